@@ -0,0 +1 @@
+"""Benchmarks that measure the performance of the bot without connecting to telegram"""
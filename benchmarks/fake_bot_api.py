@@ -0,0 +1,440 @@
+"""Local stand-in for the telegram Bot API, so the whole bot can be run without a network.
+Only the methods used by the bot are implemented. The updates are pushed by the caller, acting as the users"""
+import email
+import email.policy
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qsl
+from PIL import Image
+
+FAKE_TOKEN = "123456789:fake-token-for-the-local-bot-api"
+
+BOT_USER = {
+    'id': 123456789,
+    'is_bot': True,
+    'first_name': "Newsgen",
+    'username': "newsgen_fake_bot",
+}
+
+PHOTO_SIZES = (90, 320, 800, 1280, 2560)  # max side of the sizes generated for each photo, like telegram does
+
+API_PATH = re.compile(r"^/bot(?P<token>[^/]+)/(?P<method>\w+)$")
+FILE_PATH = re.compile(r"^/file/bot(?P<token>[^/]+)/(?P<file_path>.+)$")
+
+LIMIT_WINDOW = 1  # seconds over which the calls are counted, when the limits are enforced
+
+
+class ApiError(Exception):
+    """Error returned to the bot, like the ones of the real Bot API
+
+    Args:
+        error_code (int): http status code
+        description (str): description of the error
+    """
+
+    def __init__(self, error_code: int, description: str, parameters: dict = None):
+        super().__init__(description)
+        self.error_code = error_code
+        self.description = description
+        self.parameters = parameters
+
+
+class ApiCall:
+    """Request made by the bot to the fake Bot API
+
+    Args:
+        method (str): Bot API method called
+        params (dict): parameters of the request. Uploaded files are replaced by their size in bytes
+        result (object): result returned to the bot
+    """
+
+    def __init__(self, method: str, params: dict, result: object):
+        self.method = method
+        self.params = params
+        self.result = result
+        self.time = time.perf_counter()
+
+
+def parse_multipart(content_type: str, body: bytes) -> dict:
+    """Parses a multipart/form-data body, the one used by the bot when uploading files
+
+    Args:
+        content_type (str): Content-Type header of the request, with the boundary
+        body (bytes): body of the request
+
+    Returns:
+        dict: fields of the form. Files are bytes, everything else is a str
+    """
+    message = email.message_from_bytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body,
+                                       policy=email.policy.HTTP)
+    params = {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        payload = part.get_payload(decode=True)
+        params[name] = payload if part.get_filename() is not None else payload.decode()
+    return params
+
+
+class FakeBotApi:
+    """Http server that answers to the bot as the Bot API would, keeping every chat in memory.
+    Every call made by the bot is recorded, so the users can wait for the answer they expect.
+    Like telegram, it can refuse the messages sent too fast with a 429 "Too Many Requests" error
+
+    Args:
+        host (str, optional): address the server listens on. Defaults to "127.0.0.1".
+        port (int, optional): port the server listens on. 0 picks a free one. Defaults to 0.
+        chat_limit (int, optional): messages (sent, edited or deleted) accepted in each chat in LIMIT_WINDOW seconds.
+            If 0, there is no limit. Defaults to 0.
+        global_limit (int, optional): messages accepted in all the chats in LIMIT_WINDOW seconds.
+            If 0, there is no limit. Defaults to 0.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, chat_limit: int = 0, global_limit: int = 0):
+        self._cond = threading.Condition()
+        self._updates = []
+        self._next_update_id = 1
+        self._next_message_id = {}  # chat_id -> id of the next message in the chat
+        self._next_file_id = 1
+        self._files = {}  # file_id -> content of the file
+        self._commands = []
+        self._calls = {}  # chat_id -> list of ApiCall
+        self._closing = False
+        self.method_counts = {}
+        self.chat_limit = chat_limit
+        self.global_limit = global_limit
+        self.rejected = 0  # calls refused because of the limits
+        self._recent = {}  # chat_id -> times of the messages accepted in the last LIMIT_WINDOW seconds, 0 for all
+        self._server = ThreadingHTTPServer((host, port), self._build_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """Url of the server"""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def base_url(self) -> str:
+        """Value to use as base_url of the Bot"""
+        return f"{self.url}/bot"
+
+    @property
+    def base_file_url(self) -> str:
+        """Value to use as base_file_url of the Bot"""
+        return f"{self.url}/file/bot"
+
+    def start(self):
+        """Starts serving the requests in another thread
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the server, waking up the pending getUpdates
+        """
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+
+    # region users side
+
+    def add_photo(self, data: bytes) -> list:
+        """Stores the photo in all the sizes telegram would generate
+
+        Args:
+            data (bytes): content of the photo, as a JPEG
+
+        Returns:
+            list: PhotoSize dicts, from the smallest to the original one
+        """
+        with Image.open(BytesIO(data)) as im:
+            im = im.convert("RGB")  # the bot may upload PNGs too, telegram stores JPEGs
+        sizes = []
+        for max_side in PHOTO_SIZES:
+            if max_side >= max(im.size):
+                break
+            ratio = max_side / max(im.size)
+            thumb = im.resize((max(1, round(im.width * ratio)), max(1, round(im.height * ratio))), Image.BILINEAR)
+            out = BytesIO()
+            thumb.save(out, format="JPEG", quality=87)
+            sizes.append(self._photo_size(out.getvalue(), thumb.size))
+        sizes.append(self._photo_size(data, im.size))
+        return sizes
+
+    def push_message(self, user: dict, text: str = None, photo: list = None) -> dict:
+        """Sends a message to the bot in the private chat of the user
+
+        Args:
+            user (dict): telegram user sending the message
+            text (str, optional): text of the message. Defaults to None.
+            photo (list, optional): PhotoSize dicts returned by add_photo. Defaults to None.
+
+        Returns:
+            dict: message sent
+        """
+        message = self._new_message(chat_id=user['id'], sender=user)
+        if text is not None:
+            message['text'] = text
+            if text.startswith("/"):
+                message['entities'] = [{'type': "bot_command", 'offset': 0, 'length': len(text.split()[0])}]
+        if photo is not None:
+            message['photo'] = photo
+        self._push_update(message=message)
+        return message
+
+    def push_callback(self, user: dict, message: dict, data: str):
+        """Presses the inline button with the data provided
+
+        Args:
+            user (dict): telegram user pressing the button
+            message (dict): message the inline keyboard belongs to
+            data (str): callback_data of the button
+        """
+        with self._cond:
+            query_id = str(self._next_update_id)
+        callback_query = {
+            'id': query_id,
+            'from': user,
+            'chat_instance': str(message['chat']['id']),
+            'message': message,
+            'data': data,
+        }
+        self._push_update(callback_query=callback_query)
+
+    def calls(self, chat_id: int) -> list:
+        """Gets a copy of the calls made by the bot in the chat
+
+        Args:
+            chat_id (int): id of the chat
+
+        Returns:
+            list: ApiCall made so far, in order
+        """
+        with self._cond:
+            return list(self._calls.get(chat_id, []))
+
+    def wait_call(self, chat_id: int, predicate, start: int = 0, timeout: float = 60) -> tuple:
+        """Waits for the bot to make a call in the chat that satisfies the predicate
+
+        Args:
+            chat_id (int): id of the chat
+            predicate (Callable): function that takes an ApiCall and returns True if it is the one expected
+            start (int, optional): index of the first call to look at. Defaults to 0.
+            timeout (float, optional): seconds to wait before giving up. Defaults to 60.
+
+        Returns:
+            tuple: (ApiCall found, its index), or (None, start) if the timeout expired
+        """
+        deadline = time.perf_counter() + timeout
+        index = start
+        with self._cond:
+            while True:
+                calls = self._calls.get(chat_id, [])
+                while index < len(calls):
+                    if predicate(calls[index]):
+                        return calls[index], index
+                    index += 1
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0 or self._closing:
+                    return None, start
+                self._cond.wait(remaining)
+
+    # endregion
+
+    # region bot side
+
+    def _build_handler(self) -> type:
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Handles the http requests made by the bot"""
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True  # headers and body are written separately, don't wait for the ack in between
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                match = FILE_PATH.match(self.path)
+                if match:
+                    file_id = match.group('file_path').rsplit("/", 1)[-1].split(".")[0]
+                    data = api._files.get(file_id)
+                    if data is None:
+                        self._send(404, b"Not Found", "text/plain")
+                    else:
+                        self._send(200, data, "application/octet-stream")
+                    return
+                self.do_POST()
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                match = API_PATH.match(self.path.split("?")[0])
+                if match is None:
+                    self._send_json(404, {'ok': False, 'error_code': 404, 'description': "Not Found"})
+                    return
+                try:
+                    result = api._call(match.group('method'), self._read_params())
+                    self._send_json(200, {'ok': True, 'result': result})
+                except ApiError as e:
+                    error = {'ok': False, 'error_code': e.error_code, 'description': e.description}
+                    if e.parameters is not None:
+                        error['parameters'] = e.parameters
+                    self._send_json(e.error_code, error)
+
+            def _read_params(self) -> dict:
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b""
+                content_type = self.headers.get('Content-Type', "")
+                params = dict(parse_qsl(self.path.split("?", 1)[1])) if "?" in self.path else {}
+                if content_type.startswith("application/json") and body:
+                    params.update(json.loads(body))
+                elif content_type.startswith("multipart/form-data"):
+                    params.update(parse_multipart(content_type, body))
+                elif body:
+                    params.update(parse_qsl(body.decode()))
+                return params
+
+            def _send_json(self, status: int, content: dict):
+                self._send(status, json.dumps(content).encode(), "application/json")
+
+            def _send(self, status: int, body: bytes, content_type: str):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                pass  # keep the output of the load test readable
+
+        return Handler
+
+    def _call(self, method: str, params: dict) -> object:
+        with self._cond:
+            self.method_counts[method] = self.method_counts.get(method, 0) + 1
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if method == "getMe":
+            return BOT_USER
+        if method == "setMyCommands":
+            self._commands = self._json_param(params, 'commands')
+            return True
+        if method == "getMyCommands":
+            return self._commands
+        if method in ("deleteWebhook", "setWebhook", "answerCallbackQuery"):
+            return True
+        if method == "getFile":
+            return self._get_file(params)
+
+        if 'chat_id' not in params:
+            raise ApiError(400, "Bad Request: chat_id is empty")
+        chat_id = int(params['chat_id'])
+        self._check_limits(chat_id)
+        if method == "sendMessage":
+            result = self._new_message(chat_id=chat_id, sender=BOT_USER, text=params['text'],
+                                       reply_markup=self._json_param(params, 'reply_markup'))
+        elif method == "sendPhoto":
+            result = self._new_message(chat_id=chat_id, sender=BOT_USER, photo=self._upload(params['photo']),
+                                       reply_markup=self._json_param(params, 'reply_markup'))
+        elif method == "editMessageText":
+            result = self._edited_message(chat_id, params, text=params['text'])
+        elif method == "editMessageMedia":
+            media = self._json_param(params, 'media')
+            content = media['media']
+            if content.startswith("attach://"):
+                content = params[content[len("attach://"):]]
+            result = self._edited_message(chat_id, params, photo=self._upload(content))
+        elif method == "deleteMessage":
+            result = True
+        else:
+            raise ApiError(404, "Not Found: method not found")
+
+        with self._cond:
+            recorded = {key: len(value) if isinstance(value, bytes) else value for key, value in params.items()}
+            self._calls.setdefault(chat_id, []).append(ApiCall(method, recorded, result))
+            self._cond.notify_all()
+        return result
+
+    def _check_limits(self, chat_id: int):
+        now = time.perf_counter()
+        with self._cond:
+            limits = ((chat_id, self.chat_limit), (0, self.global_limit))
+            for key, limit in limits:
+                recent = self._recent.setdefault(key, [])
+                while recent and recent[0] <= now - LIMIT_WINDOW:
+                    recent.pop(0)
+                if 0 < limit <= len(recent):
+                    self.rejected += 1
+                    retry_after = max(1, round(recent[0] + LIMIT_WINDOW - now))
+                    raise ApiError(429, f"Too Many Requests: retry after {retry_after}", {'retry_after': retry_after})
+            for key, limit in limits:
+                if limit > 0:
+                    self._recent[key].append(now)
+
+    def _get_updates(self, params: dict) -> list:
+        offset = int(params.get('offset', 0) or 0)
+        limit = int(params.get('limit', 100) or 100)
+        timeout = float(params.get('timeout', 0) or 0)
+        with self._cond:
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            if not self._updates and timeout > 0:
+                self._cond.wait_for(lambda: self._updates or self._closing, timeout)
+            return self._updates[:limit]
+
+    def _get_file(self, params: dict) -> dict:
+        file_id = params.get('file_id')
+        data = self._files.get(file_id)
+        if data is None:
+            raise ApiError(400, "Bad Request: invalid file_id")
+        return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(data), 'file_path': f"photos/{file_id}.jpg"}
+
+    def _push_update(self, **content):
+        with self._cond:
+            self._updates.append({'update_id': self._next_update_id, **content})
+            self._next_update_id += 1
+            self._cond.notify_all()
+
+    def _new_message(self, chat_id: int, sender: dict, message_id: int = None, **content) -> dict:
+        if message_id is None:
+            with self._cond:
+                message_id = self._next_message_id.get(chat_id, 1)
+                self._next_message_id[chat_id] = message_id + 1
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {
+                'id': chat_id,
+                'type': "private"
+            },
+            'from': sender,
+        }
+        message.update({key: value for key, value in content.items() if value is not None})
+        return message
+
+    def _edited_message(self, chat_id: int, params: dict, **content) -> dict:
+        message = self._new_message(chat_id=chat_id, sender=BOT_USER, message_id=int(params['message_id']),
+                                    reply_markup=self._json_param(params, 'reply_markup'), **content)
+        message['edit_date'] = message['date']
+        return message
+
+    def _upload(self, content) -> list:
+        if isinstance(content, bytes):
+            return self.add_photo(content)
+        return [{'file_id': content, 'file_unique_id': content, 'width': 0, 'height': 0}]  # photo sent again by file_id
+
+    def _photo_size(self, data: bytes, size: tuple) -> dict:
+        with self._cond:
+            file_id = f"photo{self._next_file_id}"
+            self._next_file_id += 1
+            self._files[file_id] = data
+        return {'file_id': file_id, 'file_unique_id': file_id, 'width': size[0], 'height': size[1], 'file_size': len(data)}
+
+    @staticmethod
+    def _json_param(params: dict, key: str):
+        value = params.get(key)
+        return json.loads(value) if isinstance(value, str) else value
+
+    # endregion
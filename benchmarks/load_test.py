@@ -0,0 +1,318 @@
+"""Runs the whole bot against a local fake Bot API, with many users creating images at the same time.
+Run from the root directory of the project with `python3 -m benchmarks.load_test`"""
+import getopt
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from telegram.ext import Updater
+from main import add_commands, add_handlers
+from modules.data.data_reader import config_map, read_md
+from modules.various.asset_cache import preload_assets
+from modules.various.render_engine import shutdown_engine
+from modules.various.update_pool import create_updater
+from benchmarks.fake_bot_api import FAKE_TOKEN, FakeBotApi
+from benchmarks.render_benchmark import RESIZE_MODES, create_background, get_peak_rss_kb, summarize
+
+FIRST_USER_ID = 1000000
+
+TITLE = "TITOLO DI PROVA"
+CAPTION = "Le lezioni del corso di Analisi I sono sospese fino a data da destinarsi, seguiranno aggiornamenti"
+
+
+class FlowTimeout(Exception):
+    """The bot did not answer in time"""
+
+
+class SimulatedUser:
+    """User going through the whole /create conversation, measuring how long the bot takes to answer each step
+
+    Args:
+        api (FakeBotApi): fake Bot API the bot is connected to
+        user_id (int): id of the user, also used as the id of the private chat
+        photo (list): PhotoSize dicts of the background to send. None sends "none" instead
+        crop_presses (int): number of crop or random buttons pressed before finishing
+        timeout (float): seconds to wait for each answer
+    """
+
+    def __init__(self, api: FakeBotApi, user_id: int, photo: list, crop_presses: int, timeout: float):
+        self.api = api
+        self.user = {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"}
+        self.photo = photo
+        self.crop_presses = crop_presses
+        self.timeout = timeout
+        self.latencies = {}  # step -> list of latencies in ms
+        self.outcomes = {}  # outcome -> number of flows
+        self._cursor = 0
+
+    def run(self, rounds: int, resize_mode: str):
+        """Goes through the conversation the requested number of times
+
+        Args:
+            rounds (int): number of images to create
+            resize_mode (str): resize mode chosen by the user
+        """
+        for _ in range(rounds):
+            try:
+                outcome = self.create_image(resize_mode)
+            except FlowTimeout as e:
+                outcome = f"timeout/{e}"
+                self._cursor = len(self.api.calls(self.user['id']))  # ignore the answers that arrived too late
+                try:
+                    self._send_text("/cancel", "cancel", is_sent_message)
+                except FlowTimeout:
+                    pass
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def create_image(self, resize_mode: str) -> str:
+        """Goes through the conversation once
+
+        Args:
+            resize_mode (str): resize mode chosen by the user
+
+        Returns:
+            str: outcome of the flow
+        """
+        flow_start = time.perf_counter()
+        message = self._send_text("/create", "create", is_sent_message)
+        while message.params['text'] == read_md("create_fail"):  # the previous image is still being cleared
+            time.sleep(0.05)
+            message = self._send_text("/create", "create", is_sent_message)
+
+        message = self._press(message.result, "template_DMI", "template", is_edited_message)
+        self._send_text(TITLE, "title", is_sent_message)
+        message = self._send_text(CAPTION, "caption", is_sent_message)
+        self._press(message.result, f"image_resize_mode_{resize_mode}", "resize_mode", is_edited_message)
+
+        if self.photo is None:
+            message = self._send(lambda: self.api.push_message(self.user, text="none"), "background", is_photo)
+        else:
+            message = self._send(lambda: self.api.push_message(self.user, photo=self.photo), "background", is_photo)
+        if message.method != "sendPhoto":
+            return self._cancel("busy")
+
+        if resize_mode != "scale":
+            prefix = "image_crop" if resize_mode == "crop" else "image_random"
+            operations = ("up", "left", "down-right") if resize_mode == "crop" else ("again",)
+            for i in range(self.crop_presses):
+                message = self._press(message.result, f"{prefix}_{operations[i % len(operations)]}", resize_mode,
+                                      is_preview)
+                if is_busy(message):
+                    return self._cancel("busy")
+            message = self._press(message.result, f"{prefix}_finish", "finish", is_final_photo)
+            if message.method != "editMessageMedia":
+                return self._cancel("busy")
+
+        self.latencies.setdefault("flow", []).append((time.perf_counter() - flow_start) * 1000)
+        return "completed"
+
+    def _send_text(self, text: str, step: str, predicate) -> object:
+        return self._send(lambda: self.api.push_message(self.user, text=text), step, predicate)
+
+    def _press(self, message: dict, data: str, step: str, predicate) -> object:
+        return self._send(lambda: self.api.push_callback(self.user, message, data), step, predicate)
+
+    def _send(self, push, step: str, predicate) -> object:
+        start = time.perf_counter()
+        push()
+        call, index = self.api.wait_call(self.user['id'], predicate, self._cursor, self.timeout)
+        if call is None:
+            raise FlowTimeout(step)
+        self._cursor = index + 1
+        self.latencies.setdefault(step, []).append((call.time - start) * 1000)
+        return call
+
+    def _cancel(self, outcome: str) -> str:
+        self._send_text("/cancel", "cancel", is_sent_message)
+        return outcome
+
+
+def is_sent_message(call) -> bool:
+    """The bot has sent a text message"""
+    return call.method == "sendMessage"
+
+
+def is_edited_message(call) -> bool:
+    """The bot has edited a text message"""
+    return call.method == "editMessageText"
+
+
+def is_busy(call) -> bool:
+    """The bot has refused to create the image because it is too busy"""
+    return call.method == "sendMessage" and call.params['text'] == read_md("busy")
+
+
+def is_photo(call) -> bool:
+    """The bot has sent an image, or it is too busy to do so"""
+    return call.method == "sendPhoto" or is_busy(call)
+
+
+def is_preview(call) -> bool:
+    """The bot has sent a new preview, or replaced the previous one, or it is too busy to do so"""
+    return call.method == "sendPhoto" or (call.method == "editMessageMedia" and 'reply_markup' in call.result) \
+        or is_busy(call)
+
+
+def is_final_photo(call) -> bool:
+    """The bot has replaced the preview with the final image, or it is too busy to do so"""
+    return (call.method == "editMessageMedia" and 'reply_markup' not in call.result) or is_busy(call)
+
+
+def start_bot(api: FakeBotApi, workers: int) -> Updater:
+    """Starts the bot with the same handlers main.main uses, connected to the fake Bot API
+
+    Args:
+        api (FakeBotApi): fake Bot API
+        workers (int): number of workers of the dispatcher
+
+    Returns:
+        Updater: updater of the bot, already polling
+    """
+    config_map['token'] = FAKE_TOKEN
+    config_map['groups'] = []
+    config_map['dispatcher']['workers'] = workers
+    updater = create_updater(FAKE_TOKEN, base_url=api.base_url, base_file_url=api.base_file_url)
+    add_commands(updater)
+    add_handlers(updater.dispatcher)
+    preload_assets()
+    updater.start_polling(poll_interval=0, timeout=1)
+    return updater
+
+
+def main():
+    """Main function
+    """
+    help_message = "python3 -m benchmarks.load_test [options]\n\n"\
+        "-u --users <n>             number of users creating images at the same time (defaults to 10)\n"\
+        "-r --rounds <n>            number of images created by each user (defaults to 3)\n"\
+        "-m --modes <modes>         resize modes used, comma separated, assigned in turn (defaults to crop,scale,random)\n"\
+        "-c --crop-presses <n>      crop or random buttons pressed before finishing (defaults to 2)\n"\
+        "-s --size <w>x<h>          size of the background sent, or none (defaults to 1280x960)\n"\
+        "-w --workers <n>           number of workers of the dispatcher (defaults to 4)\n"\
+        "-T --timeout <s>           seconds to wait for each answer of the bot (defaults to 60)\n"\
+        "-l --limits <chat>,<all>   messages per second the fake Bot API accepts in each chat and in all of them,\n"\
+        "                           refusing the others with 429 errors like telegram (defaults to 0,0, no limits)\n"\
+        "-o --output <file>         save the results as json in file\n"
+
+    users = 10
+    rounds = 3
+    modes = list(RESIZE_MODES)
+    crop_presses = 2
+    size = "1280x960"
+    workers = 4
+    timeout = 60
+    limits = (0, 0)
+    output_path = ""
+
+    try:
+        opts, _ = getopt.getopt(
+            sys.argv[1:], "hu:r:m:c:s:w:T:l:o:", [
+                "help", "users=", "rounds=", "modes=", "crop-presses=", "size=", "workers=", "timeout=", "limits=",
+                "output="
+            ])
+    except getopt.GetoptError:
+        print(help_message)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print(help_message)
+            sys.exit()
+        elif opt in ("-u", "--users"):
+            users = int(arg)
+        elif opt in ("-r", "--rounds"):
+            rounds = int(arg)
+        elif opt in ("-m", "--modes"):
+            modes = arg.split(",")
+        elif opt in ("-c", "--crop-presses"):
+            crop_presses = int(arg)
+        elif opt in ("-s", "--size"):
+            size = arg
+        elif opt in ("-w", "--workers"):
+            workers = int(arg)
+        elif opt in ("-T", "--timeout"):
+            timeout = float(arg)
+        elif opt in ("-l", "--limits"):
+            limits = tuple(int(limit) for limit in arg.split(","))
+        elif opt in ("-o", "--output"):
+            output_path = arg
+
+    api = FakeBotApi(chat_limit=limits[0], global_limit=limits[1])
+    api.start()
+    photo = None
+    if size.lower() != "none":
+        bg_dir = os.path.join(tempfile.gettempdir(), "newsgen_benchmark")
+        os.makedirs(bg_dir, exist_ok=True)
+        with open(create_background(tuple(int(side) for side in size.split("x")), bg_dir), "rb") as bg_file:
+            photo = api.add_photo(bg_file.read())
+
+    updater = start_bot(api, workers)
+    simulated_users = [SimulatedUser(api, FIRST_USER_ID + i, photo, crop_presses, timeout) for i in range(users)]
+    threads = [
+        threading.Thread(target=user.run, args=(rounds, modes[i % len(modes)]), daemon=True)
+        for i, user in enumerate(simulated_users)
+    ]
+    print(f"[info] {users} users, {rounds} images each, background {size}")
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    updater.stop()
+    shutdown_engine()
+    api.stop()
+
+    latencies, outcomes = {}, {}
+    for user in simulated_users:
+        for step, values in user.latencies.items():
+            latencies.setdefault(step, []).extend(values)
+        for outcome, count in user.outcomes.items():
+            outcomes[outcome] = outcomes.get(outcome, 0) + count
+    results = {step: {'count': len(values), **summarize(values)} for step, values in latencies.items()}
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'users': users,
+            'rounds': rounds,
+            'modes': modes,
+            'crop_presses': crop_presses,
+            'size': size,
+            'workers': workers,
+            'limits': limits,
+            'image_settings': config_map['image'],
+            'render_settings': config_map['render'],
+            'rate_limit_settings': config_map['rate_limit'],
+            'duration_s': round(duration, 3),
+        },
+        'flows_per_s': round(outcomes.get("completed", 0) / duration, 3),
+        'outcomes': outcomes,
+        'api_calls': dict(sorted(api.method_counts.items())),
+        'api_rejected': api.rejected,
+        'peak_rss_kb': get_peak_rss_kb(),
+        'results': results,
+    }
+
+    for step, result in results.items():
+        print(f"[info] {step}: {result['count']} answers, p50 {result['p50_ms']} ms, p90 {result['p90_ms']} ms, "
+              f"p99 {result['p99_ms']} ms")
+    print(f"[info] {outcomes} in {report['meta']['duration_s']} s, {report['flows_per_s']} images/s, "
+          f"peak RSS {report['peak_rss_kb']} KB")
+    print(f"[info] {sum(api.method_counts.values())} api calls, {api.rejected} refused with 429")
+
+    if output_path:
+        with open(output_path, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"[info] results saved in {output_path}")
+
+
+if __name__ == "__main__":
+    main()
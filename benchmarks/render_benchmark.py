@@ -0,0 +1,335 @@
+"""Measures the time needed to create the images, calling photo_utils directly.
+Run from the root directory of the project with `python3 -m benchmarks.render_benchmark`"""
+import getopt
+import glob
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from io import BytesIO
+from statistics import mean
+from PIL import Image, ImageDraw
+from modules.various.asset_cache import get_template
+from modules.various.font_registry import get_font
+from modules.various.photo_utils import create_image, resize_image, draw_text, prepare_background
+from modules.various.render_session import RenderSession
+from modules.various.text_layout import wrap_text
+from modules.data.data_reader import config_map
+
+RESIZE_MODES = ("crop", "scale", "random")
+
+BACKGROUNDS = {
+    'default': None,
+    'small': (640, 480),
+    'medium': (1280, 960),
+    'large': (2560, 1920),
+    '12mp': (4000, 3000),
+}  # synthetic backgrounds, from the default one (no background sent) to a 12 MP photo
+
+CAPTIONS = {
+    'short': "Lezioni sospese",
+    'medium': "Le lezioni del corso di Analisi I sono sospese fino a data da destinarsi, seguiranno aggiornamenti",
+    'long': "Si comunica che gli esami della sessione straordinaria si svolgeranno in presenza nelle aule del "
+            "dipartimento. Gli studenti sono invitati a prenotarsi entro la scadenza indicata sul portale. " * 3,
+    'very_long': "Si comunica che gli esami della sessione straordinaria si svolgeranno in presenza nelle aule del "
+                 "dipartimento. Gli studenti sono invitati a prenotarsi entro la scadenza indicata sul portale. " * 15,
+}
+
+
+def get_templates() -> list:
+    """Gets the name of all the templates in data/img
+
+    Returns:
+        list: names of the templates
+    """
+    return sorted(os.path.basename(path)[len("template_"):-len(".png")] for path in glob.glob("data/img/template_*.png"))
+
+
+def create_background(size: tuple, directory: str) -> str:
+    """Creates a synthetic photo-like background and saves it as a JPEG, like the ones sent by telegram
+
+    Args:
+        size (tuple): (width, height) of the background
+        directory (str): directory where the background is saved
+
+    Returns:
+        str: path of the background
+    """
+    path = os.path.join(directory, f"bg_{size[0]}x{size[1]}.jpg")
+    if not os.path.exists(path):
+        w, h = size
+        im = Image.linear_gradient("L").resize(size).convert("RGB")
+        noise = Image.effect_noise(size, 64).convert("RGB")
+        im = Image.blend(im, noise, 0.4)
+        draw_im = ImageDraw.Draw(im)
+        for i in range(0, w, max(1, w // 12)):  # some sharp shapes, so the blur has something to work on
+            draw_im.rectangle((i, h // 4, i + w // 24, h * 3 // 4), fill=(i * 255 // w, 90, 160))
+        im.save(path, format="JPEG", quality=90)
+    return path
+
+
+def measure(fn, iterations: int) -> dict:
+    """Calls the function the requested number of times, measuring the latency of each call
+
+    Args:
+        fn (Callable): function to measure
+        iterations (int): number of calls
+
+    Returns:
+        dict: latency percentiles and mean in milliseconds, throughput in calls per second
+    """
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - start) * 1000)
+    total = sum(latencies)
+    return {
+        'iterations': iterations,
+        **summarize(latencies),
+        'throughput_per_s': round(iterations / total * 1000, 3) if total > 0 else None,
+    }
+
+
+def summarize(latencies: list) -> dict:
+    """Summarizes the latencies measured
+
+    Args:
+        latencies (list): latencies in milliseconds
+
+    Returns:
+        dict: latency percentiles, mean and max in milliseconds
+    """
+    latencies = sorted(latencies)
+    return {
+        'mean_ms': round(mean(latencies), 3),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p90_ms': round(percentile(latencies, 90), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'max_ms': round(latencies[-1], 3),
+    }
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """Gets the percentile of the sorted values, interpolating between the closest ranks
+
+    Args:
+        sorted_values (list): values sorted in ascending order
+        pct (float): percentile, from 0 to 100
+
+    Returns:
+        float: the percentile
+    """
+    k = (len(sorted_values) - 1) * pct / 100
+    low = int(k)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (k - low)
+
+
+def get_peak_rss_kb() -> int:
+    """Gets the peak resident set size of the process
+
+    Returns:
+        int: peak RSS in KB
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss  # macOS reports bytes, linux KB
+
+
+def bench_create_image(backgrounds: dict, templates: list, iterations: int) -> dict:
+    """Measures create_image for each template, resize mode and background.
+    "cold" renders start from a new session, "warm" renders reuse it, like the crop and random re-renders
+
+    Args:
+        backgrounds (dict): name -> path of the background (or "" for the default one)
+        templates (list): templates to use
+        iterations (int): number of renders for each case
+
+    Returns:
+        dict: results for each case
+    """
+    results = {}
+    for template in templates:
+        for resize_mode in RESIZE_MODES:
+            for bg_name, bg_path in backgrounds.items():
+                data = {
+                    'title': "TITOLO DI PROVA",
+                    'caption': CAPTIONS['medium'],
+                    'template': template,
+                    'resize_mode': resize_mode,
+                    'background_offset': {
+                        'x': 50,
+                        'y': -50
+                    } if resize_mode == "crop" else None,
+                }
+                name = f"create_image/{template}/{resize_mode}/{bg_name}"
+                results[f"{name}/cold"] = measure(
+                    lambda: create_image(data=data, bg_path=bg_path, photo_path=BytesIO(), session=RenderSession()),
+                    iterations)
+                session = RenderSession()
+                create_image(data=data, bg_path=bg_path, photo_path=BytesIO(), session=session)
+                results[f"{name}/warm"] = measure(
+                    lambda: create_image(data=data, bg_path=bg_path, photo_path=BytesIO(), session=session), iterations)
+                print(f"[info] {name}: cold p50 {results[name + '/cold']['p50_ms']} ms, "
+                      f"warm p50 {results[name + '/warm']['p50_ms']} ms")
+    return results
+
+
+def bench_resize_image(backgrounds: dict, iterations: int) -> dict:
+    """Measures resize_image for each resize mode and background, on an already prepared background
+
+    Args:
+        backgrounds (dict): name -> path of the background (or "" for the default one)
+        iterations (int): number of calls for each case
+
+    Returns:
+        dict: results for each case
+    """
+    results = {}
+    fg = get_template("DMI")
+    for resize_mode in RESIZE_MODES:
+        for bg_name, bg_path in backgrounds.items():
+            im, scale = prepare_background(bg_path=bg_path, template="DMI", size=fg.size, resize_mode=resize_mode,
+                                           blur=config_map['image']['blur'], blur_mode=config_map['image']['blur_mode'])
+            offset = {'x': 50, 'y': -50} if resize_mode == "crop" else None
+            results[f"resize_image/{resize_mode}/{bg_name}"] = measure(
+                lambda: resize_image(im=im, fg=fg, resize_mode=resize_mode, offset=offset, scale=scale), iterations)
+    return results
+
+
+def bench_text(iterations: int) -> dict:
+    """Measures draw_text and wrap_text for each caption length
+
+    Args:
+        iterations (int): number of calls for each case
+
+    Returns:
+        dict: results for each case
+    """
+    results = {}
+    font_size = config_map['image']['font_size_caption']
+    font = get_font(size=font_size)
+    canvas = Image.new("RGBA", get_template("DMI").size, (255, 255, 255, 0))
+    draw_im = ImageDraw.Draw(canvas)
+    w = canvas.size[0]
+    for caption_name, caption in CAPTIONS.items():
+        results[f"wrap_text/{caption_name}"] = measure(lambda: wrap_text(text=caption, max_w=w / 3 * 2, font=font),
+                                                       iterations)
+        results[f"draw_text/{caption_name}"] = measure(
+            lambda: draw_text(draw_im=draw_im, w=w, text=caption, y_text=0, font_size=font_size), iterations)
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float, min_delta_ms: float = 1) -> list:
+    """Compares the results with the baseline
+
+    Args:
+        results (dict): current results
+        baseline (dict): results used as reference
+        threshold (float): relative slowdown of the p50 tolerated before reporting a regression (0.2 = 20%)
+        min_delta_ms (float, optional): absolute slowdown of the p50 ignored anyway, so that the fastest cases
+            don't report noise as regressions. Defaults to 1.
+
+    Returns:
+        list: descriptions of the regressions found
+    """
+    regressions = []
+    for name, current in results['results'].items():
+        reference = baseline['results'].get(name)
+        if reference is None or reference['p50_ms'] <= 0:
+            continue
+        ratio = current['p50_ms'] / reference['p50_ms']
+        if ratio > 1 + threshold and current['p50_ms'] - reference['p50_ms'] >= min_delta_ms:
+            regressions.append(f"{name}: p50 {reference['p50_ms']} ms -> {current['p50_ms']} ms (x{ratio:.2f})")
+    return regressions
+
+
+def main():
+    """Main function
+    """
+    help_message = "python3 -m benchmarks.render_benchmark [options]\n\n"\
+        "-i --iterations <n>        number of calls for each case (defaults to 10)\n"\
+        "-q --quick                 only the DMI template and the backgrounds up to large\n"\
+        "-o --output <file>         save the results as json in file\n"\
+        "-b --baseline <file>       compare the results with the ones saved in file\n"\
+        "-t --threshold <ratio>     p50 slowdown tolerated before a regression is reported (defaults to 0.2)\n"
+
+    iterations = 10
+    quick = False
+    output_path = ""
+    baseline_path = ""
+    threshold = 0.2
+
+    try:
+        opts, _ = getopt.getopt(sys.argv[1:], "hqi:o:b:t:",
+                                ["help", "quick", "iterations=", "output=", "baseline=", "threshold="])
+    except getopt.GetoptError:
+        print(help_message)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print(help_message)
+            sys.exit()
+        elif opt in ("-i", "--iterations"):
+            iterations = int(arg)
+        elif opt in ("-q", "--quick"):
+            quick = True
+        elif opt in ("-o", "--output"):
+            output_path = arg
+        elif opt in ("-b", "--baseline"):
+            baseline_path = arg
+        elif opt in ("-t", "--threshold"):
+            threshold = float(arg)
+
+    templates = ["DMI"] if quick else get_templates()
+    bg_dir = os.path.join(tempfile.gettempdir(), "newsgen_benchmark")
+    os.makedirs(bg_dir, exist_ok=True)
+    backgrounds = {
+        name: create_background(size, bg_dir) if size else ""
+        for name, size in BACKGROUNDS.items()
+        if not (quick and name == "12mp")
+    }
+
+    start = time.perf_counter()
+    results = {}
+    results.update(bench_text(iterations))
+    results.update(bench_resize_image(backgrounds, iterations))
+    results.update(bench_create_image(backgrounds, templates, iterations))
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'pillow': Image.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'iterations': iterations,
+            'image_settings': config_map['image'],
+            'duration_s': round(time.perf_counter() - start, 3),
+        },
+        'peak_rss_kb': get_peak_rss_kb(),
+        'results': results,
+    }
+    print(f"[info] {len(results)} cases in {report['meta']['duration_s']} s, peak RSS {report['peak_rss_kb']} KB")
+
+    if output_path:
+        with open(output_path, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"[info] results saved in {output_path}")
+
+    if baseline_path:
+        with open(baseline_path, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(report, baseline, threshold)
+        for regression in regressions:
+            print(f"[regression] {regression}")
+        if regressions:
+            sys.exit(1)
+        print("[info] no regressions compared to the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,25 @@
 # region imports
 # libs
 import os
+import signal
 import warnings
+from threading import current_thread, main_thread
 # telegram
 from telegram import BotCommand
 from telegram.ext import Updater, CommandHandler, MessageHandler, ConversationHandler, CallbackQueryHandler,\
     Filters, Dispatcher
 # debug
-from modules.debug.log_manager import log_message
+from modules.debug.log_manager import log_message, close_message_log
+from modules.debug.metrics import add_metrics_endpoint, start_metrics_server
 # data
-from modules.data.data_reader import config_map
+from modules.data.data_reader import config_map, reload_markdown
+from modules.data.persistence import get_persistence
+# various
+from modules.various.asset_cache import preload_assets, invalidate_assets
+from modules.various.render_engine import engine_started, get_engine, shutdown_engine
+from modules.various.render_cache import close_render_cache
+from modules.various.photo_utils import restore_images
+from modules.various.update_pool import create_updater
 # commands
 from modules.commands.command_handlers import STATE, start_cmd, help_cmd, settings_cmd, create_cmd, background_msg,\
     title_msg, caption_msg, cancel_cmd, fail_msg
@@ -67,24 +77,54 @@ def add_handlers(dp: Dispatcher):
             },
             fallbacks=[CommandHandler('cancel', cancel_cmd),
                        MessageHandler(Filters.all & ~Filters.command, fail_msg)],
-            allow_reentry=False))
+            allow_reentry=False,
+            name="create",
+            persistent=dp.persistence is not None))
+
+
+def reload_data():
+    """Reads again the markdown responses, and the templates and default backgrounds in data/img
+    """
+    reload_markdown()
+    invalidate_assets()
+    if engine_started():  # the worker processes keep their own copy of the images
+        get_engine().run_on_all(invalidate_assets)
 
 
 def main():
     """Main function
     """
-    updater = Updater(config_map['token'], request_kwargs={'read_timeout': 20, 'connect_timeout': 20}, use_context=True)
+    persistence = get_persistence()
+    updater = create_updater(config_map['token'], persistence=persistence)
     add_commands(updater)
     add_handlers(updater.dispatcher)
+    in_progress = {}
+    if persistence is not None:  # the users who were adjusting their image can go on after the restart
+        user_data = persistence.get_user_data()
+        in_progress = {key[-1]: user_data[key[-1]]
+                       for key, state in persistence.get_conversations("create").items()
+                       if state in (STATE['crop'], STATE['random'])}
+    restore_images(updater.bot, in_progress)
+    preload_assets()
+    reload_markdown()
+    if hasattr(signal, "SIGHUP") and current_thread() is main_thread():  # kill -HUP reloads the markdown and the images
+        signal.signal(signal.SIGHUP, lambda signum, frame: reload_data())
 
     if config_map['webhook']['enabled']:  # if the webhook is enabled, start the webhook...
         PORT = int(os.environ.get('PORT', 5000))
         updater.start_webhook(listen="0.0.0.0", port=int(PORT), url_path=config_map['token'])
         updater.bot.setWebhook(config_map['webhook']['url'] + config_map['token'])
+        if config_map['metrics']['enabled']:  # the metrics are exposed on the same port
+            add_metrics_endpoint(updater)
     else:  # ... else, start the polling
         updater.start_polling()
+        if config_map['metrics']['enabled'] and config_map['metrics']['port'] > 0:
+            start_metrics_server()
 
     updater.idle()
+    shutdown_engine()
+    close_render_cache()
+    close_message_log()
 
 
 warnings.filterwarnings("ignore",
@@ -1,9 +1,10 @@
 """Handles the callbacks"""
-import os
 from telegram import Update, ParseMode
 from telegram.ext import CallbackContext
 from modules.various.utils import get_callback_info, get_keyboard_setting
-from modules.various.photo_utils import generate_photo, build_bg_path, build_photo_path
+from modules.various.photo_utils import generate_photo, random_offset, has_image_in_progress
+from modules.various.font_registry import get_font
+from modules.debug.metrics import timed
 from modules.data.data_reader import config_map, read_md, update_settings_file
 from modules.commands.command_handlers import STATE
 
@@ -43,6 +44,7 @@ OFFSET_VALUES = {
 }
 
 
+@timed("handler.settings_callback")
 def settings_callback(update: Update, context: CallbackContext):
     """Handles the settings callback
     Select which setting the user wants to modify
@@ -61,6 +63,7 @@ def settings_callback(update: Update, context: CallbackContext):
                                   parse_mode=ParseMode.MARKDOWN_V2)
 
 
+@timed("handler.alter_setting_callback")
 def alter_setting_callback(update: Update, context: CallbackContext):
     """Handles the alter setting callback
     Modify the setting based on the button pressed or finalize it
@@ -89,6 +92,9 @@ def alter_setting_callback(update: Update, context: CallbackContext):
     elif action == "cancel":  # the changes will last untill the bot is reboted
         text = "*Impostazioni*\nLe modifiche saranno in vigore fino al prossimo riavvio del bot"
 
+    if reply_markup is not None and setting.startswith("font_size") and config_map['image'][setting] > 0:
+        get_font(size=config_map['image'][setting])  # the font size has changed, load it in the shared registry
+
     info['bot'].edit_message_text(chat_id=info['chat_id'],
                                   message_id=info['message_id'],
                                   text=text,
@@ -96,6 +102,7 @@ def alter_setting_callback(update: Update, context: CallbackContext):
                                   parse_mode=ParseMode.MARKDOWN_V2)
 
 
+@timed("handler.template_callback")
 def template_callback(update: Update, context: CallbackContext) -> int:
     """Handles the template callback
     Select the desidered template
@@ -118,6 +125,7 @@ def template_callback(update: Update, context: CallbackContext) -> int:
     return STATE['title']
 
 
+@timed("handler.image_resize_mode_callback")
 def image_resize_mode_callback(update: Update, context: CallbackContext) -> int:
     """Handles the image resize mode crop callback
     Sets the resize mode of the image ('crop', 'scale', 'random')
@@ -138,6 +146,8 @@ def image_resize_mode_callback(update: Update, context: CallbackContext) -> int:
             'x': 0,
             'y': 0,
         }
+    elif info["query_data"][18:] == "random":  # the same offset is used for the preview and the final image
+        context.user_data['background_offset'] = random_offset()
 
     text = read_md("resize_mode")
     info['bot'].edit_message_text(chat_id=info['chat_id'],
@@ -147,6 +157,7 @@ def image_resize_mode_callback(update: Update, context: CallbackContext) -> int:
     return STATE['background']
 
 
+@timed("handler.image_crop_callback")
 def image_crop_callback(update: Update, context: CallbackContext) -> int:
     """Handles the image crop callback
     Modifies the cropping parameters
@@ -161,19 +172,16 @@ def image_crop_callback(update: Update, context: CallbackContext) -> int:
     """
     info = get_callback_info(update, context)
 
+    if not has_image_in_progress(info['sender_id']):  # the image has expired or has been cancelled
+        return expired_image(info)
+
     operation = info["query_data"][11:]
 
     if operation == 'reset':
         context.user_data['background_offset'] = {'x': 0, 'y': 0}
-    elif operation == 'finish':
-        sender_id = info['sender_id']
-
-        info['bot'].edit_message_reply_markup(chat_id=info['chat_id'], message_id=info['message_id'], reply_markup=None)
-
-        if os.path.exists(build_bg_path(sender_id)):
-            os.remove(build_bg_path(sender_id))
-        os.remove(build_photo_path(sender_id))
-
+    elif operation == 'finish':  # replace the preview with the full size image
+        if not generate_photo(info=info, user_data=context.user_data, final=True):
+            return STATE['crop']
         return STATE['end']
     else:
         offset_value = OFFSET_VALUES[operation]
@@ -181,11 +189,13 @@ def image_crop_callback(update: Update, context: CallbackContext) -> int:
         context.user_data['background_offset']['x'] += offset_value['x']
         context.user_data['background_offset']['y'] += offset_value['y']
 
-    generate_photo(info=info, user_data=context.user_data, delete_message=True)
+    if not has_newer_press(update, context):  # else the newer press renders the offsets accumulated so far
+        generate_photo(info=info, user_data=context.user_data, replace_message=True)
 
     return STATE['crop']
 
 
+@timed("handler.image_random_callback")
 def image_random_callback(update: Update, context: CallbackContext) -> int:
     """Handles the image random callback
     Makes yhe user try the generation again
@@ -200,19 +210,56 @@ def image_random_callback(update: Update, context: CallbackContext) -> int:
     """
     info = get_callback_info(update, context)
 
+    if not has_image_in_progress(info['sender_id']):  # the image has expired or has been cancelled
+        return expired_image(info)
+
     operation = info["query_data"][13:]
 
-    if operation == 'finish':
-        sender_id = info['sender_id']
+    if operation == 'finish':  # replace the preview with the full size image
+        if not generate_photo(info=info, user_data=context.user_data, final=True):
+            return STATE['random']
+        return STATE['end']
 
-        info['bot'].edit_message_reply_markup(chat_id=info['chat_id'], message_id=info['message_id'], reply_markup=None)
+    context.user_data['background_offset'] = random_offset()
+    if not has_newer_press(update, context):  # else the newer press draws its own offset
+        generate_photo(info=info, user_data=context.user_data, replace_message=True)
 
-        if os.path.exists(build_bg_path(sender_id)):
-            os.remove(build_bg_path(sender_id))
-        os.remove(build_photo_path(sender_id))
+    return STATE['random']
 
-        return STATE['end']
 
-    generate_photo(info=info, user_data=context.user_data, delete_message=True)
+def has_newer_press(update: Update, context: CallbackContext) -> bool:
+    """Whether the user has already pressed another button of the same preview, and the update is waiting
+    in the queue of the chat (see UpdatePool). The preview requested now would be replaced before being seen,
+    so it can be skipped. This is how the requests are coalesced when the images are not rendered by the render engine
 
-    return STATE['random']
+    Args:
+        update (Update): update event
+        context (CallbackContext): context passed by the handler
+
+    Returns:
+        bool: True if a newer press of the same user on the same message is waiting
+    """
+    pool = getattr(context.dispatcher, "pool", None)  # only the PooledDispatcher queues the updates of a chat
+    if pool is None:
+        return False
+    query = update.callback_query
+    for args in pool.waiting(update.effective_chat.id):
+        newer = args[0].callback_query if isinstance(args[0], Update) else None
+        if newer is not None and newer.message is not None and newer.from_user.id == query.from_user.id and \
+                newer.message.message_id == query.message.message_id:
+            return True
+    return False
+
+
+def expired_image(info: dict) -> int:
+    """Tells the user that the image is no longer available, so a new one has to be created
+    Puts the conversation in the "end" state
+
+    Args:
+        info (dict): info of the callback
+
+    Returns:
+        int: new state of the conversation
+    """
+    info['bot'].send_message(chat_id=info['chat_id'], text=read_md("expired"), parse_mode=ParseMode.MARKDOWN_V2)
+    return STATE['end']
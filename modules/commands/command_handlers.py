@@ -1,9 +1,11 @@
 """Handles the commands"""
-import os
 from telegram import Update, ParseMode, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CallbackContext
 from modules.various.utils import get_message_info
-from modules.various.photo_utils import build_photo_path, generate_photo, build_bg_path
+from modules.various.photo_utils import generate_photo, choose_photo_size, download_background, clear_user_images,\
+    has_image_in_progress
+from modules.various.asset_cache import get_template_size
+from modules.debug.metrics import timer, timed
 from modules.data.data_reader import read_md, config_map
 
 STATE = {
@@ -24,6 +26,7 @@ TEMPLATE = {
 }
 
 
+@timed("handler.start_cmd")
 def start_cmd(update: Update, context: CallbackContext):
     """Handles the /start command
     Sends a short welcoming message
@@ -37,6 +40,7 @@ def start_cmd(update: Update, context: CallbackContext):
     info['bot'].send_message(chat_id=info['chat_id'], text=text, parse_mode=ParseMode.MARKDOWN_V2)
 
 
+@timed("handler.help_cmd")
 def help_cmd(update: Update, context: CallbackContext):
     """Handles the /help command
     Sends a short summary of the bot's commands
@@ -50,6 +54,7 @@ def help_cmd(update: Update, context: CallbackContext):
     info['bot'].send_message(chat_id=info['chat_id'], text=text, parse_mode=ParseMode.MARKDOWN_V2)
 
 
+@timed("handler.settings_cmd")
 def settings_cmd(update: Update, context: CallbackContext):
     """Handles the /settings command
     Let the user set some values used to create the image. Those settings apply to all users
@@ -76,6 +81,7 @@ def settings_cmd(update: Update, context: CallbackContext):
                              reply_markup=inline_keyboard)
 
 
+@timed("handler.create_cmd")
 def create_cmd(update: Update, context: CallbackContext) -> int:
     """Handles the /settings command
     Start the process aimed to create the requested image
@@ -93,7 +99,7 @@ def create_cmd(update: Update, context: CallbackContext) -> int:
     return_state = STATE['end']
     if config_map['groups'] and info['chat_id'] not in config_map['groups']:  # the group is not among the allowed ones
         text = "Questo gruppo/chat non è fra quelli supportati"
-    elif os.path.exists(f"data/img/{str(info['sender_id'])}.png"):  # if the bot is already making an image for the user
+    elif has_image_in_progress(info['sender_id']):  # if the bot is already making an image for the user
         text = read_md("create_fail")
     else:
         text = read_md("create")
@@ -120,6 +126,7 @@ def create_cmd(update: Update, context: CallbackContext) -> int:
     return return_state
 
 
+@timed("handler.cancel_cmd")
 def cancel_cmd(update: Update, context: CallbackContext) -> int:
     """Handles the /cancel command
     Cancels the current cretion of the image
@@ -135,18 +142,13 @@ def cancel_cmd(update: Update, context: CallbackContext) -> int:
     info = get_message_info(update, context)
     text = read_md("cancel")
 
-    # Clear the disk space used by the images, if present
-    bg_path = build_bg_path(info['sender_id'])
-    photo_path = build_photo_path(info['sender_id'])
-    if os.path.exists(bg_path):
-        os.remove(bg_path)
-    if os.path.exists(photo_path):
-        os.remove(photo_path)
+    clear_user_images(info['sender_id'])  # clear the disk space and the memory used by the images, if present
 
     info['bot'].send_message(chat_id=info['chat_id'], text=text, parse_mode=ParseMode.MARKDOWN_V2)
     return STATE['end']
 
 
+@timed("handler.title_msg")
 def title_msg(update: Update, context: CallbackContext) -> int:
     """Handles the title message
     Saves the title so it can be used as the title of the image
@@ -165,6 +167,7 @@ def title_msg(update: Update, context: CallbackContext) -> int:
     return STATE['caption']
 
 
+@timed("handler.caption_msg")
 def caption_msg(update: Update, context: CallbackContext) -> int:
     """Handles the caption message
     Saves the caption so it can be used as the caption of the image
@@ -197,6 +200,7 @@ def caption_msg(update: Update, context: CallbackContext) -> int:
     return STATE['resize_mode']
 
 
+@timed("handler.background_msg")
 def background_msg(update: Update, context: CallbackContext) -> int:
     """Handles the background message
     Saves the photo so it can be used as the background of the image
@@ -213,13 +217,25 @@ def background_msg(update: Update, context: CallbackContext) -> int:
     photo = update.message.photo
     resize_mode = context.user_data['resize_mode']
 
-    if photo:  # if an actual photo was sent
-        bg_image = info['bot'].getFile(photo[-1].file_id)
-        bg_image.download(build_bg_path(info['sender_id']))
+    clear_user_images(info['sender_id'])  # the background has changed, so nothing prepared before can be reused
+
+    context.user_data['background_file_id'] = None
+    context.user_data['background_unique_id'] = None  # identifies the background in the render cache
+    context.user_data['background_scale'] = 1
+    if photo:  # if an actual photo was sent, download the smallest size that is enough for the template
+        photo_size, context.user_data['background_scale'] = choose_photo_size(
+            photo, get_template_size(context.user_data['template']), resize_mode)
+        # kept in the user_data, so that the background can be downloaded again if the bot restarts
+        context.user_data['background_file_id'] = photo_size.file_id
+        context.user_data['background_unique_id'] = photo_size.file_unique_id
+        with timer("download"):
+            download_background(info['bot'], info['sender_id'], photo_size.file_id)
 
     info['bot'].send_message(chat_id=info['chat_id'], text=text, parse_mode=ParseMode.MARKDOWN_V2)
 
-    generate_photo(info, context.user_data)
+    if not generate_photo(info, context.user_data):  # the bot is too busy, the user will have to send the background again
+        clear_user_images(info['sender_id'])  # no image was started, so nothing else would free the background
+        return STATE['background']
 
     if resize_mode == "crop":
         return STATE['crop']
@@ -229,6 +245,7 @@ def background_msg(update: Update, context: CallbackContext) -> int:
         return STATE['end']
 
 
+@timed("handler.fail_msg")
 def fail_msg(update: Update, context: CallbackContext) -> None:
     """Handles the fail message
     The message sent during the creation of the image was not valid
@@ -1,7 +1,15 @@
 """Read data from files"""
 import os
+import time
+from threading import Lock
 import yaml
 
+MARKDOWN_CHECK_INTERVAL = 5  # seconds between two checks for modified markdown files
+
+_markdown = {}  # file name -> (mtime, contents)
+_markdown_checked = 0.0
+_markdown_lock = Lock()
+
 
 def get_abs_path(*root_file_path: str) -> str:
     r"""Get the abs path from the root directory of the project to the requested path
@@ -31,7 +39,8 @@ def read_file(*root_file_path: str) -> str:
 
 
 def read_md(file_name: str) -> str:
-    """Read the contens of a markdown file. The path is data/markdown
+    """Read the contens of a markdown file. The path is data/markdown.
+    The contents are kept in memory, and the file is read again only if it has been modified
 
     Args:
         file_name (str): name of the file
@@ -39,7 +48,50 @@ def read_md(file_name: str) -> str:
     Returns:
         str: contents of the file
     """
-    return read_file("data", "markdown", file_name + ".md")
+    check_markdown()
+    entry = _markdown.get(file_name)
+    if entry is None:  # not a file found by the last check, so it is read directly (raising if it doesn't exist)
+        entry = (os.path.getmtime(get_abs_path("data", "markdown", file_name + ".md")),
+                 read_file("data", "markdown", file_name + ".md"))
+        _markdown[file_name] = entry
+    return entry[1]
+
+
+def check_markdown(force: bool = False):
+    """Reads again the markdown files in data/markdown modified since they were last read.
+    The check is made at most once every MARKDOWN_CHECK_INTERVAL seconds
+
+    Args:
+        force (bool, optional): whether to check immediately. Defaults to False.
+    """
+    global _markdown, _markdown_checked  # pylint: disable=global-statement
+    if not force and time.monotonic() - _markdown_checked < MARKDOWN_CHECK_INTERVAL:
+        return
+    with _markdown_lock:
+        if not force and time.monotonic() - _markdown_checked < MARKDOWN_CHECK_INTERVAL:
+            return  # another thread has just checked
+        markdown = {}
+        for entry in os.scandir(get_abs_path("data", "markdown")):
+            if not entry.name.endswith(".md"):
+                continue
+            file_name = entry.name[:-len(".md")]
+            mtime = entry.stat().st_mtime
+            cached = _markdown.get(file_name)
+            if cached is not None and cached[0] == mtime:
+                markdown[file_name] = cached
+            else:
+                markdown[file_name] = (mtime, read_file("data", "markdown", entry.name))
+        _markdown = markdown
+        _markdown_checked = time.monotonic()
+
+
+def reload_markdown():
+    """Reads all the markdown files in data/markdown again, even if they don't seem to be modified.
+    Called at startup and when an admin asks for it (SIGHUP)
+    """
+    with _markdown_lock:
+        _markdown.clear()
+    check_markdown(force=True)
 
 
 def update_settings_file():
@@ -49,5 +101,38 @@ def update_settings_file():
         yaml.dump(config_map, yaml_file)
 
 
-with open(get_abs_path("config", "settings.yaml"), 'r') as yaml_config:
-    config_map: dict = yaml.load(yaml_config, Loader=yaml.SafeLoader)
+def add_defaults(config: dict, defaults: dict) -> dict:
+    """Adds to the config the settings it is missing, taking them from the defaults.
+    The nested settings are added too, so that a settings.yaml written for an older version of the bot still works
+
+    Args:
+        config (dict): settings read from the file
+        defaults (dict): default settings
+
+    Returns:
+        dict: the config, with the missing settings added
+    """
+    for key, value in defaults.items():
+        if key not in config:
+            config[key] = value
+        elif isinstance(value, dict) and isinstance(config[key], dict):
+            add_defaults(config[key], value)
+    return config
+
+
+def load_config() -> dict:
+    """Reads config/settings.yaml, adding the settings it is missing from config/settings.yaml.dist
+
+    Returns:
+        dict: the settings
+    """
+    with open(get_abs_path("config", "settings.yaml"), 'r') as yaml_config:
+        config = yaml.load(yaml_config, Loader=yaml.SafeLoader) or {}
+    dist_path = get_abs_path("config", "settings.yaml.dist")
+    if os.path.exists(dist_path):
+        with open(dist_path, 'r') as yaml_defaults:
+            add_defaults(config, yaml.load(yaml_defaults, Loader=yaml.SafeLoader) or {})
+    return config
+
+
+config_map: dict = load_config()
@@ -0,0 +1,191 @@
+"""Keeps the conversations and the user_data between restarts"""
+import json
+import logging
+import sqlite3
+import time
+from collections import defaultdict
+from copy import deepcopy
+from queue import Empty, Queue
+from threading import Lock, Thread
+from telegram.ext import BasePersistence, PicklePersistence
+from modules.data.data_reader import config_map, get_abs_path
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()  # tells the writer thread to write what is left and stop
+
+
+class SQLitePersistence(BasePersistence):
+    """Persistence backed by a SQLite database.
+    Everything is kept in memory and read from the database only at startup.
+    The changes are written by a background thread, in a single transaction for each batch:
+    when batch_size of them are waiting or flush_interval seconds have passed.
+    Many changes of the same entry in a batch result in a single write
+
+    Args:
+        path (str): path of the database file
+        batch_size (int): how many changes are written at once
+        flush_interval (float): max seconds a change waits before being written
+    """
+
+    def __init__(self, path: str, batch_size: int, flush_interval: float):
+        super().__init__(store_user_data=True, store_chat_data=True, store_bot_data=True)
+        self.path = path
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self._user_data = defaultdict(dict)
+        self._chat_data = defaultdict(dict)
+        self._bot_data = {}
+        self._conversations = {}  # name -> {key: state}
+        self._written = {}  # (kind, key) -> last value queued, so unchanged data is not written again
+        self._lock = Lock()
+        self._load()
+        self._queue = None
+        self._thread = None
+        self._start()
+
+    def get_user_data(self) -> defaultdict:
+        return deepcopy(self._user_data)
+
+    def get_chat_data(self) -> defaultdict:
+        return deepcopy(self._chat_data)
+
+    def get_bot_data(self) -> dict:
+        return deepcopy(self._bot_data)
+
+    def get_conversations(self, name: str) -> dict:
+        return dict(self._conversations.get(name, {}))
+
+    def update_conversation(self, name: str, key: tuple, new_state: object):
+        if isinstance(new_state, tuple):  # the new state is still being computed (run_async): keep the old one
+            new_state = new_state[0]
+        conversations = self._conversations.setdefault(name, {})
+        if new_state is None:
+            conversations.pop(key, None)
+        else:
+            conversations[key] = new_state
+        self._write(f"conversation:{name}", json.dumps(key), new_state)
+
+    def update_user_data(self, user_id: int, data: dict):
+        self._user_data[user_id] = data
+        self._write("user_data", str(user_id), data)
+
+    def update_chat_data(self, chat_id: int, data: dict):
+        self._chat_data[chat_id] = data
+        self._write("chat_data", str(chat_id), data)
+
+    def update_bot_data(self, data: dict):
+        self._bot_data = data
+        self._write("bot_data", "", data)
+
+    def flush(self):
+        """Writes the changes still waiting and stops the writer thread.
+        If more changes arrive later, the writer thread is started again
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._queue.put(_STOP)
+        if thread is not None:
+            thread.join()
+
+    def _start(self):
+        """Starts a writer thread, with its own queue. The lock must be held, or the persistence must be initializing
+        """
+        self._queue = Queue()
+        self._thread = Thread(target=self._run, args=(self._queue,), name="persistence", daemon=True)
+        self._thread.start()
+
+    def _write(self, kind: str, key: str, value: object):
+        """Queues the change, if the value is different from the last one queued for the same entry.
+        The value is serialized immediately, since the handlers may keep changing it
+        """
+        try:
+            value = json.dumps(value) if value is not None else None
+        except TypeError as e:
+            logger.error("Could not persist %s %s: %s", kind, key, e)
+            return
+        with self._lock:
+            if (kind, key) in self._written and self._written[(kind, key)] == value:
+                return
+            self._written[(kind, key)] = value
+            if self._thread is None:  # a change arrived after the flush
+                self._start()
+            self._queue.put((kind, key, value))
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS persistence "
+                           "(kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (kind, key))")
+        return connection
+
+    def _load(self):
+        connection = self._connect()
+        try:
+            for kind, key, value in connection.execute("SELECT kind, key, value FROM persistence"):
+                self._written[(kind, key)] = value
+                value = json.loads(value)
+                if kind == "user_data":
+                    self._user_data[int(key)] = value
+                elif kind == "chat_data":
+                    self._chat_data[int(key)] = value
+                elif kind == "bot_data":
+                    self._bot_data = value
+                elif kind.startswith("conversation:"):
+                    self._conversations.setdefault(kind[len("conversation:"):], {})[tuple(json.loads(key))] = value
+        finally:
+            connection.close()
+
+    def _run(self, queue: Queue):
+        connection = self._connect()  # sqlite connections can only be used by the thread that created them
+        batch = {}
+        deadline = None
+        while True:
+            try:
+                item = queue.get(timeout=max(0, deadline - time.monotonic()) if batch else None)
+            except Empty:
+                item = None
+            if item is not None and item is not _STOP:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                kind, key, value = item
+                batch[(kind, key)] = value  # only the last change of each entry is written
+            if batch and (item is None or item is _STOP or len(batch) >= self.batch_size
+                          or time.monotonic() >= deadline):
+                self._commit(connection, batch)
+                batch = {}
+            if item is _STOP:
+                connection.close()
+                return
+
+    @staticmethod
+    def _commit(connection: sqlite3.Connection, batch: dict):
+        try:
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO persistence (kind, key, value) VALUES (?, ?, ?)",
+                                       [(kind, key, value) for (kind, key), value in batch.items() if value is not None])
+                connection.executemany("DELETE FROM persistence WHERE kind = ? AND key = ?",
+                                       [(kind, key) for (kind, key), value in batch.items() if value is None])
+        except sqlite3.Error as e:
+            logger.error("Could not write %d changes: %s", len(batch), e)
+
+
+def get_persistence() -> BasePersistence:
+    """Creates the persistence chosen in the persistence settings
+
+    Returns:
+        BasePersistence: the persistence. None if the backend is "none"
+    """
+    settings = config_map['persistence']
+    backend = settings['backend']
+    if backend == "sqlite":
+        return SQLitePersistence(path=get_abs_path("data", "persistence.sqlite3"),
+                                 batch_size=settings['batch_size'],
+                                 flush_interval=settings['flush_interval'])
+    if backend == "pickle":  # written only when the bot stops
+        return PicklePersistence(filename=get_abs_path("data", "persistence.pickle"), on_flush=True)
+    if backend != "none":
+        raise ValueError(f"Unknown persistence backend: {backend}")
+    return None
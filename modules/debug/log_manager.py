@@ -1,14 +1,180 @@
 """Handles the logging of events"""
+import atexit
+import json
 import logging
-from modules.data.data_reader import get_abs_path
+import os
+import time
+from queue import Empty, Queue
+from threading import Lock, Thread
+from modules.data.data_reader import config_map, get_abs_path
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 logger.info("Logger enabled")
 
+_STOP = object()  # tells the writer thread to flush what is left and stop
+
+
+def format_text(record: dict) -> str:
+    """Formats the record in the human readable format
+
+    Args:
+        record (dict): record created by log_message
+
+    Returns:
+        str: formatted record
+    """
+    return f"\n\n___ID MESSAGE:  {record['message_id']} ____\n"\
+        "___INFO USER___\n"\
+        f"user_id:  {record['user_id']}\n"\
+        f"user_name:  {record['user_name']}\n"\
+        f"user_first_lastname: {record['first_name']} {record['last_name']}\n"\
+        "___INFO CHAT___\n"\
+        f"chat_id:  {record['chat_id']}\n"\
+        f"chat_type:  {record['chat_type']}\n"\
+        f"chat_title:  {record['chat_title']}\n"\
+        "___TESTO___\n"\
+        f"text:  {record['text']}\n"\
+        f"date:  {record['date']}"\
+        "\n_____________\n"
+
+
+def format_json(record: dict) -> str:
+    """Formats the record as a single json line
+
+    Args:
+        record (dict): record created by log_message
+
+    Returns:
+        str: formatted record
+    """
+    return json.dumps(record, ensure_ascii=False, default=str) + "\n"
+
+
+class MessageLogWriter:
+    """Writes the records on a background thread, so the dispatcher never waits for the disk.
+    The records are written in batches, when batch_size of them are waiting or flush_interval seconds have passed.
+    When the file would grow past max_bytes, it is renamed to file.1 (file.1 to file.2 and so on) and a new one is started
+
+    Args:
+        path (str): path of the log file
+        log_format (str): "text" or "json"
+        batch_size (int): how many records are written at once
+        flush_interval (float): max seconds a record waits before being written
+        max_bytes (int): size of the file that triggers the rotation. If <= 0, the file is never rotated
+        backup_count (int): how many rotated files are kept
+    """
+
+    def __init__(self, path: str, log_format: str, batch_size: int, flush_interval: float, max_bytes: int,
+                 backup_count: int):
+        self.path = path
+        self.format = format_json if log_format == "json" else format_text
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._queue = Queue()
+        self._file = None
+        self._thread = Thread(target=self._run, name="message_log", daemon=True)
+        self._thread.start()
+
+    def write(self, record: dict):
+        """Queues the record, without waiting for it to be written
+
+        Args:
+            record (dict): record to write
+        """
+        self._queue.put(record)
+
+    def close(self):
+        """Writes the records still in the queue and stops the writer thread
+        """
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0, deadline - time.monotonic()) if batch else None)
+            except Empty:
+                item = None
+            if item is not None and item is not _STOP:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+            if batch and (item is None or item is _STOP or len(batch) >= self.batch_size
+                          or time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+            if item is _STOP:
+                if self._file is not None:
+                    self._file.close()
+                return
+
+    def _flush(self, batch: list):
+        data = "".join(self.format(record) for record in batch)
+        try:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf8")
+            if 0 < self.max_bytes < self._file.tell() + len(data.encode("utf8")) and self._file.tell() > 0:
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+        except OSError as e:
+            logger.error(e)
+            if self._file is not None:
+                self._file.close()
+            self._file = None  # try to open it again with the next batch
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        self._file = open(self.path, "w", encoding="utf8")
+
+
+_writer = None
+_writer_lock = Lock()
+
+
+def get_message_log() -> MessageLogWriter:
+    """Gets the writer of logs/messages.log, starting it with the debug settings the first time it is needed
+
+    Returns:
+        MessageLogWriter: the writer
+    """
+    global _writer  # pylint: disable=global-statement
+    with _writer_lock:
+        if _writer is None:
+            settings = config_map['debug']
+            _writer = MessageLogWriter(path=get_abs_path("logs", "messages.log"),
+                                       log_format=settings['log_format'],
+                                       batch_size=settings['log_batch_size'],
+                                       flush_interval=settings['log_flush_interval'],
+                                       max_bytes=settings['log_max_bytes'],
+                                       backup_count=settings['log_backup_count'])
+            atexit.register(close_message_log)
+        return _writer
+
+
+def close_message_log():
+    """Writes the records still waiting and stops the writer, if it was started
+    """
+    global _writer  # pylint: disable=global-statement
+    with _writer_lock:
+        if _writer is not None:
+            _writer.close()
+            _writer = None
+
 
 def log_message(update, context):
-    """Log the message that caused the update
+    """Log the message that caused the update.
+    Only the data is collected here, it is formatted and written by the writer thread
 
     Args:
         update (Update): update event
@@ -16,25 +182,21 @@ def log_message(update, context):
     """
     if update.message:
         try:
-            with open(get_abs_path("logs", "messages.log"), "a", encoding="utf8") as log_file:
-
-                user = update.message.from_user
-                chat = update.message.chat
-                message = f"\n___ID MESSAGE:  {str(update.message.message_id)} ____\n"\
-                        "___INFO USER___\n"\
-                        f"user_id:  {str(user.id)}\n"\
-                        f"user_name:  {str(user.username)}\n"\
-                        f"user_first_lastname: {str(user.first_name)} {str(user.last_name)}\n"\
-                        "___INFO CHAT___\n"\
-                        f"chat_id:  {str(chat.id)}\n"\
-                        f"chat_type:  {str(chat.type)}\n"\
-                        f"chat_title:  {str(chat.title)}\n"\
-                        "___TESTO___\n"\
-                        f"text:  {str(update.message.text)}\n"\
-                        f"date:  {str(update.message.date)}"\
-                        "\n_____________\n"
-                log_file.write("\n" + message)
+            user = update.message.from_user
+            chat = update.message.chat
+            record = {
+                'message_id': update.message.message_id,
+                'user_id': user.id,
+                'user_name': user.username,
+                'first_name': user.first_name,
+                'last_name': user.last_name,
+                'chat_id': chat.id,
+                'chat_type': chat.type,
+                'chat_title': chat.title,
+                'text': update.message.text,
+                'date': update.message.date,
+            }
         except AttributeError as e:
             logger.warning(e)
-        except FileNotFoundError as e:
-            logger.error(e)
+            return
+        get_message_log().write(record)
@@ -0,0 +1,269 @@
+"""Measures how long each stage of the bot takes, collecting the timings in histograms.
+The histograms, and a few gauges, are exposed in the Prometheus text format and, optionally, logged as structured lines"""
+import logging
+import random
+import time
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Callable
+import tornado.web
+from modules.data.data_reader import config_map
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # upper bounds of the buckets, in seconds
+
+METRIC_NAME = "newsgen_stage_duration_seconds"
+
+
+class Histogram:
+    """Thread safe histogram of durations, with the same buckets Prometheus uses by default
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # the last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = Lock()
+
+    def observe(self, seconds: float):
+        """Adds a duration to the histogram
+
+        Args:
+            seconds (float): duration measured
+        """
+        index = next((i for i, bound in enumerate(BUCKETS) if seconds <= bound), len(BUCKETS))
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def merge(self, state: tuple):
+        """Adds the durations collected by another histogram
+
+        Args:
+            state (tuple): (counts, sum, count) of the other histogram
+        """
+        counts, total, count = state
+        with self._lock:
+            self.counts = [a + b for a, b in zip(self.counts, counts)]
+            self.sum += total
+            self.count += count
+
+    def state(self) -> tuple:
+        """Gets a copy of the values of the histogram
+
+        Returns:
+            tuple: (counts, sum, count)
+        """
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+_histograms = {}
+_histograms_lock = Lock()
+
+
+def get_histogram(stage: str) -> Histogram:
+    """Gets the histogram of the stage, creating it the first time
+
+    Args:
+        stage (str): name of the stage
+
+    Returns:
+        Histogram: histogram of the stage
+    """
+    histogram = _histograms.get(stage)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(stage, Histogram())
+    return histogram
+
+
+def observe(stage: str, seconds: float):
+    """Records the duration of the stage
+
+    Args:
+        stage (str): name of the stage
+        seconds (float): duration measured
+    """
+    get_histogram(stage).observe(seconds)
+    if config_map['metrics']['log']:
+        logger.info("stage=%s duration_ms=%.3f", stage, seconds * 1000)
+
+
+def is_sampled() -> bool:
+    """Whether the next measurement should be taken, based on the metrics settings
+
+    Returns:
+        bool: True if the measurement should be taken
+    """
+    settings = config_map['metrics']
+    return settings['enabled'] and (settings['sample_rate'] >= 1 or random.random() < settings['sample_rate'])
+
+
+@contextmanager
+def timer(stage: str):
+    """Measures the duration of the block, if it is sampled
+
+    Args:
+        stage (str): name of the stage
+    """
+    if not is_sampled():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def timed(stage: str) -> Callable:
+    """Decorator that measures the duration of each call of the function, if it is sampled
+
+    Args:
+        stage (str): name of the stage
+
+    Returns:
+        Callable: decorator
+    """
+    def decorator(fn: Callable) -> Callable:
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+_gauges = {}  # name -> (description, function that returns the current value)
+
+
+def register_gauge(name: str, description: str, value: Callable[[], float]):
+    """Exposes a value read when the metrics are rendered, like the size of a queue
+
+    Args:
+        name (str): name of the metric
+        description (str): description shown in the help line
+        value (Callable[[], float]): returns the current value
+    """
+    _gauges[name] = (description, value)
+
+
+def collect(fn: Callable, *args) -> tuple:
+    """Calls the function, then takes the durations measured in this process in the meantime.
+    Used by the worker processes, so that their measurements reach the main process.
+    What the process had before the call (like the histograms copied from the main process) is discarded
+
+    Args:
+        fn (Callable): function to call
+        args (Any): arguments passed to the function
+
+    Returns:
+        tuple: (result of the function, states of the histograms measured)
+    """
+    with _histograms_lock:
+        _histograms.clear()
+    result = fn(*args)
+    with _histograms_lock:
+        states = {stage: histogram.state() for stage, histogram in _histograms.items()}
+        _histograms.clear()
+    return result, states
+
+
+def merge(states: dict):
+    """Adds the durations collected by another process
+
+    Args:
+        states (dict): stage -> (counts, sum, count), as returned by collect
+    """
+    for stage, state in states.items():
+        get_histogram(stage).merge(state)
+
+
+def render_metrics() -> str:
+    """Renders all the histograms in the Prometheus text format
+
+    Returns:
+        str: text to expose
+    """
+    lines = [
+        f"# HELP {METRIC_NAME} Time spent in each stage of the bot, in seconds.",
+        f"# TYPE {METRIC_NAME} histogram",
+    ]
+    with _histograms_lock:
+        histograms = sorted(_histograms.items())
+    for stage, histogram in histograms:
+        counts, total, count = histogram.state()
+        cumulative = 0
+        for bound, bucket_count in zip(BUCKETS + ("+Inf",), counts):
+            cumulative += bucket_count
+            lines.append(f'{METRIC_NAME}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'{METRIC_NAME}_sum{{stage="{stage}"}} {total}')
+        lines.append(f'{METRIC_NAME}_count{{stage="{stage}"}} {count}')
+    for name, (description, value) in sorted(_gauges.items()):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value()}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Serves the metrics on the webhook server"""
+
+    def get(self):  # pylint: disable=arguments-differ
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(render_metrics())
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Serves the metrics when the bot is polling, and so there is no webhook server"""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.path.strip("/") != config_map['metrics']['path'].strip("/"):
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass  # the scrapes would flood the log
+
+
+def add_metrics_endpoint(updater, timeout: float = 5):
+    """Exposes the metrics on the port used by the webhook of the updater.
+    The webhook server is started by another thread, so it waits for it to be ready
+
+    Args:
+        updater (Updater): updater that has just started the webhook
+        timeout (float, optional): seconds to wait for the webhook server. Defaults to 5.
+    """
+    deadline = time.perf_counter() + timeout
+    while updater.httpd is None and time.perf_counter() < deadline:
+        time.sleep(0.05)
+    if updater.httpd is None:
+        logger.error("The webhook server did not start, the metrics won't be exposed")
+        return
+    path = "/" + config_map['metrics']['path'].strip("/")
+    updater.httpd.http_server.request_callback.add_handlers(r".*", [(path, MetricsHandler)])
+
+
+def start_metrics_server() -> ThreadingHTTPServer:
+    """Exposes the metrics on the port in the metrics settings, for when the bot is polling
+
+    Returns:
+        ThreadingHTTPServer: server started
+    """
+    server = ThreadingHTTPServer(("0.0.0.0", config_map['metrics']['port']), MetricsRequestHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,60 @@
+"""Connections to the Bot API, kept alive and shared by all the threads of the bot"""
+import time
+from telegram.utils.request import Request
+from telegram.vendor.ptb_urllib3.urllib3 import PoolManager
+from modules.debug.metrics import is_sampled, observe
+
+
+def _timed_pool(pool_cls: type) -> type:
+    """Extends the connection pool class so that it measures how long each request waits for a connection
+
+    Args:
+        pool_cls (type): class of the connection pool
+
+    Returns:
+        type: the extended class
+    """
+
+    class TimedPool(pool_cls):
+
+        def _get_conn(self, timeout=None):
+            if not is_sampled():
+                return super()._get_conn(timeout=timeout)
+            start = time.perf_counter()
+            try:
+                return super()._get_conn(timeout=timeout)
+            finally:
+                observe("api.connection_wait", time.perf_counter() - start)
+
+    TimedPool.__name__ = f"Timed{pool_cls.__name__}"
+    return TimedPool
+
+
+class PooledRequest(Request):
+    """Request that keeps con_pool_size keep-alive connections for each host, shared by all the threads.
+    When all of them are busy, the next request waits for one to be free, up to connect_timeout seconds,
+    instead of opening a new connection that would be discarded right after (the default of urllib3).
+    The time spent waiting is measured as the "api.connection_wait" stage
+
+    Args:
+        con_pool_size (int): number of connections kept for each host
+        proxy_url (str, optional): url of the proxy the requests go through. Defaults to None.
+        connect_timeout (float, optional): max seconds to wait for a connection. Defaults to 5.
+        read_timeout (float, optional): max seconds to wait for the response. Defaults to 5.
+    """
+
+    def __init__(self, con_pool_size: int, proxy_url: str = None, connect_timeout: float = 5., read_timeout: float = 5.):
+        super().__init__(con_pool_size=con_pool_size,
+                         proxy_url=proxy_url,
+                         connect_timeout=connect_timeout,
+                         read_timeout=read_timeout)
+        if isinstance(self._con_pool, PoolManager):  # also true for the proxies
+            self._con_pool.connection_pool_kw['block'] = True
+            self._con_pool.pool_classes_by_scheme = {
+                scheme: _timed_pool(pool_cls)
+                for scheme, pool_cls in self._con_pool.pool_classes_by_scheme.items()
+            }
+
+    def _request_wrapper(self, *args, **kwargs):
+        kwargs.setdefault('pool_timeout', self._connect_timeout)
+        return super()._request_wrapper(*args, **kwargs)
@@ -0,0 +1,129 @@
+"""Keeps the decoded templates and default backgrounds in memory, so they are read from the disk only once"""
+import glob
+import os
+from PIL import Image
+from modules.data.data_reader import config_map
+from modules.various.lru_cache import LRUCache
+
+_assets = LRUCache(config_map['image']['asset_cache_size'])
+
+
+def build_template_path(template: str) -> str:
+    """Builds the path of the template image
+
+    Args:
+        template (str): name of the template
+
+    Returns:
+        str: path where to find the template
+    """
+    return f"data/img/template_{template}.png"
+
+
+def build_default_bg_path(template: str) -> str:
+    """Builds the path of the default background associated with the template
+
+    Args:
+        template (str): name of the template. The "_vuoto" suffix is ignored
+
+    Returns:
+        str: path where to find the default background
+    """
+    return f"data/img/bg_{template.replace('_vuoto', '')}.png"  # remove "_vuoto" the template path
+
+
+def load_rgba(path: str) -> Image.Image:
+    """Opens and fully decodes the image, converting it in the RGBA mode
+
+    Args:
+        path (str): path of the image
+
+    Returns:
+        Image: decoded image
+    """
+    with Image.open(path) as im:
+        return im.convert("RGBA")
+
+
+def get_template(template: str, scale: float = 1) -> Image.Image:
+    """Gets a copy of the decoded template image
+
+    Args:
+        template (str): name of the template
+        scale (float, optional): scale of the template, used for the previews. Defaults to 1.
+
+    Returns:
+        Image: RGBA template image
+    """
+    path = build_template_path(template)
+    if scale == 1:
+        return _assets.get(path, lambda: load_rgba(path)).copy()
+
+    def load_scaled() -> Image.Image:
+        im = get_template(template)
+        w, h = im.size
+        return im.resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.LANCZOS)
+
+    return _assets.get((path, scale), load_scaled).copy()
+
+
+def get_template_size(template: str) -> tuple:
+    """Gets the size of the template image, without copying it
+
+    Args:
+        template (str): name of the template
+
+    Returns:
+        tuple: (width, height) of the template
+    """
+    path = build_template_path(template)
+    return _assets.get(path, lambda: load_rgba(path)).size
+
+
+def get_default_background(template: str) -> Image.Image:
+    """Gets a copy of the decoded default background associated with the template
+
+    Args:
+        template (str): name of the template
+
+    Returns:
+        Image: RGBA background image
+    """
+    path = build_default_bg_path(template)
+    return _assets.get(path, lambda: load_rgba(path)).copy()
+
+
+def get_asset_version(template: str) -> list:
+    """Gets what identifies the current version of the template image and of its default background on the disk,
+    so that an image made with an older version can be told apart
+
+    Args:
+        template (str): name of the template
+
+    Returns:
+        list: [modification time in ns, size in bytes] of each of the two images, None if the image doesn't exist
+    """
+    version = []
+    for path in (build_template_path(template), build_default_bg_path(template)):
+        try:
+            stat = os.stat(path)
+            version.append([stat.st_mtime_ns, stat.st_size])
+        except OSError:
+            version.append(None)
+    return version
+
+
+def preload_assets():
+    """Decodes all the templates and the default backgrounds found in data/img, so the first renders don't have to
+    """
+    for path in sorted(glob.glob("data/img/template_*.png")):
+        template = os.path.basename(path)[len("template_"):-len(".png")]
+        get_template(template)
+        if os.path.exists(build_default_bg_path(template)):
+            get_default_background(template)
+
+
+def invalidate_assets():
+    """Discards all the cached images. They will be read from the disk again the next time they are needed
+    """
+    _assets.clear()
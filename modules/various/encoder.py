@@ -0,0 +1,57 @@
+"""Encodes the final images with the format and quality chosen in the settings"""
+import logging
+from typing import BinaryIO, Union
+from PIL import Image, features
+from modules.data.data_reader import config_map
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("PNG", "JPEG", "WEBP")
+
+
+def get_encoder_options(fmt: str, settings: dict) -> dict:
+    """Gets the options passed to Image.save for the format
+
+    Args:
+        fmt (str): format of the image. One of FORMATS
+        settings (dict): encoder settings, like {'quality': 85, 'optimize': False, 'progressive': True}
+
+    Returns:
+        dict: keyword arguments for Image.save
+    """
+    if fmt == "JPEG":
+        return {
+            'quality': settings['quality'],
+            'optimize': settings['optimize'],
+            'progressive': settings['progressive'],
+        }
+    if fmt == "WEBP":
+        return {'quality': settings['quality'], 'method': 6 if settings['optimize'] else 0}
+    return {'optimize': settings['optimize'], 'compress_level': settings['compress_level']}
+
+
+def encode_image(im: Image.Image, out: Union[str, BinaryIO], purpose: str = "final") -> str:
+    """Saves the image with the encoder settings associated with the purpose
+
+    Args:
+        im (Image): image to save
+        out (Union[str, BinaryIO]): path or buffer where the image will be saved
+        purpose (str, optional): "preview" for the images the user is still adjusting, "final" for the finished ones.
+            Defaults to "final".
+
+    Returns:
+        str: format the image was saved with
+    """
+    settings = config_map['encoder'][purpose]
+    fmt = settings['format'].upper()
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported image format: {settings['format']}")
+    if fmt == "WEBP" and not features.check("webp"):
+        logger.warning("WEBP is not supported by this Pillow installation, PNG will be used instead")
+        fmt = "PNG"
+
+    if fmt == "JPEG" and im.mode != "RGB":  # JPEG has no alpha channel
+        im = im.convert("RGB")
+
+    im.save(out, format=fmt, **get_encoder_options(fmt, settings))
+    return fmt
@@ -0,0 +1,47 @@
+"""Keeps the parsed fonts in memory, so each font file is read once and parsed once per size"""
+from io import BytesIO
+from PIL import ImageFont
+from modules.data.data_reader import config_map
+from modules.various.lru_cache import LRUCache
+
+FONT_PATH = "data/font/UbuntuCondensed-Regular.ttf"
+
+_font_files = LRUCache(0)  # contents of the font files. There are very few of them, so they are never evicted
+_fonts = LRUCache(config_map['image']['font_cache_size'])
+
+
+def read_font_file(font_path: str) -> bytes:
+    """Reads the contents of the font file
+
+    Args:
+        font_path (str): path of the font file
+
+    Returns:
+        bytes: contents of the file
+    """
+    with open(font_path, "rb") as font_file:
+        return font_file.read()
+
+
+def get_font(size: int, font_path: str = FONT_PATH) -> ImageFont.FreeTypeFont:
+    """Gets the font with the requested size. The instances are shared between threads
+
+    Args:
+        size (int): size of the font
+        font_path (str, optional): path of the font file. Defaults to FONT_PATH.
+
+    Returns:
+        FreeTypeFont: font of the requested size
+    """
+    def load_font() -> ImageFont.FreeTypeFont:
+        data = _font_files.get(font_path, lambda: read_font_file(font_path))
+        return ImageFont.truetype(font=BytesIO(data), size=size)
+
+    return _fonts.get((font_path, size), load_font)
+
+
+def clear_fonts():
+    """Discards all the cached fonts
+    """
+    _fonts.clear()
+    _font_files.clear()
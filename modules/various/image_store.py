@@ -0,0 +1,45 @@
+"""Keeps the backgrounds sent by the users in memory, instead of saving them in data/img"""
+from modules.data.data_reader import config_map
+from modules.various.lru_cache import LRUCache
+
+# unbounded: a background is needed until the image is finished, and it is discarded then (see discard_images),
+# or as soon as the image is refused (see background_msg).
+# The images in progress are limited by the max_jobs render setting, and the size of each by the spill_size setting
+_backgrounds = LRUCache(0)
+
+
+def save_background(sender_id: int, data: bytes, spill_path: str):
+    """Keeps the background sent by the user in memory.
+    If it is larger than the spill_size setting, it is saved on the disk instead
+
+    Args:
+        sender_id (int): id of the user
+        data (bytes): contents of the background
+        spill_path (str): path where the background is saved if it is too large to be kept in memory
+    """
+    if len(data) > config_map['image']['spill_size']:
+        with open(spill_path, "wb") as bg_file:
+            bg_file.write(data)
+    else:
+        _backgrounds.put(sender_id, data)
+
+
+def load_background(sender_id: int) -> bytes:
+    """Gets the background of the user kept in memory
+
+    Args:
+        sender_id (int): id of the user
+
+    Returns:
+        bytes: contents of the background. None if it is not in memory
+    """
+    return _backgrounds.peek(sender_id)
+
+
+def discard_images(sender_id: int):
+    """Frees the memory used by the background of the user
+
+    Args:
+        sender_id (int): id of the user
+    """
+    _backgrounds.pop(sender_id)
@@ -0,0 +1,182 @@
+"""Keeps track of the images in progress, so that each user has at most one and a render at a time"""
+import time
+from threading import Lock
+from typing import Callable
+
+
+class JobLimitError(Exception):
+    """Raised when a new image can't be started because too many are already in progress"""
+
+
+class Job:
+    """Image in progress of a user, from its first render until it is delivered or cancelled
+
+    Args:
+        sender_id (int): id of the user
+    """
+
+    def __init__(self, sender_id: int):
+        self.sender_id = sender_id
+        self.started = time.monotonic()
+        self.last_activity = self.started
+        self.render_started = None  # when the render in flight has started, None if there is none
+        self.pending = None  # request that arrived while rendering, to be rendered once the render in flight is done
+        self.pending_final = False  # whether the pending request is for the final image
+
+
+class JobRegistry:
+    """In-memory registry of the images in progress.
+    Each user can have only one image in progress, with at most one render in flight at a time.
+    An image with no activity for job_timeout seconds expires, and a render that takes longer than render_timeout
+    seconds is considered lost, so that a failed render can't lock a user out
+
+    Args:
+        max_jobs (int): how many images can be in progress at the same time. If <= 0, there is no limit
+        job_timeout (float): seconds of inactivity after which an image expires
+        render_timeout (float): seconds after which a render in flight is considered lost
+        on_expire (Callable[[int], None], optional): called with the id of the user when an image expires,
+            to free what it used. Defaults to None.
+    """
+
+    def __init__(self, max_jobs: int, job_timeout: float, render_timeout: float, on_expire: Callable[[int], None] = None):
+        self.max_jobs = max_jobs
+        self.job_timeout = job_timeout
+        self.render_timeout = render_timeout
+        self.on_expire = on_expire
+        self._jobs = {}  # sender_id -> Job
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def has_job(self, sender_id: int) -> bool:
+        """Whether the user has an image in progress
+
+        Args:
+            sender_id (int): id of the user
+
+        Returns:
+            bool: True if there is an image in progress that hasn't expired
+        """
+        self.expire()
+        return sender_id in self._jobs
+
+    def begin_render(self, sender_id: int) -> bool:
+        """Registers a new render for the user, starting the image if it is the first one
+
+        Args:
+            sender_id (int): id of the user
+
+        Raises:
+            JobLimitError: the image would be new, but too many are already in progress
+
+        Returns:
+            bool: False if the user already has a render in flight, so this one should be skipped
+        """
+        self.expire()
+        now = time.monotonic()
+        with self._lock:
+            job = self._jobs.get(sender_id)
+            if job is None:
+                if 0 < self.max_jobs <= len(self._jobs):
+                    raise JobLimitError(f"{len(self._jobs)} images are already in progress")
+                job = self._jobs[sender_id] = Job(sender_id)
+            elif job.render_started is not None and now - job.render_started < self.render_timeout:
+                return False
+            job.render_started = now
+            job.last_activity = now
+            return True
+
+    def resume(self, sender_id: int):
+        """Registers an image that was already in progress before the bot restarted, with no render in flight
+
+        Args:
+            sender_id (int): id of the user
+        """
+        with self._lock:
+            if sender_id not in self._jobs:
+                self._jobs[sender_id] = Job(sender_id)
+
+    def defer(self, sender_id: int, request: Callable[[], None], final: bool = False) -> bool:
+        """Keeps the request until the render in flight of the user is done, replacing any request kept before.
+        This way, many requests made while rendering result in a single render.
+        A request for the final image is never replaced by one for a preview
+
+        Args:
+            sender_id (int): id of the user
+            request (Callable[[], None]): starts the render requested
+            final (bool, optional): whether the request is for the final image. Defaults to False.
+
+        Returns:
+            bool: False if there is no render in flight, so the request should be made immediately
+        """
+        with self._lock:
+            job = self._jobs.get(sender_id)
+            if job is None or job.render_started is None:
+                return False
+            if final or not job.pending_final:
+                job.pending = request
+                job.pending_final = final
+            job.last_activity = time.monotonic()
+            return True
+
+    def has_pending(self, sender_id: int) -> bool:
+        """Whether a request has been deferred while the render in flight of the user was running,
+        which makes the image being rendered outdated
+
+        Args:
+            sender_id (int): id of the user
+
+        Returns:
+            bool: True if there is a deferred request
+        """
+        with self._lock:
+            job = self._jobs.get(sender_id)
+            return job is not None and job.pending is not None
+
+    def end_render(self, sender_id: int) -> Callable[[], None]:
+        """Marks the render in flight of the user as done, whether it succeeded or not
+
+        Args:
+            sender_id (int): id of the user
+
+        Returns:
+            Callable[[], None]: the request deferred while rendering, if any. It supersedes the render just done
+        """
+        with self._lock:
+            job = self._jobs.get(sender_id)
+            if job is None:
+                return None
+            pending, job.pending, job.pending_final = job.pending, None, False
+            job.render_started = None
+            job.last_activity = time.monotonic()
+            return pending
+
+    def finish(self, sender_id: int):
+        """Removes the image of the user, because it was delivered or cancelled
+
+        Args:
+            sender_id (int): id of the user
+        """
+        with self._lock:
+            self._jobs.pop(sender_id, None)
+
+    def expire(self) -> list:
+        """Removes the images with no activity for job_timeout seconds, calling on_expire for each of them
+
+        Returns:
+            list: ids of the users whose image has expired
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                sender_id for sender_id, job in self._jobs.items()
+                if now - job.last_activity >= self.job_timeout and
+                (job.render_started is None or now - job.render_started >= self.render_timeout)
+            ]
+            for sender_id in expired:
+                del self._jobs[sender_id]
+        if self.on_expire is not None:
+            for sender_id in expired:
+                self.on_expire(sender_id)
+        return expired
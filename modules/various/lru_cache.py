@@ -0,0 +1,112 @@
+"""Thread-safe bounded cache used to keep expensive objects in memory"""
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Hashable
+
+
+class LRUCache:
+    """Dictionary-like cache that discards the least recently used entry once it grows over max_size.
+    All the operations are protected by a lock, so the same cache can be shared between threads
+
+    Args:
+        max_size (int): maximum number of entries kept in memory. If <= 0, the cache is unbounded
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """Gets the value associated with the key. If it is not present, it is created with the loader and stored
+
+        Args:
+            key (Hashable): key of the entry
+            loader (Callable[[], Any]): function called to create the value on a cache miss
+
+        Returns:
+            Any: value associated with the key
+        """
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                return self._data[key]
+
+        value = loader()  # the loader may be slow, so it runs outside of the lock
+
+        with self._lock:
+            if key not in self._data:
+                self._data[key] = value
+                self._evict()
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Gets the value associated with the key, without creating it if it is not present
+
+        Args:
+            key (Hashable): key of the entry
+            default (Any, optional): value returned if the key is not present. Defaults to None.
+
+        Returns:
+            Any: value associated with the key
+        """
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key: Hashable, value: Any):
+        """Stores the value with the provided key, replacing the old one, if present
+
+        Args:
+            key (Hashable): key of the entry
+            value (Any): value to store
+        """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self._evict()
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Removes the entry associated with the key
+
+        Args:
+            key (Hashable): key of the entry
+            default (Any, optional): value returned if the key is not present. Defaults to None.
+
+        Returns:
+            Any: value that was associated with the key
+        """
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def items(self) -> list:
+        """Gets a copy of the entries, from the least to the most recently used
+
+        Returns:
+            list: (key, value) pairs
+        """
+        with self._lock:
+            return list(self._data.items())
+
+    def clear(self):
+        """Removes all the entries from the cache
+        """
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    def _evict(self):
+        """Discards the least recently used entries until the size is within the limit. The lock must be held
+        """
+        while 0 < self.max_size < len(self._data):
+            self._data.popitem(last=False)
@@ -1,10 +1,47 @@
 """Generates the image based on the user's settings"""
+import logging
 import os
 import random
-from threading import Thread
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
-from modules.data.data_reader import config_map
+import re
+from concurrent.futures import Future
+from copy import deepcopy
+from io import BytesIO
+from typing import BinaryIO, Union
+from PIL import Image, ImageDraw, ImageFilter
+from telegram import Bot, ParseMode, InputMediaPhoto, Message
+from telegram.error import TelegramError
+from modules.data.data_reader import config_map, read_md
+from modules.debug.metrics import timer, timed
 from modules.various.utils import get_keyboard_crop, get_keyboard_random
+from modules.various.asset_cache import get_template, get_template_size, get_default_background
+from modules.various.font_registry import get_font
+from modules.various.text_layout import layout_text
+from modules.various.render_session import RenderSession, get_session, clear_session
+from modules.various.render_engine import RenderBusyError, get_engine, engine_started
+from modules.various.image_store import load_background, save_background, discard_images
+from modules.various.job_registry import JobLimitError, JobRegistry
+from modules.various.render_cache import get_render_cache, render_key
+from modules.various.encoder import encode_image
+from modules.various.rate_limiter import PRIORITY_FINAL, PRIORITY_PREVIEW
+
+logger = logging.getLogger(__name__)
+
+USER_IMAGE_PATTERN = re.compile(r"^(bg_)?(\d+)\.png$")  # files of build_bg_path and build_photo_path
+
+BLUR_PIXELS_PER_RADIUS = 3  # in the "fast" blur_mode, how many pixels are kept for each unit of the blur radius
+
+PHOTO_SIZE_TOLERANCE = 0.98  # telegram rounds the sizes of the photos, so a size can be a few pixels short
+
+_kept_backgrounds = set()  # users whose worker process already has the background prepared in its render session
+
+_jobs = JobRegistry(max_jobs=config_map['render']['max_jobs'],
+                    job_timeout=config_map['render']['job_timeout'],
+                    render_timeout=config_map['render']['render_timeout'],
+                    on_expire=lambda sender_id: clear_user_images(sender_id))  # images in progress
+
+
+class BackgroundMissingError(Exception):
+    """Raised by a worker process asked to reuse the background it prepared, when its render session no longer has it"""
 
 
 def build_bg_path(sender_id: int) -> str:
@@ -31,44 +68,273 @@ def build_photo_path(sender_id: int) -> str:
     return f"data/img/{str(sender_id)}.png"  # the user_id indentifies the image of each user
 
 
-def generate_photo(info: dict, user_data: dict, delete_message: bool = False):
+def generate_photo(info: dict,
+                   user_data: dict,
+                   replace_message: bool = False,
+                   final: bool = False,
+                   deferred: bool = False) -> bool:
     """Generates the image based on the user's settings, then sends it
-    The process can be executed on the main thread or on a separate thread, based on the settings
+    The process can be executed on the main thread or by the render engine, based on the settings.
+    If the render engine is too busy to accept the image, or too many images are in progress, the user is asked to try
+    again later.
+    While a preview is rendering, the following requests of the user are coalesced: the preview in flight is dropped
+    when it is done, and only the latest request (with all the offsets accumulated in user_data) is rendered and sent.
+    A request for the final image is never replaced by a later one for a preview, and a deferred request waits for the
+    render engine instead of being refused, since the user was told it had been accepted.
+    The next render starts only after the previous image has been sent, so the images arrive in order
 
     Args:
         info (dict): {'bot': bot used to send the image, 'chat_id': id of the chat that will receive the image}
         data (dict): {'title': title of the image, 'caption': caption of the image, 'template': template to be used,
             'resize_mode': how to resize the image, 'background_offset': offset used to crop the image}
-        message_id (bool, optional): whther or not the previous message needs to be deleted. Defaults to False.
+        replace_message (bool, optional): whether the new preview replaces the previous one, the message
+            info['message_id']. Defaults to False.
+        final (bool, optional): whether the user has finished adjusting the image. The last preview is replaced by
+            the image rendered at full size. Defaults to False.
+        deferred (bool, optional): whether the request was deferred while the previous render was in flight.
+            Defaults to False.
+
+    Returns:
+        bool: whether the image has been accepted
     """
-    if delete_message:  # delete the last message sent
-        info['bot'].delete_message(chat_id=info['chat_id'], message_id=info['message_id'])
+    sender_id = info['sender_id']
+    try:
+        if not _jobs.begin_render(sender_id):  # the previous render is still in flight
+            if _jobs.defer(sender_id,
+                           lambda: generate_photo(info=info, user_data=user_data, replace_message=replace_message,
+                                                  final=final, deferred=True),
+                           final=final):
+                return True
+            # the previous render has ended in the meantime
+            return generate_photo(info=info, user_data=user_data, replace_message=replace_message, final=final,
+                                  deferred=deferred)
+    except JobLimitError:
+        info['bot'].send_message(chat_id=info['chat_id'], text=read_md("busy"), parse_mode=ParseMode.MARKDOWN_V2)
+        return False
+
+    cache_key = None
+    # an identical image may have already been sent. Not in random mode, where the offsets are always new
+    if get_render_cache() is not None and user_data['resize_mode'] != "random":
+        cache_key = render_key(data=user_data, final=final)
+    if cache_key is not None:
+        if send_cached_image(info=info, data=user_data, cache_key=cache_key, replace_message=replace_message,
+                             final=final):
+            finish_render(sender_id)
+            return True
 
     if config_map['image']['thread']:
-        t = Thread(target=send_image, args=(info, user_data))
-        t.start()
+        data = deepcopy(user_data)  # the user_data may change while the image is waiting for a worker
+
+        def submit(wait: bool):
+            bg_bytes = load_background(sender_id)
+            # with processes, the background kept in memory is sent to the worker only until it has prepared it
+            bg_kept = bg_bytes is not None and get_engine().processes and sender_id in _kept_backgrounds
+            get_engine().submit(sender_id,
+                                render_image,
+                                sender_id,
+                                data,
+                                dict(config_map['image']),
+                                None if bg_kept else bg_bytes,
+                                final,
+                                bg_kept,
+                                callback=on_rendered,
+                                wait=wait)
+
+        def on_rendered(future: Future):
+            try:
+                if future.exception() is None and load_background(sender_id) is not None:
+                    _kept_backgrounds.add(sender_id)
+                if final or not _jobs.has_pending(sender_id):  # else this preview is outdated, only the latest is sent
+                    deliver_image(info=info,
+                                  data=data,
+                                  photo=future.result(),  # raises, if the render failed
+                                  cache_key=cache_key,
+                                  replace_message=replace_message,
+                                  final=final)
+            except BackgroundMissingError:  # e.g. the session has been evicted: the worker needs the background again
+                _kept_backgrounds.discard(sender_id)
+                submit(wait=True)
+                return
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Could not create the image of %s", sender_id)
+                abort_image(info)
+                return
+            finish_render(sender_id)  # only now, so that a newer image can't be sent before this one
+
+        try:
+            submit(wait=deferred)
+        except RenderBusyError:
+            _jobs.end_render(sender_id)
+            info['bot'].send_message(chat_id=info['chat_id'], text=read_md("busy"), parse_mode=ParseMode.MARKDOWN_V2)
+            return False
     else:
-        send_image(info=info, data=user_data)
+        try:
+            send_image(info=info, data=user_data, cache_key=cache_key, replace_message=replace_message, final=final)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Could not create the image of %s", sender_id)
+            abort_image(info)  # the user has already been told, as it happens with the render engine
+    return True
+
+
+def finish_render(sender_id: int):
+    """Marks the render in flight of the user as done, once its image has been sent,
+    then starts the request deferred in the meantime, if any
+
+    Args:
+        sender_id (int): id of the user
+    """
+    pending = _jobs.end_render(sender_id)
+    if pending is not None:
+        pending()
+
+
+def abort_image(info: dict):
+    """Gives up on the image of the user, because it could not be rendered or sent,
+    so that the user is not locked out until it expires. The user is told that something went wrong
+
+    Args:
+        info (dict): {'bot': bot used to send the image, 'chat_id': id of the chat that will receive the image}
+    """
+    clear_user_images(info['sender_id'])
+    try:
+        info['bot'].send_message(chat_id=info['chat_id'], text=read_md("fail"), parse_mode=ParseMode.MARKDOWN_V2)
+    except TelegramError as e:
+        logger.error("Could not tell %s that the image failed: %s", info['sender_id'], e)
 
 
-def send_image(info: dict, data: dict):
+def send_cached_image(info: dict, data: dict, cache_key: str, replace_message: bool = False, final: bool = False) -> bool:
+    """Sends again, by its file_id, an image identical to the one requested, if it has already been sent
+
+    Args:
+        info (dict): {'bot': bot used to send the image, 'chat_id': id of the chat that will receive the image}
+        data (dict): {'title': title of the image, 'caption': caption of the image, 'template': template to be used,
+            'resize_mode': how to resize the image, 'background_offset': offset used to crop the image}
+        cache_key (str): key of the image, built by render_key
+        replace_message (bool, optional): whether the image replaces the last preview. Defaults to False.
+        final (bool, optional): whether the image is the final one, which always replaces the last preview.
+            Defaults to False.
+
+    Returns:
+        bool: whether the image has been sent. If False, it has to be rendered
+    """
+    file_id = get_render_cache().get(cache_key)
+    if file_id is None:
+        return False
+    try:
+        deliver_image(info=info, data=data, file_id=file_id, replace_message=replace_message, final=final)
+    except TelegramError as e:  # the file_id is no longer valid
+        logger.warning("Could not send the cached image, rendering it again: %s", e)
+        get_render_cache().discard(cache_key)
+        return False
+    return True
+
+
+def send_image(info: dict, data: dict, cache_key: str = None, replace_message: bool = False, final: bool = False):
     """Creates and sends the requested image
 
     Args:
         info (dict): {'bot': bot used to send the image, 'chat_id': id of the chat that will receive the image}
         data (dict): {'title': title of the image, 'caption': caption of the image, 'template': template to be used,
             'resize_mode': how to resize the image, 'background_offset': offset used to crop the image}
+        cache_key (str, optional): key of the image in the render cache, if it is enabled. Defaults to None.
+        replace_message (bool, optional): whether the image replaces the last preview. Defaults to False.
+        final (bool, optional): whether the image is the final one, which always replaces the last preview.
+            Defaults to False.
+    """
+    try:
+        photo = render_image(sender_id=info['sender_id'], data=data, bg_bytes=load_background(info['sender_id']),
+                             final=final)  # create the image to send
+        deliver_image(info=info, data=data, photo=photo, cache_key=cache_key, replace_message=replace_message,
+                      final=final)
+    except Exception:
+        _jobs.end_render(info['sender_id'])  # the request deferred in the meantime is dropped with the image
+        raise
+    finish_render(info['sender_id'])
+
+
+@timed("render")
+def render_image(sender_id: int,
+                 data: dict,
+                 image_config: dict = None,
+                 bg_bytes: bytes = None,
+                 final: bool = False,
+                 bg_kept: bool = False) -> bytes:
+    """Creates the image requested by the user, reusing what was prepared for the user's previous images.
+    While the user is still adjusting the image (crop and random), a smaller preview is rendered instead.
+    It is also the job executed by the render engine, so everything it needs must be passed as a parameter
+
+    Args:
+        sender_id (int): id of the user
+        data (dict): {'title': title of the image, 'caption': caption of the image, 'template': template to be used,
+            'resize_mode': how to resize the image, 'background_offset': offset used to crop the image}
+        image_config (dict, optional): image settings taken when the image was requested, since a worker process
+            has its own copy of them. Defaults to the current image settings.
+        bg_bytes (bytes, optional): contents of the background sent by the user, if it is kept in memory.
+            Defaults to None.
+        final (bool, optional): whether the user has finished adjusting the image. Defaults to False.
+        bg_kept (bool, optional): whether the background is kept in memory but not sent, because the session
+            already has it prepared. Defaults to False.
+
+    Raises:
+        BackgroundMissingError: bg_kept is True, but the session doesn't have the background prepared
+
+    Returns:
+        bytes: contents of the image if the in_memory setting is enabled, None if it was saved on the disk
+    """
+    if image_config is None:
+        image_config = config_map['image']
+
+    preview = not final and data['resize_mode'] != "scale"
+    photo_path = BytesIO() if image_config['in_memory'] else build_photo_path(sender_id)
+    create_image(data=data,
+                 bg_path=build_bg_path(sender_id),
+                 photo_path=photo_path,
+                 session=get_session(sender_id),
+                 bg_bytes=bg_bytes,
+                 bg_kept=bg_kept,
+                 purpose="preview" if preview else "final",
+                 scale=image_config['preview_scale'] if preview else 1,
+                 image_config=image_config)
+    return photo_path.getvalue() if isinstance(photo_path, BytesIO) else None
+
+
+def deliver_image(info: dict,
+                  data: dict,
+                  photo: bytes = None,
+                  file_id: str = None,
+                  cache_key: str = None,
+                  replace_message: bool = False,
+                  final: bool = False):
+    """Sends the image created by render_image, or an identical one already sent, by its file_id.
+    An image that replaces the previous preview is edited in place, keeping the same message and keyboard.
+    If the message can't be edited, the image is sent as a new message and the old one is deleted.
+    The previews are sent after any other message waiting for the rate limit, and a preview waiting to replace
+    the message is dropped if a newer image replaces it first
+
+    Args:
+        info (dict): {'bot': bot used to send the image, 'chat_id': id of the chat that will receive the image}
+        data (dict): {'title': title of the image, 'caption': caption of the image, 'template': template to be used,
+            'resize_mode': how to resize the image, 'background_offset': offset used to crop the image}
+        photo (bytes, optional): contents of the image, if it was kept in memory. Defaults to None.
+        file_id (str, optional): file_id of an identical image already sent, used instead of the image rendered.
+            Defaults to None.
+        cache_key (str, optional): key under which the file_id of the image sent is stored in the render cache.
+            Defaults to None.
+        replace_message (bool, optional): whether the image replaces the last preview, the message info['message_id'].
+            Defaults to False.
+        final (bool, optional): whether the image is the final one, which always replaces the last preview.
+            Defaults to False.
     """
     bot = info['bot']
     chat_id = info['chat_id']
-    bg_path = build_bg_path(info['sender_id'])
     photo_path = build_photo_path(info['sender_id'])
     resize_mode = data['resize_mode']
 
-    create_image(data=data, bg_path=bg_path, photo_path=photo_path)  # create the image to send
-
     # Set the inline keyboard and whether the images should be deleted from the disk immediatly, based on the resize_mode
-    if resize_mode in "crop":
+    if final:
+        clear = True
+        reply_markup = None
+    elif resize_mode in "crop":
         clear = False
         reply_markup = get_keyboard_crop()
     elif resize_mode == "scale":
@@ -78,96 +344,427 @@ def send_image(info: dict, data: dict):
         clear = False
         reply_markup = get_keyboard_random()
 
-    fd = open(photo_path, "rb")
+    priority = PRIORITY_PREVIEW if reply_markup is not None else PRIORITY_FINAL  # the final images have no keyboard
+
+    if file_id is not None:
+        fd = None
+    elif photo is not None:
+        fd = BytesIO(photo)
+    else:
+        fd = open(photo_path, "rb")
+
+    with timer("send"):
+        if final or replace_message:  # the preview is replaced by the new one, or by the full size image
+            try:
+                message = bot.edit_message_media(chat_id=chat_id,
+                                                 message_id=info['message_id'],
+                                                 media=InputMediaPhoto(media=file_id or fd),
+                                                 reply_markup=reply_markup,
+                                                 priority=priority)  # None if a newer image has replaced it
+            except TelegramError as e:  # e.g. the message is too old or has been deleted
+                message = None
+                if "not modified" not in str(e):  # else the same image, sent again by its file_id, is already there
+                    logger.warning("Could not edit the preview, sending it again: %s", e)
+                    if fd is not None:
+                        fd.seek(0)
+                    # the new message is sent first, so that a failure doesn't leave the user without any
+                    message = bot.send_photo(chat_id=chat_id, photo=file_id or fd, reply_markup=reply_markup,
+                                             priority=priority)
+                    try:
+                        bot.delete_message(chat_id=chat_id, message_id=info['message_id'])
+                    except TelegramError:
+                        pass  # already gone
+        else:
+            message = bot.send_photo(chat_id=chat_id, photo=file_id or fd, reply_markup=reply_markup, priority=priority)
+
+    if fd is not None:
+        fd.close()
+
+    if cache_key is not None and isinstance(message, Message) and message.photo:  # the largest size is the image
+        get_render_cache().put(cache_key, message.photo[-1].file_id)
+
+    if clear:  # clear the disk space and the memory used by the images
+        clear_user_images(info['sender_id'])
+
+
+def has_image_in_progress(sender_id: int) -> bool:
+    """Whether the bot is already making an image for the user.
+    An image is in progress from its first render until it is delivered, cancelled or it expires
+
+    Args:
+        sender_id (int): id of the user
 
-    bot.send_photo(chat_id=chat_id, photo=fd, reply_markup=reply_markup)
+    Returns:
+        bool: True if there is an image in progress
+    """
+    return _jobs.has_job(sender_id)
 
-    fd.close()
 
-    if clear:  # clear the disk space used by the images
-        if os.path.exists(bg_path):
-            os.remove(bg_path)
-        os.remove(photo_path)
+def clear_user_images(sender_id: int):
+    """Frees the disk space and the memory used to create the images of the user
 
+    Args:
+        sender_id (int): id of the user
+    """
+    _jobs.finish(sender_id)
+    _kept_backgrounds.discard(sender_id)
+    for path in (build_bg_path(sender_id), build_photo_path(sender_id)):
+        if os.path.exists(path):
+            os.remove(path)
+    discard_images(sender_id)
+    clear_session(sender_id)
+    if engine_started() and get_engine().processes:  # the worker processes have their own sessions
+        get_engine().run(sender_id, clear_session, sender_id)
+
+
+def choose_photo_size(photo: list, size: tuple, resize_mode: str) -> tuple:
+    """Chooses the smallest size of the photo that still gives the same image as the largest one.
+    The image is always rendered as if the largest size had been used (see reduce_and_blur).
+    In the "scale" resize_mode the photo is resized to the template, so a size that covers the template is enough,
+    while in the other ones the template shows the largest size at its own resolution.
+    In the "fast" blur_mode the background is also reduced to BLUR_PIXELS_PER_RADIUS pixels for each unit of the blur
+    radius, so a size with that many pixels is enough as well
 
-def create_image(data: dict, bg_path: str, photo_path: str):
+    Args:
+        photo (list): sizes of the photo sent by the user, as PhotoSize
+        size (tuple): (width, height) of the template
+        resize_mode (str): how to resize the image
+
+    Returns:
+        tuple: (PhotoSize chosen, its scale compared to the largest size)
+    """
+    largest = max(photo, key=lambda photo_size: photo_size.width * photo_size.height)
+    temp_w, temp_h = size
+    needed = 1
+    if resize_mode == "scale":
+        needed = min(needed, max(temp_w / largest.width, temp_h / largest.height))
+    blur = config_map['image']['blur']
+    if config_map['image']['blur_mode'] == "fast" and blur > 0:
+        needed = min(needed, BLUR_PIXELS_PER_RADIUS / blur)
+
+    sufficient = [
+        photo_size for photo_size in photo
+        if photo_size.width >= largest.width * needed * PHOTO_SIZE_TOLERANCE
+        and photo_size.height >= largest.height * needed * PHOTO_SIZE_TOLERANCE
+    ]
+    chosen = min(sufficient, key=lambda photo_size: photo_size.width * photo_size.height)
+    return chosen, chosen.width / largest.width
+
+
+def download_background(bot: Bot, sender_id: int, file_id: str):
+    """Downloads the background sent by the user.
+    It is kept in memory if the in_memory setting is enabled, unless it is too large, else it is saved in data/img.
+    The contents are kept as they are received, without copying them, and they are decoded only when the background
+    is prepared, at the reduced scale it is needed at (see reduce_and_blur)
+
+    Args:
+        bot (Bot): bot used to download the background
+        sender_id (int): id of the user
+        file_id (str): file_id of the photo sent by the user
+    """
+    data = bot.request.retrieve(bot.getFile(file_id).file_path)  # the file_path is the full url of the file
+    if config_map['image']['in_memory']:
+        save_background(sender_id, data, build_bg_path(sender_id))
+    else:
+        with open(build_bg_path(sender_id), "wb") as bg_file:
+            bg_file.write(data)
+
+
+def restore_images(bot: Bot, in_progress: dict) -> int:
+    """Reconciles data/img with the images that were in progress when the bot stopped.
+    The files left behind by the other users are deleted. The images in progress are registered again,
+    downloading the background sent by the user if it was only kept in memory.
+    If the background can't be downloaded, the user will be told that the image has expired
+
+    Args:
+        bot (Bot): bot used to download the backgrounds
+        in_progress (dict): user_data of the users who were adjusting their image, by user id
+
+    Returns:
+        int: number of files deleted
+    """
+    removed = 0
+    for entry in os.scandir(os.path.dirname(build_bg_path(0))):
+        match = USER_IMAGE_PATTERN.match(entry.name)
+        if match is None:  # templates and default backgrounds
+            continue
+        if match.group(1) is None or int(match.group(2)) not in in_progress:  # the previews are rendered again
+            os.remove(entry.path)
+            removed += 1
+
+    for sender_id, user_data in in_progress.items():
+        file_id = user_data.get('background_file_id')
+        if file_id is not None and not os.path.exists(build_bg_path(sender_id)):
+            try:
+                download_background(bot, sender_id, file_id)
+            except TelegramError as e:
+                logger.warning("Could not restore the background of %s: %s", sender_id, e)
+                continue
+        _jobs.resume(sender_id)
+
+    logger.info("Restored %d images in progress, deleted %d files left behind", len(in_progress), removed)
+    return removed
+
+
+def create_image(data: dict,
+                 bg_path: str,
+                 photo_path: Union[str, BinaryIO],
+                 session: RenderSession = None,
+                 bg_bytes: bytes = None,
+                 bg_kept: bool = False,
+                 purpose: str = "final",
+                 scale: float = 1,
+                 image_config: dict = None):
     """Creates the image with the data provided
 
     Args:
         data (dict): {'title': title of the image, 'caption': caption of the image, 'template': template to be used,
             'resize_mode': how to resize the image, 'background_offset': offset used to crop the image}
         bg_path (str): path where to find the bg_image, if provided
-        photo_path (str): path that will be used to save the image
+        photo_path (Union[str, BinaryIO]): path or buffer that will be used to save the image
+        session (RenderSession, optional): session of the user, used to reuse the prepared background between renders.
+            Defaults to None.
+        bg_bytes (bytes, optional): contents of the bg_image, if it is kept in memory instead of bg_path. Defaults to None.
+        bg_kept (bool, optional): whether the bg_image is kept in memory, but only its prepared version in the session
+            is provided. Defaults to False.
+        purpose (str, optional): "preview" or "final", selects the encoder settings used to save the image.
+            Defaults to "final".
+        scale (float, optional): scale of the image compared to the template, used to render smaller previews.
+            Defaults to 1.
+        image_config (dict, optional): image settings to use. Defaults to the current image settings.
     """
+    if image_config is None:
+        image_config = config_map['image']
     title = data['title']
     caption = data['caption']
     template = data['template']
     resize_mode = data['resize_mode']
-    background_offset = data['background_offset'] if resize_mode == "crop" else None
+    background_offset = data.get('background_offset') if resize_mode != "scale" else None
+    if resize_mode == "crop":  # the offset is measured in pixels of the full size image
+        background_offset = {'x': background_offset['x'] * scale, 'y': background_offset['y'] * scale}
+    resample = Image.BICUBIC if scale == 1 else Image.BILINEAR  # previews use a cheaper resampling
+
+    size = get_template_size(template)
+    if session is None:
+        session = RenderSession()
+
+    # The template, the title and the caption are drawn only once for each session, on a single overlay
+    font_size_title = image_config['font_size_title']
+    font_size_caption = image_config['font_size_caption']
+    key = (template, title, caption, font_size_title, font_size_caption, scale)
+    overlay: Image.Image = session.get(
+        "overlay", key, lambda: create_overlay(template=template, title=title, caption=caption,
+                                               font_size_title=font_size_title, font_size_caption=font_size_caption,
+                                               scale=scale))
+
+    # Load the background, already blurred and scaled. It is prepared only once for each session
+    blur = image_config['blur']
+    blur_mode = image_config['blur_mode']
+    source_scale = data.get('background_scale', 1)
+    key = (bg_path, bg_bytes is not None or bg_kept or os.path.exists(bg_path), template, resize_mode, blur, blur_mode,
+           size, source_scale)
+
+    def prepare() -> tuple:
+        if bg_kept:
+            raise BackgroundMissingError("The background is not in the session")
+        return prepare_background(bg_path=BytesIO(bg_bytes) if bg_bytes is not None else bg_path, template=template,
+                                  size=size, resize_mode=resize_mode, blur=blur, blur_mode=blur_mode,
+                                  source_scale=source_scale)
+
+    im, bg_scale = session.get("background", key, prepare)
+
+    with timer("resize"):
+        im = resize_image(im=im, fg=overlay, resize_mode=resize_mode, offset=background_offset, scale=bg_scale / scale,
+                          resample=resample)  # resize the image
+
+    with timer("compose"):
+        im.paste(overlay, box=(0, 0), mask=overlay)  # apply foreground and text
+
+    with timer("encode"):
+        encode_image(im=im, out=photo_path, purpose=purpose)
+    im.close()
 
-    # Load background
-    if os.path.exists(bg_path):
-        im: Image.Image = Image.open(bg_path).filter(ImageFilter.GaussianBlur(config_map['image']['blur']))
-    else:
-        im: Image.Image = Image.open(f"data/img/bg_{template.replace('_vuoto', '')}.png")  # remove "_vuoto" the template path
 
-    fg: Image.Image = Image.open(f"data/img/template_{template}.png")
+@timed("overlay")
+def create_overlay(template: str, title: str, caption: str, font_size_title: int, font_size_caption: int,
+                   scale: float = 1) -> Image:
+    """Creates the layer placed over the background: the template with the title and the caption drawn on it
 
-    im = resize_image(im=im, fg=fg, resize_mode=resize_mode, offset=background_offset)  # resize the image
+    Args:
+        template (str): template to be used
+        title (str): title of the image
+        caption (str): caption of the image
+        font_size_title (int): font size of the title
+        font_size_caption (int): font size of the caption
+        scale (float, optional): scale of the image compared to the template. Defaults to 1.
 
-    im.paste(fg, box=(0, 0), mask=fg)  # apply foreground
+    Returns:
+        Image: RGBA overlay. It must not be modified, since it can be used by more renders
+    """
+    fg: Image.Image = get_template(template, scale=scale)
+    w, h = fg.size
 
-    draw_im = ImageDraw.Draw(im)
-    w, h = im.size
+    # the text is drawn on a transparent white layer, so its antialiased borders blend correctly with the template
+    text_layer = Image.new("RGBA", fg.size, (255, 255, 255, 0))
+    draw_im = ImageDraw.Draw(text_layer)
 
-    y_title = draw_text(draw_im=draw_im, w=w, text=title, y_text=h / 2 - 120,
-                        font_size=config_map['image']['font_size_title'])  # draw the title
+    y_title = draw_text(draw_im=draw_im, w=w, text=title, y_text=h / 2 - 120 * scale,
+                        font_size=max(1, round(font_size_title * scale)),
+                        spacing=5 * scale)  # draw the title
 
-    draw_text(draw_im=draw_im, w=w, text=caption, y_text=y_title + 30,
-              font_size=config_map['image']['font_size_caption'])  # draw the caption
+    draw_text(draw_im=draw_im, w=w, text=caption, y_text=y_title + 30 * scale,
+              font_size=max(1, round(font_size_caption * scale)),
+              spacing=5 * scale)  # draw the caption
 
-    im.save(photo_path)
-    im.close()
+    overlay = Image.alpha_composite(fg, text_layer)
     fg.close()
+    text_layer.close()
+    return overlay
+
+
+@timed("background")
+def prepare_background(bg_path: Union[str, BinaryIO],
+                       template: str,
+                       size: tuple,
+                       resize_mode: str,
+                       blur: int,
+                       blur_mode: str = "exact",
+                       source_scale: float = 1) -> tuple:
+    """Loads the background and prepares it to be cropped.
+    The image provided by the user is blurred, then it is scaled so that it covers the template.
+    In the "scale" resize_mode, the background is resized to the exact size of the template
+
+    Args:
+        bg_path (Union[str, BinaryIO]): path where to find the bg_image, if provided, or a buffer with its contents
+        template (str): template to be used. If there is no bg_image, its default background is used instead
+        size (tuple): (width, height) of the template
+        resize_mode (str): how to resize the image
+        blur (int): radius of the blur applied to the bg_image
+        blur_mode (str, optional): "exact" blurs the bg_image at its original resolution,
+            "fast" reduces it first (see reduce_and_blur). Defaults to "exact".
+        source_scale (float, optional): scale of the bg_image compared to the largest size of the photo, whose pixels
+            the blur radius is measured in. Defaults to 1.
 
+    Returns:
+        tuple: (prepared background, scale). The scale is how many pixels of the prepared background make up a pixel of the
+            final image. The background must not be modified, since it can be used by more renders
+    """
+    if isinstance(bg_path, str) and not os.path.exists(bg_path):
+        return get_default_background(template), 1
 
-def resize_image(im: Image, fg: Image, resize_mode: str, offset: dict) -> Image:
+    with Image.open(bg_path) as bg:
+        if blur_mode == "fast":
+            return reduce_and_blur(im=bg, size=size, resize_mode=resize_mode, blur=blur, source_scale=source_scale)
+        im: Image.Image = bg.filter(ImageFilter.GaussianBlur(blur * source_scale))
+
+    if resize_mode == "scale":
+        return im.resize(size), 1
+
+    orig_w, orig_h = im.size  # size of the bg image
+    temp_w, temp_h = size  # size of the template image
+    ratio = max(temp_w / orig_w, temp_h / orig_h)
+    if ratio > 1:
+        im = im.resize((int(orig_w * ratio), int(orig_h * ratio)))
+    return im, 1
+
+
+def reduce_and_blur(im: Image, size: tuple, resize_mode: str, blur: int, source_scale: float = 1) -> tuple:
+    """Reduces the image before blurring it, scaling the blur radius to match, so that far less pixels have to be blurred.
+    In the "scale" resize_mode the image is reduced to the size of the template.
+    Otherwise the part of the image shown in the final image must stay the same, so the image is reduced only as much
+    as the blur can hide, keeping BLUR_PIXELS_PER_RADIUS pixels for each unit of the blur radius.
+    The final image is then obtained by enlarging the cropped area (see resize_image).
+    If the image is a JPEG that has not been loaded yet, it is decoded directly at a reduced scale (1/2, 1/4 or 1/8),
+    the smallest one that is still larger than the reduced image, which takes a fraction of the time and memory.
+    If the image is a smaller size of the photo (see choose_photo_size), the result is the same as with the largest size
+
+    Args:
+        im (Image): image to blur, preferably just opened
+        size (tuple): (width, height) of the template
+        resize_mode (str): how to resize the image
+        blur (int): radius of the blur as it would be applied to the largest size of the photo
+        source_scale (float, optional): scale of the image compared to the largest size of the photo. Defaults to 1.
+
+    Returns:
+        tuple: (prepared background, scale), like prepare_background
+    """
+    orig_w, orig_h = im.size  # size of the bg image
+    temp_w, temp_h = size  # size of the template image
+    blur = blur * source_scale  # in pixels of the bg image
+
+    if resize_mode == "scale":
+        if temp_w > orig_w or temp_h > orig_h:  # enlarging the image first would only make the blur slower
+            return im.filter(ImageFilter.GaussianBlur(blur)).resize(size), 1
+        reduction = ((temp_w / orig_w) * (temp_h / orig_h))**0.5
+        im.draft(im.mode, size)
+        return im.resize(size, Image.BOX).filter(ImageFilter.GaussianBlur(blur * reduction)), 1
+
+    reduction = min(1, BLUR_PIXELS_PER_RADIUS / blur) if blur > 0 else 1
+    if reduction < 1:
+        reduced_size = (max(1, round(orig_w * reduction)), max(1, round(orig_h * reduction)))
+        im.draft(im.mode, reduced_size)
+        im = im.resize(reduced_size, Image.BOX)
+    im = im.filter(ImageFilter.GaussianBlur(blur * reduction))
+
+    ratio = max(temp_w / orig_w, temp_h / orig_h) * source_scale  # how much the largest size would have to be enlarged
+    return im, reduction * source_scale / max(ratio, 1)
+
+
+def resize_image(im: Image, fg: Image, resize_mode: str, offset: dict, scale: float = 1,
+                 resample: int = Image.BICUBIC) -> Image:
     """Resizes the image with the method specified in resize_mode
 
     Args:
         im (Image): image to resize
         fg (Image): images wich dimensions will be used to resize the former image
         resize_mode (str): how to resize the image
-        offset (dict): offset used to crop the image
+        offset (dict): offset used to crop the image. In the "random" resize_mode it is relative to the space the image
+            can move in, from -0.5 to 0.5 (see random_offset). If None, a new random offset is used
+        scale (float, optional): how many pixels of the image make up a pixel of the final image. Defaults to 1.
+        resample (int, optional): resampling filter used when the image is resized. Defaults to Image.BICUBIC.
 
     Returns:
         Image: newly resized image
     """
     orig_w, orig_h = im.size  # size of the bg image
     temp_w, temp_h = fg.size  # size of the template image
+    win_w, win_h = temp_w * scale, temp_h * scale  # size of the area of the bg image that will be shown
+
+    if resize_mode == "scale":  # scales the image so that it fits (ignores proportions)
+        return im.resize(fg.size, resample)
+
+    ratio = max(win_w / orig_w, win_h / orig_h)
+    if ratio > 1:
+        im = im.resize((int(orig_w * ratio), int(orig_h * ratio)), resample)
+    orig_w, orig_h = im.size
 
     if resize_mode == "crop":  # crops the image from the center + the offset
-        ratio = max(temp_w / orig_w, temp_h / orig_h)
-        if ratio > 1:
-            im = im.resize((int(orig_w * ratio), int(orig_h * ratio)))
-        orig_w, orig_h = im.size
-        im = im.crop(box=((orig_w - temp_w) / 2 + offset['x'], (orig_h - temp_h) / 2 + offset['y'],
-                          (orig_w + temp_w) / 2 + offset['x'], (orig_h + temp_h) / 2 + offset['y']))
-    elif resize_mode == "scale":  # scales the image so that it fits (ignores proportions)
-        im = im.resize(fg.size)
+        x_offset, y_offset = offset['x'] * scale, offset['y'] * scale
     elif resize_mode == "random":  # crops the image from the center + the random offset
-        ratio = max(temp_w / orig_w, temp_h / orig_h)
-        if ratio > 1:
-            im = im.resize((int(orig_w * ratio), int(orig_h * ratio)))
-        orig_w, orig_h = im.size
-        x_offset = random.randint(-abs(orig_w - temp_w) // 2, abs(orig_w - temp_w) // 2)
-        y_offset = random.randint(-abs(orig_h - temp_h) // 2, abs(orig_h - temp_h) // 2)
-        im = im.crop(box=((orig_w - temp_w) / 2 + x_offset, (orig_h - temp_h) / 2 + y_offset, (orig_w + temp_w) / 2 + x_offset,
-                          (orig_h + temp_h) / 2 + y_offset))
+        if offset is None:
+            offset = random_offset()
+        x_offset, y_offset = offset['x'] * abs(orig_w - win_w), offset['y'] * abs(orig_h - win_h)
+    else:
+        return im
+
+    im = im.crop(box=((orig_w - win_w) / 2 + x_offset, (orig_h - win_h) / 2 + y_offset, (orig_w + win_w) / 2 + x_offset,
+                      (orig_h + win_h) / 2 + y_offset))
+    if scale != 1:  # the cropped area is resized to the size of the final image
+        im = im.resize(fg.size, resample)
     return im
 
 
-def draw_text(draw_im: ImageDraw, w: int, text: str, y_text: float, font_size: int) -> int:
+def random_offset() -> dict:
+    """Generates a random offset for the "random" resize_mode.
+    It is relative to the space the background can move in, so the same offset can be used for previews and final images
+
+    Returns:
+        dict: {'x': value between -0.5 and 0.5, 'y': value between -0.5 and 0.5}
+    """
+    return {'x': random.uniform(-0.5, 0.5), 'y': random.uniform(-0.5, 0.5)}
+
+
+def draw_text(draw_im: ImageDraw, w: int, text: str, y_text: float, font_size: int, spacing: float = 5) -> int:
     """Draws the text on the image of width w, starting at height y_text
 
     Args:
@@ -175,46 +772,14 @@ def draw_text(draw_im: ImageDraw, w: int, text: str, y_text: float, font_size: i
         w (int): with of the image
         text (str): text to write
         y_text (int): height of the text
-        font (any): font of the text
+        font_size (int): size of the font
+        spacing (float, optional): space between the lines. Defaults to 5.
 
     Returns:
         int: final height of the text
     """
-    font = ImageFont.truetype(font="data/font/UbuntuCondensed-Regular.ttf", size=font_size)
-    for line in wrap_text(text=text, max_w=w / 3 * 2, font=font):  # write each line of the text
-        t_w, t_h = font.getsize(line)
-        draw_im.multiline_text(xy=((w - t_w) / 2, y_text), text=line, fill="white", font=font)
-        y_text += t_h + 5
-    return y_text
-
-
-def wrap_text(text: str, max_w: int, font: any) -> list:
-    """Wraps the text so that no line is longer than the max width allowed
-
-    Args:
-        text (str): text to wrap
-        max_w (int): max width the text is allowed to be
-        font (any): font the text will use
-
-    Returns:
-        list: list of lines (str)
-    """
-    lines = []
-
-    if font.getsize(text)[0] < max_w:
-        lines.append(text)
-        return lines
-
-    for row in text.split("\n"):
-        line = None
-        for word in row.split():
-            if not line:
-                line = word
-            elif font.getsize(line + word)[0] < max_w:
-                line += " " + word
-            else:
-                lines.append(line)
-                line = word
-        if line:
-            lines.append(line)
-    return lines
+    font = get_font(size=font_size)
+    layout = layout_text(text=text, max_w=w / 3 * 2, font_size=font_size, spacing=spacing)
+    for line, x, y in zip(layout.lines, layout.xs, layout.ys):  # write each line of the text
+        draw_im.multiline_text(xy=(w / 2 + x, y_text + y), text=line, fill="white", font=font)
+    return y_text + layout.height
@@ -0,0 +1,301 @@
+"""Keeps the calls made to the Bot API within the limits set by telegram, so that a burst doesn't end in 429 errors"""
+import inspect
+import itertools
+import logging
+import time
+from threading import Condition
+from typing import Callable
+from telegram import Bot
+from telegram.error import RetryAfter
+from modules.debug.metrics import is_sampled, observe
+from modules.various.lru_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_FINAL = 0  # final images, which the user is waiting for to finish
+PRIORITY_MESSAGE = 1  # text messages, edits and deletions
+PRIORITY_PREVIEW = 2  # previews, which will likely be replaced soon
+
+MAX_WAIT_STEP = 1  # max seconds a call waits before checking again if it can go, in case no one wakes it up
+
+
+class TokenBucket:
+    """Allows up to burst calls at once, then rate calls per second
+
+    Args:
+        rate (float): calls per second. If <= 0, the calls are not limited
+        burst (int): calls that can be made at once
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        """Seconds to wait before the next call can be made
+
+        Args:
+            now (float): current time, from time.monotonic
+
+        Returns:
+            float: seconds to wait. 0 if the call can be made now
+        """
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.rate <= 0:
+            return 0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        """Consumes a call. Must follow a wait_time that returned 0
+        """
+        if self.rate > 0:
+            self.tokens -= 1
+
+    def pause(self, seconds: float):
+        """Stops the calls for the seconds provided, as requested by telegram
+
+        Args:
+            seconds (float): seconds to wait
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class _Ticket:
+    """Call waiting for its turn"""
+
+    def __init__(self, chat_id: int, priority: int, seq: int, key: tuple):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.seq = seq
+        self.key = key
+        self.dropped = False
+        self.queued = time.perf_counter()
+
+
+class ApiLimiter:
+    """Decides when each call to the Bot API can be made, so that both the global limit and the limit of each chat
+    are respected. The calls wait in the thread that makes them.
+    When more calls are waiting, the one with the highest priority goes first, then the oldest.
+    A call can have a key, like the message it edits: the calls with the same key are made one at a time,
+    and a call still waiting is dropped as soon as a newer one with the same key arrives, since it is obsolete
+
+    Args:
+        global_rate (float): calls per second to all the chats. If <= 0, there is no global limit
+        global_burst (int): calls to all the chats that can be made at once
+        chat_rate (float): calls per second to a private chat. If <= 0, there is no limit
+        group_rate (float): calls per second to a group. If <= 0, there is no limit
+        chat_burst (int): calls to the same chat or group that can be made at once
+        max_chats (int, optional): how many chats are tracked. The least recently used ones are forgotten.
+            Defaults to 4096.
+    """
+
+    def __init__(self,
+                 global_rate: float,
+                 global_burst: int,
+                 chat_rate: float,
+                 group_rate: float,
+                 chat_burst: int,
+                 max_chats: int = 4096):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.dropped = 0  # calls dropped because they were obsolete
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = LRUCache(max_chats)  # chat_id -> TokenBucket
+        self._no_chat = TokenBucket(0, 1)  # calls with no chat: not limited, but they can be paused by telegram
+        self._waiting = []  # _Ticket
+        self._latest = {}  # key -> latest _Ticket with that key
+        self._in_flight = set()  # keys of the calls being made
+        self._seq = itertools.count()
+        self._cond = Condition()
+
+    @property
+    def waiting(self) -> int:
+        """Number of calls waiting for their turn"""
+        return len(self._waiting)
+
+    def acquire(self, chat_id: int, priority: int = PRIORITY_MESSAGE, key: tuple = None, retry: bool = False) -> bool:
+        """Waits until the call can be made. If it has a key, release must be called once the call is done
+
+        Args:
+            chat_id (int): id of the chat the call is made in. None if it has no chat, like the edit of an inline message
+            priority (int, optional): priority of the call. Defaults to PRIORITY_MESSAGE.
+            key (tuple, optional): identifies what the call changes, like the message it edits. Defaults to None.
+            retry (bool, optional): whether the call has already been made once, so it is older than
+                any call with the same key still waiting. Defaults to False.
+
+        Returns:
+            bool: False if the call has been dropped, because a newer call with the same key has arrived
+        """
+        with self._cond:
+            ticket = _Ticket(chat_id, priority, next(self._seq), key)
+            if key is not None:
+                previous = self._latest.get(key)  # only the calls still waiting are there
+                if previous is not None:
+                    self.dropped += 1
+                    if retry:
+                        return False
+                    previous.dropped = True
+                self._latest[key] = ticket
+            self._waiting.append(ticket)
+            self._cond.notify_all()
+            try:
+                while not ticket.dropped:
+                    wait = self._wait_time(ticket)
+                    if wait == 0:
+                        self._chat(chat_id).take()
+                        self._global.take()
+                        if key is not None:
+                            self._in_flight.add(key)
+                        if is_sampled():
+                            observe("api.rate_limit_wait", time.perf_counter() - ticket.queued)
+                        return True
+                    self._cond.wait(min(wait, MAX_WAIT_STEP))
+                return False
+            finally:
+                self._waiting.remove(ticket)
+                if key is not None and self._latest.get(key) is ticket:
+                    del self._latest[key]
+                self._cond.notify_all()
+
+    def release(self, key: tuple):
+        """Tells that the call with the key, allowed by acquire, is done
+
+        Args:
+            key (tuple): key passed to acquire
+        """
+        with self._cond:
+            self._in_flight.discard(key)
+            self._cond.notify_all()
+
+    def pause(self, chat_id: int, seconds: float):
+        """Stops the calls to the chat for the seconds provided, as requested by telegram with a RetryAfter
+
+        Args:
+            chat_id (int): id of the chat. None for the calls with no chat
+            seconds (float): seconds to wait
+        """
+        with self._cond:
+            self._chat(chat_id).pause(seconds)
+
+    def _chat(self, chat_id: int) -> TokenBucket:
+        if chat_id is None:
+            return self._no_chat
+        rate = self.group_rate if chat_id < 0 else self.chat_rate  # groups and channels have negative ids
+        return self._chats.get(chat_id, lambda: TokenBucket(rate, self.chat_burst))
+
+    def _wait_time(self, ticket: _Ticket) -> float:
+        """Seconds the ticket has to wait before checking again. 0 if the call can be made now.
+        The condition must be held
+        """
+        now = time.monotonic()
+        if ticket.key is not None and ticket.key in self._in_flight:
+            return MAX_WAIT_STEP  # woken up by release
+        wait = self._chat(ticket.chat_id).wait_time(now)
+        if wait > 0:
+            return wait
+        ready = (other for other in self._waiting
+                 if other is not ticket and (other.key is None or other.key not in self._in_flight)
+                 and self._chat(other.chat_id).wait_time(now) == 0)
+        if any((other.priority, other.seq) < (ticket.priority, ticket.seq) for other in ready):
+            return MAX_WAIT_STEP  # woken up when the call ahead goes
+        return self._global.wait_time(now)
+
+
+def call_arguments(method: Callable, args: tuple, kwargs: dict) -> dict:
+    """Gets the arguments of a call by their name, whether they were passed by position or by keyword
+
+    Args:
+        method (Callable): method called
+        args (tuple): arguments passed by position
+        kwargs (dict): arguments passed by keyword
+
+    Returns:
+        dict: the arguments passed, by name
+    """
+    positional = (name for name, parameter in inspect.signature(method).parameters.items()
+                  if parameter.kind in (parameter.POSITIONAL_ONLY, parameter.POSITIONAL_OR_KEYWORD))
+    return {**dict(zip(positional, args)), **kwargs}
+
+
+class RateLimitedBot(Bot):
+    """Bot whose messages go through the limiter: send_message, send_photo, edit_message_text, edit_message_media and
+    delete_message. They accept an additional priority keyword argument, PRIORITY_MESSAGE by default.
+    The edits of the same message are made one at a time, and one still waiting is dropped by a newer one, returning None.
+    If telegram answers with a RetryAfter, the chat is paused for the time requested and the call is made again,
+    up to max_retries times
+
+    Args:
+        limiter (ApiLimiter): limiter the calls go through
+        max_retries (int): how many times a call is made again after a RetryAfter
+        args (Any): arguments of Bot
+        kwargs (Any): keyword arguments of Bot
+    """
+
+    def __init__(self, *args, limiter: ApiLimiter, max_retries: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter
+        self.max_retries = max_retries
+
+    def send_message(self, *args, priority: int = PRIORITY_MESSAGE, **kwargs):
+        return self._limited(super().send_message, priority, None, *args, **kwargs)
+
+    def send_photo(self, *args, priority: int = PRIORITY_MESSAGE, **kwargs):
+        return self._limited(super().send_photo, priority, None, *args, **kwargs)
+
+    def edit_message_text(self, *args, priority: int = PRIORITY_MESSAGE, **kwargs):
+        return self._limited(super().edit_message_text, priority, "text", *args, **kwargs)
+
+    def edit_message_media(self, *args, priority: int = PRIORITY_MESSAGE, **kwargs):
+        return self._limited(super().edit_message_media, priority, "media", *args, **kwargs)
+
+    def delete_message(self, *args, priority: int = PRIORITY_MESSAGE, **kwargs):
+        return self._limited(super().delete_message, priority, None, *args, **kwargs)
+
+    def _limited(self, method, priority: int, edit: str, *args, **kwargs):
+        """Makes the call when the limiter allows it
+
+        Args:
+            method (Callable): method of Bot to call
+            priority (int): priority of the call
+            edit (str): what the call edits in the message, if it is an edit. Defaults to None.
+            args (Any): arguments of the method
+            kwargs (Any): keyword arguments of the method
+
+        Returns:
+            Any: result of the method. None if the call has been dropped
+        """
+        arguments = call_arguments(method, args, kwargs)
+        chat_id = arguments.get('chat_id')
+        if chat_id is not None:  # else e.g. an inline message, edited by its inline_message_id
+            try:
+                chat_id = int(chat_id)
+            except ValueError:  # the username of a channel
+                chat_id = 0
+        key = None
+        if edit is not None:
+            if arguments.get('inline_message_id') is not None:
+                key = (edit, arguments['inline_message_id'])
+            else:
+                key = (edit, chat_id, arguments.get('message_id'))
+        for attempt in itertools.count():
+            if not self.limiter.acquire(chat_id, priority, key, retry=attempt > 0):
+                logger.debug("Dropped %s in chat %s, replaced by a newer one", method.__name__, chat_id)
+                return None
+            try:
+                return method(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning("Too many requests in chat %s, retrying in %s s", chat_id, e.retry_after)
+                self.limiter.pause(chat_id, e.retry_after)
+            finally:
+                if key is not None:
+                    self.limiter.release(key)
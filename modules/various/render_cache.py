@@ -0,0 +1,163 @@
+"""Remembers the images already sent, so that an identical image is sent again by its Telegram file_id,
+without rendering or uploading it"""
+import atexit
+import hashlib
+import json
+import logging
+import os
+from threading import Lock
+from modules.data.data_reader import config_map, get_abs_path
+from modules.various.asset_cache import get_asset_version
+from modules.various.lru_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1  # part of every key: change it when the rendering changes, so the old images are not reused
+
+RENDER_SETTINGS = ("blur", "blur_mode", "font_size_caption", "font_size_title", "preview_scale")  # image settings used
+
+
+def render_key(data: dict, final: bool) -> str:
+    """Builds the key of the image, hashing everything that can change how it looks.
+    The background sent by the user is identified by the file_unique_id telegram gave it (see background_msg),
+    the template and its default background by their version on the disk
+
+    Args:
+        data (dict): {'title': title of the image, 'caption': caption of the image, 'template': template to be used,
+            'resize_mode': how to resize the image, 'background_offset': offset used to crop the image,
+            'background_unique_id': file_unique_id of the background, None for the default one}
+        final (bool): whether the user has finished adjusting the image
+
+    Returns:
+        str: key of the image. None if the background is unknown, so the image can't be cached
+    """
+    if 'background_unique_id' not in data:  # an image started before the background was identified
+        return None
+    preview = not final and data['resize_mode'] != "scale"
+    inputs = {
+        'version': CACHE_VERSION,
+        'title': data['title'],
+        'caption': data['caption'],
+        'template': data['template'],
+        'assets': get_asset_version(data['template']),
+        'resize_mode': data['resize_mode'],
+        'background_offset': data.get('background_offset') if data['resize_mode'] != "scale" else None,
+        'background': data['background_unique_id'],
+        'background_scale': data.get('background_scale', 1),
+        'preview': preview,
+        'image': {setting: config_map['image'][setting] for setting in RENDER_SETTINGS},
+        'encoder': config_map['encoder']["preview" if preview else "final"],
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+class RenderCache:
+    """Bounded map from the key of an image to the file_id Telegram assigned to it when it was first sent.
+    The entries are loaded from the file when the cache is created and saved back by save
+
+    Args:
+        max_size (int): how many file_ids are kept. The least recently used ones are discarded first
+        path (str): file where the entries are kept between restarts
+    """
+
+    def __init__(self, max_size: int, path: str):
+        self.path = path
+        self._files = LRUCache(max_size)
+        self._dirty = False
+        self._lock = Lock()
+        self.load()
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def get(self, key: str) -> str:
+        """Gets the file_id of the image
+
+        Args:
+            key (str): key of the image, built by render_key
+
+        Returns:
+            str: file_id of the image. None if it has never been sent
+        """
+        return self._files.peek(key)
+
+    def put(self, key: str, file_id: str):
+        """Stores the file_id of an image that has just been sent
+
+        Args:
+            key (str): key of the image, built by render_key
+            file_id (str): file_id assigned by Telegram
+        """
+        self._files.put(key, file_id)
+        self._dirty = True
+
+    def discard(self, key: str):
+        """Forgets the image, for example because Telegram no longer accepts its file_id
+
+        Args:
+            key (str): key of the image, built by render_key
+        """
+        if self._files.pop(key) is not None:
+            self._dirty = True
+
+    def load(self):
+        """Loads the entries saved in the file, if it exists
+        """
+        try:
+            with open(self.path, "r", encoding="utf8") as cache_file:
+                entries = json.load(cache_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Could not load the render cache: %s", e)
+            return
+        for key, file_id in entries:  # from the least to the most recently used
+            self._files.put(key, file_id)
+
+    def save(self):
+        """Saves the entries in the file, if they have changed since they were loaded or last saved.
+        The file is replaced atomically, so a crash can't leave it half written
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            tmp_path = self.path + ".tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf8") as cache_file:
+                    json.dump(self._files.items(), cache_file)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logger.error("Could not save the render cache: %s", e)
+
+
+_cache = None
+_cache_lock = Lock()
+
+
+def get_render_cache() -> RenderCache:
+    """Gets the render cache, loading it the first time it is needed.
+    If the cache_size render setting is 0, the cache is disabled
+
+    Returns:
+        RenderCache: the render cache. None if it is disabled
+    """
+    global _cache  # pylint: disable=global-statement
+    if config_map['render']['cache_size'] <= 0:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = RenderCache(max_size=config_map['render']['cache_size'],
+                                 path=get_abs_path("data", "render_cache.json"))
+            atexit.register(close_render_cache)
+        return _cache
+
+
+def close_render_cache():
+    """Saves the render cache, if it was loaded
+    """
+    global _cache  # pylint: disable=global-statement
+    with _cache_lock:
+        if _cache is not None:
+            _cache.save()
+            _cache = None
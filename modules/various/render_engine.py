@@ -0,0 +1,242 @@
+"""Bounded pool of workers used to create the images outside of the dispatcher thread"""
+import logging
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from typing import Any, Callable
+from modules.data.data_reader import config_map
+from modules.debug.metrics import collect, merge
+
+logger = logging.getLogger(__name__)
+
+
+class RenderBusyError(Exception):
+    """Raised when the queue of the render engine is full and a new job can't be accepted"""
+
+
+class RenderEngine:
+    """Runs the jobs on a bounded pool of workers.
+    At most workers + queue_size jobs can be running or waiting at the same time: the following ones are refused,
+    unless they are submitted with wait, in which case they are started as soon as one of the others is done.
+    With processes, each worker is a separate process and the jobs with the same key always run on the same worker,
+    so whatever a worker keeps in memory for a key (like a RenderSession) can be reused by the next job.
+    The processes are started from a clean server process instead of being forked from the bot, since a fork could
+    copy a lock held by one of its threads.
+    The callbacks run on a separate pool of threads, so that sending an image doesn't delay the next job
+
+    Args:
+        workers (int): number of workers. If <= 0, the number of cpus is used
+        queue_size (int): how many jobs can wait for a free worker
+        processes (bool): whether the workers are processes or threads
+    """
+
+    def __init__(self, workers: int, queue_size: int, processes: bool):
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.capacity = self.workers + max(queue_size, 0)
+        self.processes = processes
+        if processes:
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            context = multiprocessing.get_context(start_method)
+            self._executors = [ProcessPoolExecutor(max_workers=1, mp_context=context) for _ in range(self.workers)]
+        else:
+            self._executors = [ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="render")]
+        # a callback for each job that can be running or waiting, since each one holds its slot until it is done
+        self._callbacks = ThreadPoolExecutor(max_workers=self.capacity, thread_name_prefix="render_callback")
+        self._slots = BoundedSemaphore(self.capacity)
+        self._waiting = deque()  # jobs submitted with wait while the engine was full, started as slots are freed
+        self._pending = 0
+        self._lock = Lock()
+
+    @property
+    def pending(self) -> int:
+        """Number of jobs running or waiting for a worker"""
+        return self._pending
+
+    def submit(self, key: int, fn: Callable, *args: Any, callback: Callable[[Future], None] = None,
+               wait: bool = False) -> Future:
+        """Submits the job to the worker associated with the key.
+        The callback is called, in the main process and on a thread of its own, with the future of the job once it is done.
+        With processes, the durations measured by the worker are added to the metrics of the main process
+
+        Args:
+            key (int): key of the job, usually the id of the user
+            fn (Callable): function to execute. With processes it must be picklable, as must its arguments
+            args (Any): arguments passed to the function
+            callback (Callable[[Future], None], optional): called when the job is done. Defaults to None.
+            wait (bool, optional): whether a job that finds the engine full waits for a free slot instead of being
+                refused. Meant for the jobs the user has already been told about. Defaults to False.
+
+        Raises:
+            RenderBusyError: the engine is already handling as many jobs as it can, and wait is False
+
+        Returns:
+            Future: future of the job. With processes, its result also contains the durations measured by the worker.
+                None if the job is waiting for a free slot
+        """
+        if not self._slots.acquire(blocking=False):
+            if not wait:
+                raise RenderBusyError(f"{self.capacity} jobs are already running or waiting")
+            with self._lock:  # a slot freed after the first attempt is either taken here or given to the job by _release
+                if not self._slots.acquire(blocking=False):
+                    self._waiting.append((key, fn, args, callback))
+                    return None
+        return self._start(key, fn, args, callback)
+
+    def _start(self, key: int, fn: Callable, args: tuple, callback: Callable[[Future], None]) -> Future:
+        """Submits the job to its worker, once it has a slot
+
+        Args:
+            key (int): key of the job
+            fn (Callable): function to execute
+            args (tuple): arguments passed to the function
+            callback (Callable[[Future], None]): called when the job is done
+
+        Returns:
+            Future: future of the job
+        """
+        with self._lock:
+            self._pending += 1
+
+        def run_callback(future: Future):
+            try:
+                if self.processes:
+                    future = unwrap_metrics(future)
+                if callback is not None:
+                    callback(future)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Render callback failed: %s", e)
+            finally:
+                self._release()
+
+        def done(future: Future):  # called by the thread that collects the results of the worker
+            try:
+                self._callbacks.submit(run_callback, future)
+            except RuntimeError as e:  # the engine is shutting down
+                logger.error("Render callback dropped: %s", e)
+                self._release()
+
+        try:
+            if self.processes:
+                future = self._executor(key).submit(collect, fn, *args)
+            else:
+                future = self._executor(key).submit(fn, *args)
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(done)
+        return future
+
+    def run(self, key: int, fn: Callable, *args: Any) -> Future:
+        """Executes the job on the worker associated with the key, ignoring the limit on the number of jobs.
+        Meant for quick maintenance jobs, like discarding what a worker keeps in memory
+
+        Args:
+            key (int): key of the job, usually the id of the user
+            fn (Callable): function to execute
+            args (Any): arguments passed to the function
+
+        Returns:
+            Future: future of the job
+        """
+        return self._executor(key).submit(fn, *args)
+
+    def run_on_all(self, fn: Callable, *args: Any) -> list:
+        """Executes the job once on each executor, ignoring the limit on the number of jobs.
+        Meant to discard what the worker processes keep in memory. With threads, the job runs only once
+
+        Args:
+            fn (Callable): function to execute
+            args (Any): arguments passed to the function
+
+        Returns:
+            list: futures of the jobs
+        """
+        return [executor.submit(fn, *args) for executor in self._executors]
+
+    def shutdown(self, wait: bool = True):
+        """Stops all the workers
+
+        Args:
+            wait (bool, optional): whether to wait for the running jobs to finish. Defaults to True.
+        """
+        for executor in self._executors:
+            executor.shutdown(wait=wait)
+        self._callbacks.shutdown(wait=wait)
+
+    def _release(self):
+        """Frees the slot used by a job, or gives it to the first job waiting for one
+        """
+        with self._lock:
+            self._pending -= 1
+            following = self._waiting.popleft() if self._waiting else None
+            if following is None:
+                self._slots.release()
+        if following is not None:
+            try:
+                self._start(*following)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Waiting render dropped: %s", e)
+
+    def _executor(self, key: int):
+        """Gets the executor the jobs with the key are submitted to
+        """
+        return self._executors[hash(key) % len(self._executors)]
+
+
+def unwrap_metrics(future: Future) -> Future:
+    """Adds the durations measured by a worker process to the metrics, leaving only the result of the job
+
+    Args:
+        future (Future): future of a job submitted to a worker process
+
+    Returns:
+        Future: future with the result of the job
+    """
+    unwrapped = Future()
+    if future.exception() is not None:
+        unwrapped.set_exception(future.exception())
+    else:
+        result, states = future.result()
+        merge(states)
+        unwrapped.set_result(result)
+    return unwrapped
+
+
+_engine = None
+_engine_lock = Lock()
+
+
+def get_engine() -> RenderEngine:
+    """Gets the render engine, creating it with the render settings the first time it is needed
+
+    Returns:
+        RenderEngine: the render engine
+    """
+    global _engine  # pylint: disable=global-statement
+    with _engine_lock:
+        if _engine is None:
+            _engine = RenderEngine(workers=config_map['render']['workers'],
+                                   queue_size=config_map['render']['queue_size'],
+                                   processes=config_map['render']['processes'])
+        return _engine
+
+
+def engine_started() -> bool:
+    """Whether the render engine has already been created
+
+    Returns:
+        bool: True if the engine is running
+    """
+    return _engine is not None
+
+
+def shutdown_engine():
+    """Stops the render engine, if it was started
+    """
+    global _engine  # pylint: disable=global-statement
+    with _engine_lock:
+        if _engine is not None:
+            _engine.shutdown()
+            _engine = None
@@ -0,0 +1,68 @@
+"""Keeps the state of each image creation, so the work that doesn't change between renders is done only once"""
+from threading import Lock
+from typing import Any, Callable, Hashable
+from modules.data.data_reader import config_map
+from modules.various.lru_cache import LRUCache
+
+
+class RenderSession:
+    """Objects shared by all the renders of the same image creation, like the prepared background.
+    Each object is stored with a key that describes how it was created: if the key changes, the object is created again
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = Lock()
+
+    def get(self, name: str, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """Gets the object stored with the name, if it was created with the same key. Otherwise it is created with the loader
+
+        Args:
+            name (str): name of the object
+            key (Hashable): describes how the object was created
+            loader (Callable[[], Any]): function called to create the object
+
+        Returns:
+            Any: the requested object
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+
+        value = loader()
+        with self._lock:
+            self._entries[name] = (key, value)
+        return value
+
+    def clear(self):
+        """Discards all the objects in the session
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+_sessions = LRUCache(config_map['image']['session_cache_size'])
+
+
+def get_session(sender_id: int) -> RenderSession:
+    """Gets the render session of the user, creating it if needed
+
+    Args:
+        sender_id (int): id of the user
+
+    Returns:
+        RenderSession: session of the user
+    """
+    return _sessions.get(sender_id, RenderSession)
+
+
+def clear_session(sender_id: int):
+    """Discards the render session of the user, freeing the memory it used
+
+    Args:
+        sender_id (int): id of the user
+    """
+    session = _sessions.pop(sender_id)
+    if session is not None:
+        session.clear()
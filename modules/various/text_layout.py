@@ -0,0 +1,92 @@
+"""Splits the text in lines and computes where each line goes, caching the result"""
+from typing import List
+from PIL import ImageFont
+from modules.data.data_reader import config_map
+from modules.various.font_registry import FONT_PATH, get_font
+from modules.various.lru_cache import LRUCache
+
+_layouts = LRUCache(config_map['image']['layout_cache_size'])
+
+
+class TextLayout:
+    """Lines of a text, ready to be drawn.
+    The positions are relative to the point where the text begins, horizontally centered on 0
+
+    Args:
+        lines (List[str]): lines of the text
+        xs (List[float]): horizontal position of each line
+        ys (List[float]): vertical position of each line
+        height (float): total height of the text, spacing after the last line included
+    """
+
+    def __init__(self, lines: List[str], xs: List[float], ys: List[float], height: float):
+        self.lines = lines
+        self.xs = xs
+        self.ys = ys
+        self.height = height
+
+
+def wrap_text(text: str, max_w: int, font: ImageFont.FreeTypeFont) -> list:
+    """Wraps the text so that no line is longer than the max width allowed.
+    Each word is measured only once, and the width of a line is the sum of the widths of its words and spaces
+
+    Args:
+        text (str): text to wrap
+        max_w (int): max width the text is allowed to be
+        font (FreeTypeFont): font the text will use
+
+    Returns:
+        list: list of lines (str)
+    """
+    if font.getsize(text)[0] < max_w:
+        return [text]
+
+    lines = []
+    space_w = font.getsize(" ")[0]
+    word_widths = {}
+    for row in text.split("\n"):
+        line = []
+        line_w = 0
+        for word in row.split():
+            if word not in word_widths:
+                word_widths[word] = font.getsize(word)[0]
+            word_w = word_widths[word]
+            if not line:
+                line, line_w = [word], word_w
+            elif line_w + space_w + word_w < max_w:
+                line.append(word)
+                line_w += space_w + word_w
+            else:
+                lines.append(" ".join(line))
+                line, line_w = [word], word_w
+        if line:
+            lines.append(" ".join(line))
+    return lines
+
+
+def layout_text(text: str, max_w: float, font_size: int, spacing: float = 5, font_path: str = FONT_PATH) -> TextLayout:
+    """Gets the layout of the text. It is computed only the first time, then it is taken from the cache
+
+    Args:
+        text (str): text to lay out
+        max_w (float): max width the text is allowed to be
+        font_size (int): size of the font
+        spacing (float, optional): space between the lines. Defaults to 5.
+        font_path (str, optional): path of the font file. Defaults to FONT_PATH.
+
+    Returns:
+        TextLayout: layout of the text
+    """
+    def compute_layout() -> TextLayout:
+        font = get_font(size=font_size, font_path=font_path)
+        lines = wrap_text(text=text, max_w=max_w, font=font)
+        xs, ys = [], []
+        y = 0
+        for line in lines:
+            t_w, t_h = font.getsize(line)
+            xs.append(-t_w / 2)
+            ys.append(y)
+            y += t_h + spacing
+        return TextLayout(lines=lines, xs=xs, ys=ys, height=y)
+
+    return _layouts.get((text, max_w, font_size, spacing, font_path), compute_layout)
@@ -0,0 +1,236 @@
+"""Handles the updates on a pool of workers, so that a slow chat doesn't hold up the others"""
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import BoundedSemaphore, Condition
+from typing import Callable
+from telegram import Update
+from telegram.ext import BasePersistence, Dispatcher, JobQueue, Updater
+from modules.data.data_reader import config_map
+from modules.debug.metrics import is_sampled, observe, register_gauge
+from modules.various.api_request import PooledRequest
+from modules.various.rate_limiter import ApiLimiter, RateLimitedBot
+
+logger = logging.getLogger(__name__)
+
+
+class UpdatePool:
+    """Bounded pool of workers for the updates.
+    The updates with the same key (the chat) wait in a queue of their own, and only the first one is given to the
+    workers: when it is done, the next one of the same chat is given to them, behind the updates of the other chats.
+    This way the updates of a chat are handled one at a time, in the order they arrived,
+    and a slow chat only holds up a single worker, never the updates of the other chats.
+    At most workers + queue_size updates can be running or waiting: after that, submit waits for a free slot
+
+    Args:
+        workers (int): number of workers. If <= 0, the number of cpus is used
+        queue_size (int): how many updates can wait for a worker
+    """
+
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.capacity = self.workers + max(queue_size, 0)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="update")
+        self._slots = BoundedSemaphore(self.capacity)
+        self._queues = {}  # key -> deque of (run, args) of the updates waiting for the one of the same chat being handled
+        self._pending = 0
+        self._lock = Condition()
+
+    @property
+    def pending(self) -> int:
+        """Number of updates being handled or waiting for a worker"""
+        return self._pending
+
+    def submit(self, key: int, fn: Callable, *args):
+        """Queues the function behind the ones with the same key, waiting if the pool is full
+
+        Args:
+            key (int): key of the update, the id of the chat
+            fn (Callable): function to execute
+            args (Any): arguments passed to the function
+        """
+        self._slots.acquire()
+        queued = time.perf_counter() if is_sampled() else None
+
+        def run():
+            if queued is not None:
+                observe("dispatcher.queue_wait", time.perf_counter() - queued)
+            fn(*args)
+
+        with self._lock:
+            self._pending += 1
+            if key in self._queues:  # an update of the same chat is being handled
+                self._queues[key].append((run, args))
+                return
+            self._queues[key] = deque()
+        self._schedule(key, run)
+
+    def waiting(self, key: int) -> list:
+        """Gets the updates with the key that are waiting for the one being handled, so that a handler can skip
+        the work a newer update would replace
+
+        Args:
+            key (int): key of the updates, the id of the chat
+
+        Returns:
+            list: the arguments of each update waiting, from the oldest
+        """
+        with self._lock:
+            return [args for _, args in self._queues.get(key, ())]
+
+    def _schedule(self, key: int, run: Callable):
+        """Gives the update to the workers. If the pool has been shut down, the update and the ones of the same chat
+        still waiting are discarded
+
+        Args:
+            key (int): key of the update
+            run (Callable): the update
+        """
+        try:
+            self._executor.submit(self._run, key, run)
+        except RuntimeError:
+            with self._lock:
+                discarded = 1 + len(self._queues.pop(key))
+            logger.warning("Discarded %d updates of chat %s, the pool has been shut down", discarded, key)
+            for _ in range(discarded):
+                self._done()
+
+    def _run(self, key: int, run: Callable):
+        """Handles the update, then schedules the next one with the same key
+
+        Args:
+            key (int): key of the update
+            run (Callable): the update
+        """
+        try:
+            run()
+        finally:
+            with self._lock:
+                queue = self._queues[key]
+                following = queue.popleft()[0] if queue else None
+                if following is None:
+                    del self._queues[key]
+            self._done()
+            if following is not None:
+                self._schedule(key, following)
+
+    def _done(self):
+        """Frees the slot of an update that is no longer pending"""
+        with self._lock:
+            self._pending -= 1
+            self._lock.notify_all()
+        self._slots.release()
+
+    def shutdown(self, wait: bool = True):
+        """Stops all the workers
+
+        Args:
+            wait (bool, optional): whether to wait for the updates already queued. Defaults to True.
+        """
+        if wait:  # the updates still waiting in the queue of their chat are scheduled only after the previous one
+            with self._lock:
+                self._lock.wait_for(lambda: self._pending == 0)
+        self._executor.shutdown(wait=wait)
+
+
+class PooledDispatcher(Dispatcher):
+    """Dispatcher that handles each update on the update pool, instead of its own thread.
+    The updates without a chat, and the errors, are still handled by the dispatcher thread
+
+    Args:
+        pool (UpdatePool): pool the updates are handled by
+        args (Any): arguments of Dispatcher
+        kwargs (Any): keyword arguments of Dispatcher
+    """
+
+    def __init__(self, *args, pool: UpdatePool, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = pool
+
+    def process_update(self, update):
+        if isinstance(update, Update) and update.effective_chat is not None:
+            self.pool.submit(update.effective_chat.id, super().process_update, update)
+        else:
+            super().process_update(update)
+
+    def stop(self):
+        super().stop()
+        self.pool.shutdown(wait=True)
+        if self.persistence is not None:  # the updates handled after the last flush
+            self.update_persistence()
+            self.persistence.flush()
+
+
+def create_updater(token: str,
+                   persistence: BasePersistence = None,
+                   request_kwargs: dict = None,
+                   base_url: str = None,
+                   base_file_url: str = None) -> Updater:
+    """Creates the updater, with a dispatcher that handles the updates on a pool sized by the dispatcher settings.
+    The bot uses the connections to the Bot API described by the api settings,
+    and its messages are kept within the limits of the rate_limit settings.
+    Unless the con_pool_size api setting says otherwise, there is a connection for each worker of the pool
+    and for each job the render engine can hold, since each job has a callback that sends its image
+
+    Args:
+        token (str): token of the bot
+        persistence (BasePersistence, optional): persistence of the dispatcher. Defaults to None.
+        request_kwargs (dict, optional): arguments of the PooledRequest used by the bot, overriding the api settings.
+            Defaults to None.
+        base_url (str, optional): url of the Bot API. Defaults to the base_url api setting.
+        base_file_url (str, optional): url used to download the files. Defaults to None.
+
+    Returns:
+        Updater: the updater
+    """
+    pool = UpdatePool(workers=config_map['dispatcher']['workers'], queue_size=config_map['dispatcher']['queue_size'])
+    render = config_map['render']
+    # the render engine runs a callback for each job running or waiting (see RenderEngine)
+    render_capacity = (render['workers'] if render['workers'] > 0 else (os.cpu_count() or 1)) + max(render['queue_size'], 0)
+    settings = config_map['api']
+    # a connection for each worker of the pool and for each render callback, plus the polling, the job queue,
+    # the dispatcher thread and the main thread
+    con_pool_size = settings['con_pool_size'] if settings['con_pool_size'] > 0 else pool.workers + render_capacity + 4
+    request_kwargs = {
+        'con_pool_size': con_pool_size,
+        'proxy_url': settings['proxy_url'] or None,
+        'connect_timeout': settings['connect_timeout'],
+        'read_timeout': settings['read_timeout'],
+        **(request_kwargs or {})
+    }
+    request = PooledRequest(**request_kwargs)
+    limits = config_map['rate_limit']
+    limiter = ApiLimiter(global_rate=limits['global_rate'],
+                         global_burst=limits['global_burst'],
+                         chat_rate=limits['chat_rate'],
+                         group_rate=limits['group_rate'],
+                         chat_burst=limits['chat_burst'])
+    bot = RateLimitedBot(token,
+                         base_url=base_url or settings['base_url'] or None,
+                         base_file_url=base_file_url,
+                         request=request,
+                         limiter=limiter,
+                         max_retries=limits['max_retries'])
+    job_queue = JobQueue()
+    dispatcher = PooledDispatcher(bot,
+                                  Queue(),
+                                  job_queue=job_queue,
+                                  workers=0,  # the pool takes the place of the run_async workers
+                                  persistence=persistence,
+                                  use_context=True,
+                                  pool=pool)
+    job_queue.set_dispatcher(dispatcher)
+
+    register_gauge("newsgen_dispatcher_workers", "Workers handling the updates.", lambda: pool.workers)
+    register_gauge("newsgen_dispatcher_pending_updates", "Updates being handled or waiting for a worker.",
+                   lambda: pool.pending)
+    register_gauge("newsgen_api_connections", "Connections kept alive for each host of the Bot API.",
+                   lambda: request.con_pool_size)
+    register_gauge("newsgen_api_waiting_calls", "Calls to the Bot API waiting for the rate limit.",
+                   lambda: limiter.waiting)
+    register_gauge("newsgen_api_dropped_calls", "Obsolete calls to the Bot API dropped while waiting.",
+                   lambda: limiter.dropped)
+    return Updater(dispatcher=dispatcher, workers=None, use_context=True)
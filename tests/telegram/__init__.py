@@ -0,0 +1 @@
+"""Tests the bot through telegram"""
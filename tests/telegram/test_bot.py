@@ -257,7 +257,7 @@ async def test_create_crop_conversation(client: TelegramClient):
         assert resp.photo is not None
 
         await resp.click(text="⬆️")  # click inline keyboard
-        resp: Message = await conv.get_response()
+        resp: Message = await conv.get_edit()
 
         assert resp.photo is not None
 
@@ -313,7 +313,7 @@ async def test_create_random_conversation(client: TelegramClient):
         assert resp.photo is not None
 
         await resp.click(text="No, ritenta")  # click inline keyboard
-        resp: Message = await conv.get_response()
+        resp: Message = await conv.get_edit()
 
         assert resp.photo is not None
 
@@ -415,7 +415,7 @@ async def test_create_crop_thread_conversation(client: TelegramClient):
         assert resp.photo is not None
 
         await resp.click(text="⬆️")  # click inline keyboard
-        resp: Message = await conv.get_response()
+        resp: Message = await conv.get_edit()
 
         assert resp.photo is not None
 
@@ -471,7 +471,7 @@ async def test_create_random_thread_conversation(client: TelegramClient):
         assert resp.photo is not None
 
         await resp.click(text="No, ritenta")  # click inline keyboard
-        resp: Message = await conv.get_response()
+        resp: Message = await conv.get_edit()
 
         assert resp.photo is not None
 
@@ -0,0 +1 @@
+"""Tests the modules of the bot, offline"""
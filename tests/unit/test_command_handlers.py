@@ -0,0 +1,36 @@
+"""Tests the handlers of the messages, with fake updates"""
+from types import SimpleNamespace
+from telegram import PhotoSize
+from modules.commands.command_handlers import STATE, background_msg
+from modules.data.data_reader import config_map
+from modules.various import photo_utils
+from modules.various.image_store import load_background
+from modules.various.job_registry import JobRegistry
+
+
+def test_background_refused(tmp_path, monkeypatch):
+    """Tests that the background of an image refused because too many are in progress is not kept
+
+    Args:
+        tmp_path (Path): temporary directory, in place of data/img
+        monkeypatch (MonkeyPatch): used to restore the modules
+    """
+    monkeypatch.setitem(config_map, 'image', dict(config_map['image'], in_memory=True))
+    jobs = JobRegistry(max_jobs=1, job_timeout=60, render_timeout=60)
+    jobs.begin_render(2)  # the image of another user
+    monkeypatch.setattr(photo_utils, "_jobs", jobs)
+    monkeypatch.setattr(photo_utils, "build_bg_path", lambda sender_id: str(tmp_path / f"bg_{sender_id}.png"))
+    monkeypatch.setattr(photo_utils, "build_photo_path", lambda sender_id: str(tmp_path / f"{sender_id}.png"))
+    sent = []
+    bot = SimpleNamespace(getFile=lambda file_id: SimpleNamespace(file_path=f"https://example.org/{file_id}"),
+                          request=SimpleNamespace(retrieve=lambda url: b"background"),
+                          send_message=lambda text, **kwargs: sent.append(text))
+    message = SimpleNamespace(chat_id=1, text=None, message_id=10, from_user=SimpleNamespace(id=1, first_name="User"),
+                              photo=[PhotoSize("photo", "unique", 1280, 853)])
+    context = SimpleNamespace(bot=bot, user_data={'title': "Title", 'caption': "Caption", 'template': "DMI",
+                                                  'resize_mode': "crop", 'background_offset': {'x': 0, 'y': 0}})
+
+    assert background_msg(SimpleNamespace(message=message), context) == STATE['background']
+    assert load_background(1) is None
+    assert not jobs.has_job(1)
+    assert len(sent) == 2  # the background has been received, but the bot is too busy
@@ -0,0 +1,92 @@
+"""Tests the reading of the markdown responses"""
+import os
+import pytest
+from modules.data import data_reader
+from modules.data.data_reader import check_markdown, read_md, reload_markdown
+
+
+@pytest.fixture
+def markdown_dir(tmp_path, monkeypatch) -> str:
+    """Makes data_reader read the files from a temporary directory, with an empty cache
+
+    Args:
+        tmp_path (Path): temporary directory, in place of the root of the project
+        monkeypatch (MonkeyPatch): used to restore the module
+
+    Returns:
+        str: directory of the markdown files
+    """
+    directory = tmp_path / "data" / "markdown"
+    directory.mkdir(parents=True)
+    monkeypatch.setattr(data_reader, "get_abs_path", lambda *path: os.path.join(str(tmp_path), *path))
+    monkeypatch.setattr(data_reader, "_markdown", {})
+    monkeypatch.setattr(data_reader, "_markdown_checked", 0.0)
+    return str(directory)
+
+
+def write_md(directory: str, file_name: str, text: str, mtime: float):
+    """Writes the markdown file, with the modification time provided
+
+    Args:
+        directory (str): directory of the markdown files
+        file_name (str): name of the file, without extension
+        text (str): contents of the file
+        mtime (float): modification time of the file
+    """
+    path = os.path.join(directory, file_name + ".md")
+    with open(path, "w", encoding="utf-8") as md_file:
+        md_file.write(text)
+    os.utime(path, (mtime, mtime))
+
+
+def test_read(markdown_dir: str):
+    """Tests that the files are read, without the surrounding whitespace
+
+    Args:
+        markdown_dir (str): directory of the markdown files
+    """
+    write_md(markdown_dir, "start", "  *Hello*\n", 1000)
+    assert read_md("start") == "*Hello*"
+    with pytest.raises(FileNotFoundError):
+        read_md("missing")
+
+
+def test_modified(markdown_dir: str):
+    """Tests that a modified file is read again by the next check, and kept in memory until then
+
+    Args:
+        markdown_dir (str): directory of the markdown files
+    """
+    write_md(markdown_dir, "start", "First", 1000)
+    assert read_md("start") == "First"
+    write_md(markdown_dir, "start", "Second", 2000)
+    assert read_md("start") == "First"  # checked less than MARKDOWN_CHECK_INTERVAL seconds ago
+    check_markdown(force=True)
+    assert read_md("start") == "Second"
+
+
+def test_new_file(markdown_dir: str):
+    """Tests that a file added after the last check is read directly
+
+    Args:
+        markdown_dir (str): directory of the markdown files
+    """
+    write_md(markdown_dir, "start", "Start", 1000)
+    assert read_md("start") == "Start"
+    write_md(markdown_dir, "help", "Help", 1000)
+    assert read_md("help") == "Help"
+
+
+def test_reload(markdown_dir: str):
+    """Tests that reload_markdown reads the files again, even if their modification time is the same
+
+    Args:
+        markdown_dir (str): directory of the markdown files
+    """
+    write_md(markdown_dir, "start", "First", 1000)
+    assert read_md("start") == "First"
+    write_md(markdown_dir, "start", "Second", 1000)
+    check_markdown(force=True)
+    assert read_md("start") == "First"
+    reload_markdown()
+    assert read_md("start") == "Second"
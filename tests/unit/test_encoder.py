@@ -0,0 +1,113 @@
+"""Tests the encoder of the images"""
+from io import BytesIO
+import pytest
+from PIL import Image
+from modules.data.data_reader import config_map
+from modules.various import encoder
+from modules.various.encoder import encode_image, get_encoder_options
+
+
+@pytest.fixture
+def encoder_config(monkeypatch) -> dict:
+    """Encoder settings that can be changed by the test, restored afterwards
+
+    Args:
+        monkeypatch (MonkeyPatch): used to restore the settings
+
+    Returns:
+        dict: encoder settings, by purpose
+    """
+    settings = {
+        'final': {'format': "PNG", 'quality': 95, 'optimize': False, 'progressive': False, 'compress_level': 6},
+        'preview': {'format': "JPEG", 'quality': 80, 'optimize': False, 'progressive': False, 'compress_level': 1},
+    }
+    monkeypatch.setitem(config_map, 'encoder', settings)
+    return settings
+
+
+def create_image() -> Image.Image:
+    """Creates an image with an alpha channel and some detail, so that the quality changes its size
+
+    Returns:
+        Image: the image
+    """
+    im = Image.radial_gradient("L").resize((400, 300))
+    return Image.merge("RGBA", (im, im.rotate(90), im.transpose(Image.FLIP_LEFT_RIGHT), Image.new("L", im.size, 255)))
+
+
+def encode(im: Image.Image, purpose: str) -> tuple:
+    """Encodes the image in memory
+
+    Args:
+        im (Image): image to encode
+        purpose (str): "preview" or "final"
+
+    Returns:
+        tuple: (format returned by encode_image, bytes of the image)
+    """
+    buffer = BytesIO()
+    fmt = encode_image(im, buffer, purpose)
+    return fmt, buffer.getvalue()
+
+
+def test_purpose(encoder_config: dict):
+    """Tests that each purpose uses its own settings
+
+    Args:
+        encoder_config (dict): encoder settings
+    """
+    fmt, data = encode(create_image(), "final")
+    assert fmt == "PNG"
+    assert Image.open(BytesIO(data)).format == "PNG"
+    assert Image.open(BytesIO(data)).mode == "RGBA"
+
+    fmt, data = encode(create_image(), "preview")
+    assert fmt == "JPEG"
+    assert Image.open(BytesIO(data)).format == "JPEG"
+    assert Image.open(BytesIO(data)).mode == "RGB"  # JPEG has no alpha channel
+
+
+def test_quality(encoder_config: dict):
+    """Tests that a lower quality gives a smaller image
+
+    Args:
+        encoder_config (dict): encoder settings
+    """
+    _, high = encode(create_image(), "preview")
+    encoder_config['preview']['quality'] = 20
+    _, low = encode(create_image(), "preview")
+    assert len(low) < len(high)
+
+
+def test_unsupported_format(encoder_config: dict):
+    """Tests that a format that is not supported is refused
+
+    Args:
+        encoder_config (dict): encoder settings
+    """
+    encoder_config['final']['format'] = "GIF"
+    with pytest.raises(ValueError):
+        encode(create_image(), "final")
+
+
+def test_webp_fallback(encoder_config: dict, monkeypatch):
+    """Tests that PNG is used when Pillow doesn't support WEBP
+
+    Args:
+        encoder_config (dict): encoder settings
+        monkeypatch (MonkeyPatch): used to pretend that WEBP is not supported
+    """
+    encoder_config['final']['format'] = "webp"
+    monkeypatch.setattr(encoder.features, "check", lambda feature: False)
+    fmt, data = encode(create_image(), "final")
+    assert fmt == "PNG"
+    assert Image.open(BytesIO(data)).format == "PNG"
+
+
+def test_encoder_options():
+    """Tests that only the options that apply to each format are passed to Pillow
+    """
+    settings = {'quality': 70, 'optimize': True, 'progressive': True, 'compress_level': 3}
+    assert get_encoder_options("JPEG", settings) == {'quality': 70, 'optimize': True, 'progressive': True}
+    assert get_encoder_options("WEBP", settings) == {'quality': 70, 'method': 6}
+    assert get_encoder_options("PNG", settings) == {'optimize': True, 'compress_level': 3}
@@ -0,0 +1,116 @@
+"""Tests the registry of the images in progress"""
+import pytest
+from modules.various.job_registry import JobLimitError, JobRegistry
+
+
+def create_registry(max_jobs: int = 0, job_timeout: float = 60, render_timeout: float = 60, on_expire=None) -> JobRegistry:
+    """Creates a registry, with timeouts long enough not to expire during a test
+
+    Args:
+        max_jobs (int, optional): how many images can be in progress at the same time. Defaults to 0 (no limit).
+        job_timeout (float, optional): seconds of inactivity after which an image expires. Defaults to 60.
+        render_timeout (float, optional): seconds after which a render in flight is considered lost. Defaults to 60.
+        on_expire (Callable[[int], None], optional): called when an image expires. Defaults to None.
+
+    Returns:
+        JobRegistry: the registry
+    """
+    return JobRegistry(max_jobs=max_jobs, job_timeout=job_timeout, render_timeout=render_timeout, on_expire=on_expire)
+
+
+def test_one_render_at_a_time():
+    """Tests that a user can't start a render while another one is in flight
+    """
+    registry = create_registry()
+    assert registry.begin_render(1)
+    assert registry.has_job(1)
+    assert not registry.begin_render(1)
+    assert registry.begin_render(2)  # another user is not affected
+    assert registry.end_render(1) is None
+    assert registry.begin_render(1)
+    assert len(registry) == 2
+
+
+def test_max_jobs():
+    """Tests that a new image is refused when too many are in progress, but the ones in progress can go on
+    """
+    registry = create_registry(max_jobs=1)
+    assert registry.begin_render(1)
+    with pytest.raises(JobLimitError):
+        registry.begin_render(2)
+    registry.end_render(1)
+    assert registry.begin_render(1)
+    registry.finish(1)
+    assert registry.begin_render(2)
+
+
+def test_lost_render():
+    """Tests that a render taking longer than render_timeout doesn't lock the user out
+    """
+    registry = create_registry(render_timeout=0)
+    assert registry.begin_render(1)
+    assert registry.begin_render(1)
+
+
+def test_defer():
+    """Tests that the requests made while rendering are kept, and only the last one is returned by end_render
+    """
+    registry = create_registry()
+    assert not registry.defer(1, lambda: "first")  # no render in flight
+    registry.begin_render(1)
+    assert not registry.has_pending(1)
+    assert registry.defer(1, lambda: "first")
+    assert registry.defer(1, lambda: "second")
+    assert registry.has_pending(1)
+    assert registry.end_render(1)() == "second"
+    assert not registry.has_pending(1)
+    assert registry.end_render(1) is None
+
+
+def test_defer_final():
+    """Tests that a request for the final image is never replaced by one for a preview
+    """
+    registry = create_registry()
+    registry.begin_render(1)
+    registry.defer(1, lambda: "preview")
+    registry.defer(1, lambda: "final", final=True)
+    registry.defer(1, lambda: "later preview")
+    assert registry.end_render(1)() == "final"
+
+    registry.begin_render(1)
+    registry.defer(1, lambda: "preview")  # the final image has been rendered: previews can be kept again
+    assert registry.end_render(1)() == "preview"
+
+
+def test_free_after_failure():
+    """Tests that a user whose image has failed can start a new one right away
+    """
+    registry = create_registry()
+    registry.begin_render(1)
+    registry.finish(1)
+    assert not registry.has_job(1)
+    assert registry.end_render(1) is None  # the render in flight ends after the image has been removed
+    assert registry.begin_render(1)
+
+
+def test_expire():
+    """Tests that the images with no activity expire, calling on_expire, unless a render is still in flight
+    """
+    expired = []
+    registry = create_registry(job_timeout=0, on_expire=expired.append)
+    registry.begin_render(1)
+    assert registry.expire() == []  # the render is still in flight
+    registry.end_render(1)
+    assert registry.expire() == [1]
+    assert expired == [1]
+    assert not registry.has_job(1)
+
+
+def test_resume():
+    """Tests that an image restored after a restart has no render in flight
+    """
+    registry = create_registry()
+    registry.resume(1)
+    assert registry.has_job(1)
+    assert not registry.defer(1, lambda: None)
+    assert registry.begin_render(1)
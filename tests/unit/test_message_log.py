@@ -0,0 +1,122 @@
+"""Tests the writer of the message log"""
+import json
+import os
+from modules.debug.log_manager import MessageLogWriter
+
+
+def create_record(message_id: int) -> dict:
+    """Creates a record, like the ones made by log_message
+
+    Args:
+        message_id (int): id of the message
+
+    Returns:
+        dict: the record
+    """
+    return {
+        'message_id': message_id,
+        'user_id': 1,
+        'user_name': "user",
+        'first_name': "First",
+        'last_name': "Last",
+        'chat_id': 1,
+        'chat_type': "private",
+        'chat_title': None,
+        'text': "/create",
+        'date': "2020-10-10 10:10:10",
+    }
+
+
+def write_records(path: str, count: int, **kwargs):
+    """Writes the records with a new writer, then closes it
+
+    Args:
+        path (str): path of the log file
+        count (int): how many records are written
+        kwargs (Any): settings of the writer, overriding the default ones
+    """
+    settings = dict(log_format="json", batch_size=1, flush_interval=60, max_bytes=0, backup_count=0)
+    settings.update(kwargs)
+    writer = MessageLogWriter(path=path, **settings)
+    for message_id in range(count):
+        writer.write(create_record(message_id))
+    writer.close()
+
+
+def read_ids(path: str) -> list:
+    """Reads the ids of the messages written in the json log file
+
+    Args:
+        path (str): path of the log file
+
+    Returns:
+        list: ids of the messages
+    """
+    with open(path, encoding="utf8") as log_file:
+        return [json.loads(line)['message_id'] for line in log_file]
+
+
+def test_json(tmp_path):
+    """Tests that each record is written as a json line, and that close writes all the records still waiting
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    path = str(tmp_path / "messages.log")
+    write_records(path, 25, batch_size=10)
+    assert read_ids(path) == list(range(25))
+
+
+def test_text(tmp_path):
+    """Tests the human readable format
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    path = str(tmp_path / "messages.log")
+    write_records(path, 2, log_format="text")
+    with open(path, encoding="utf8") as log_file:
+        text = log_file.read()
+    assert text.count("___ID MESSAGE:") == 2
+    assert "user_name:  user" in text
+
+
+def test_append(tmp_path):
+    """Tests that a new writer appends to the file left by the previous one
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    path = str(tmp_path / "messages.log")
+    write_records(path, 2)
+    write_records(path, 3)
+    assert read_ids(path) == [0, 1, 0, 1, 2]
+
+
+def test_rotation(tmp_path):
+    """Tests that the file is rotated when it would grow past max_bytes, keeping backup_count old files
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    path = str(tmp_path / "messages.log")
+    record_size = len(json.dumps(create_record(0))) + 1
+    write_records(path, 7, max_bytes=record_size * 2, backup_count=2)  # two records for each file
+    assert read_ids(path) == [6]
+    assert read_ids(path + ".1") == [4, 5]
+    assert read_ids(path + ".2") == [2, 3]
+    assert not os.path.exists(path + ".3")
+    assert all(os.path.getsize(file_path) <= record_size * 2 for file_path in (path, path + ".1", path + ".2"))
+
+
+def test_rotation_no_backup(tmp_path):
+    """Tests that without backups the file is started again from scratch
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    path = str(tmp_path / "messages.log")
+    record_size = len(json.dumps(create_record(0))) + 1
+    write_records(path, 5, max_bytes=record_size * 2, backup_count=0)
+    assert read_ids(path) == [4]
+    assert not os.path.exists(path + ".1")
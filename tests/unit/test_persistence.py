@@ -0,0 +1,125 @@
+"""Tests the persistence backed by SQLite"""
+import sqlite3
+from modules.data.persistence import SQLitePersistence
+
+
+def create_persistence(path: str, batch_size: int = 10, flush_interval: float = 60) -> SQLitePersistence:
+    """Creates the persistence. The flush_interval is long, so the changes are written only by flush or batch_size
+
+    Args:
+        path (str): path of the database file
+        batch_size (int, optional): how many changes are written at once. Defaults to 10.
+        flush_interval (float, optional): max seconds a change waits before being written. Defaults to 60.
+
+    Returns:
+        SQLitePersistence: the persistence
+    """
+    return SQLitePersistence(path=str(path), batch_size=batch_size, flush_interval=flush_interval)
+
+
+def count_rows(path: str) -> int:
+    """Counts the entries written in the database
+
+    Args:
+        path (str): path of the database file
+
+    Returns:
+        int: number of entries
+    """
+    connection = sqlite3.connect(str(path))
+    try:
+        return connection.execute("SELECT COUNT(*) FROM persistence").fetchone()[0]
+    finally:
+        connection.close()
+
+
+def test_round_trip(tmp_path):
+    """Tests that everything written is read back by a new persistence, as if the bot had restarted
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    path = tmp_path / "persistence.sqlite3"
+    persistence = create_persistence(path)
+    user_data = {'title': "Title", 'caption': "Caption", 'background_offset': {'x': 10, 'y': -5}}
+    persistence.update_user_data(1, user_data)
+    persistence.update_chat_data(-100, {'count': 3})
+    persistence.update_bot_data({'started': True})
+    persistence.update_conversation("create", (1, 1), 4)
+    persistence.flush()
+
+    restored = create_persistence(path)
+    assert restored.get_user_data()[1] == user_data
+    assert restored.get_chat_data()[-100] == {'count': 3}
+    assert restored.get_bot_data() == {'started': True}
+    assert restored.get_conversations("create") == {(1, 1): 4}
+    assert restored.get_conversations("other") == {}
+    restored.flush()
+
+
+def test_changes_copied(tmp_path):
+    """Tests that the data is serialized when it is updated, so later changes by the handlers are not written
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    path = tmp_path / "persistence.sqlite3"
+    persistence = create_persistence(path)
+    user_data = {'title': "Title"}
+    persistence.update_user_data(1, user_data)
+    user_data['title'] = "Changed"
+    persistence.flush()
+    assert create_persistence(path).get_user_data()[1] == {'title': "Title"}
+
+
+def test_conversation_end(tmp_path):
+    """Tests that a conversation that has ended is removed, and that a state still being computed keeps the old one
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    path = tmp_path / "persistence.sqlite3"
+    persistence = create_persistence(path)
+    persistence.update_conversation("create", (1, 1), 2)
+    persistence.update_conversation("create", (2, 2), 2)
+    persistence.update_conversation("create", (2, 2), (2, object()))  # run_async: (old state, promise)
+    persistence.update_conversation("create", (1, 1), None)
+    persistence.flush()
+    assert create_persistence(path).get_conversations("create") == {(2, 2): 2}
+    assert count_rows(path) == 1
+
+
+def test_write_after_flush(tmp_path):
+    """Tests that the changes that arrive after a flush are still written
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    path = tmp_path / "persistence.sqlite3"
+    persistence = create_persistence(path)
+    persistence.update_user_data(1, {'title': "First"})
+    persistence.flush()
+    persistence.update_user_data(1, {'title': "Second"})
+    persistence.update_user_data(2, {'title': "Other"})
+    persistence.flush()
+    restored = create_persistence(path).get_user_data()
+    assert restored[1] == {'title': "Second"}
+    assert restored[2] == {'title': "Other"}
+
+
+def test_batch_size(tmp_path):
+    """Tests that the changes are written without a flush once batch_size of them are waiting
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    path = tmp_path / "persistence.sqlite3"
+    persistence = create_persistence(path, batch_size=2)
+    persistence.update_user_data(1, {'title': "First"})
+    persistence.update_user_data(2, {'title': "Second"})
+    for _ in range(100):
+        if count_rows(path) == 2:
+            break
+        persistence._thread.join(0.05)
+    assert count_rows(path) == 2
+    persistence.flush()
@@ -0,0 +1,254 @@
+"""Tests the preparation of the backgrounds"""
+from io import BytesIO
+from types import SimpleNamespace
+import pytest
+from PIL import Image
+from telegram import PhotoSize
+from telegram.error import TelegramError
+from modules.data.data_reader import config_map
+from modules.various import photo_utils
+from modules.various.job_registry import JobRegistry
+from modules.various.photo_utils import BackgroundMissingError, choose_photo_size, generate_photo, reduce_and_blur, \
+    render_image, restore_images
+from modules.various.render_session import clear_session
+from modules.various.render_cache import RenderCache, render_key
+
+PHOTO = [
+    PhotoSize("small", "s", 90, 60),
+    PhotoSize("medium", "m", 320, 213),
+    PhotoSize("large", "l", 800, 533),
+    PhotoSize("largest", "xl", 1280, 853),
+]
+
+
+@pytest.fixture
+def image_config(monkeypatch) -> dict:
+    """Image settings that can be changed by the test, restored afterwards
+
+    Args:
+        monkeypatch (MonkeyPatch): used to restore the settings
+
+    Returns:
+        dict: image settings
+    """
+    image = dict(config_map['image'], blur=0, blur_mode="fast")
+    monkeypatch.setitem(config_map, 'image', image)
+    return image
+
+
+@pytest.fixture
+def jobs(tmp_path, monkeypatch) -> JobRegistry:
+    """Registry of the images in progress used by the module in place of its own, with the images of the users
+    kept in a temporary directory
+
+    Args:
+        tmp_path (Path): temporary directory, in place of data/img
+        monkeypatch (MonkeyPatch): used to restore the module
+
+    Returns:
+        JobRegistry: registry of the images in progress
+    """
+    registry = JobRegistry(max_jobs=0, job_timeout=60, render_timeout=60)
+    monkeypatch.setattr(photo_utils, "_jobs", registry)
+    monkeypatch.setattr(photo_utils, "build_bg_path", lambda sender_id: str(tmp_path / f"bg_{sender_id}.png"))
+    monkeypatch.setattr(photo_utils, "build_photo_path", lambda sender_id: str(tmp_path / f"{sender_id}.png"))
+    return registry
+
+
+def test_choose_largest(image_config: dict):
+    """Tests that the largest size is chosen when the template shows it at its own resolution
+
+    Args:
+        image_config (dict): image settings
+    """
+    photo_size, scale = choose_photo_size(PHOTO, (600, 600), "crop")
+    assert photo_size.file_id == "largest"
+    assert scale == 1
+
+
+def test_choose_scale(image_config: dict):
+    """Tests that in the "scale" resize_mode the smallest size that covers the template is chosen
+
+    Args:
+        image_config (dict): image settings
+    """
+    photo_size, scale = choose_photo_size(PHOTO, (300, 200), "scale")
+    assert photo_size.file_id == "medium"
+    assert scale == 320 / 1280
+
+    photo_size, _ = choose_photo_size(PHOTO, (2000, 2000), "scale")
+    assert photo_size.file_id == "largest"
+
+
+def test_choose_blur(image_config: dict):
+    """Tests that the blur allows a smaller size only in the "fast" blur_mode
+
+    Args:
+        image_config (dict): image settings
+    """
+    image_config['blur'] = 30  # 3 pixels for each unit of the radius: a tenth of the largest size is enough
+    photo_size, scale = choose_photo_size(PHOTO, (600, 600), "crop")
+    assert photo_size.file_id == "medium"
+    assert scale == 320 / 1280
+
+    image_config['blur_mode'] = "exact"
+    photo_size, _ = choose_photo_size(PHOTO, (600, 600), "crop")
+    assert photo_size.file_id == "largest"
+
+
+def test_choose_tolerance(image_config: dict):
+    """Tests that a size a few pixels short, because of the rounding of telegram, is still enough
+
+    Args:
+        image_config (dict): image settings
+    """
+    photo_size, _ = choose_photo_size(PHOTO, (319, 1), "scale")
+    assert photo_size.file_id == "medium"
+    photo_size, _ = choose_photo_size(PHOTO, (326, 1), "scale")
+    assert photo_size.file_id == "medium"
+    photo_size, _ = choose_photo_size(PHOTO, (340, 1), "scale")
+    assert photo_size.file_id == "large"
+
+
+def test_reduce_scale():
+    """Tests that in the "scale" resize_mode the background is brought to the size of the template
+    """
+    for size in ((1200, 900), (100, 80)):
+        im, scale = reduce_and_blur(Image.new("RGB", size), (600, 400), "scale", blur=10)
+        assert im.size == (600, 400)
+        assert scale == 1
+
+
+def test_reduce_no_blur():
+    """Tests that without blur the background is not reduced
+    """
+    im, scale = reduce_and_blur(Image.new("RGB", (1200, 900)), (600, 600), "crop", blur=0)
+    assert im.size == (1200, 900)
+    assert scale == 1
+
+    im, scale = reduce_and_blur(Image.new("RGB", (300, 200)), (600, 600), "crop", blur=0)
+    assert im.size == (300, 200)
+    assert scale == pytest.approx(1 / 3)  # the background will be enlarged 3 times
+
+
+def test_reduce_blur():
+    """Tests that the background is reduced as much as the blur can hide
+    """
+    im, scale = reduce_and_blur(Image.new("RGB", (1200, 900)), (600, 600), "crop", blur=30)
+    assert im.size == (120, 90)
+    assert scale == pytest.approx(0.1)
+
+
+def test_reduce_jpeg():
+    """Tests that a JPEG decoded directly at a reduced scale gives the same result as the decoded image
+    """
+    buffer = BytesIO()
+    Image.radial_gradient("L").resize((1200, 900)).convert("RGB").save(buffer, "JPEG")
+    im, scale = reduce_and_blur(Image.open(BytesIO(buffer.getvalue())), (600, 600), "crop", blur=30)
+    assert im.size == (120, 90)
+    assert scale == pytest.approx(0.1)
+
+    im, scale = reduce_and_blur(Image.open(BytesIO(buffer.getvalue())), (300, 200), "scale", blur=10)
+    assert im.size == (300, 200)
+    assert scale == 1
+
+
+def test_reduce_smaller_size():
+    """Tests that a smaller size of the photo gives the same result as the largest one
+    """
+    largest, largest_scale = reduce_and_blur(Image.new("RGB", (1200, 900)), (600, 600), "crop", blur=30)
+    smaller, smaller_scale = reduce_and_blur(Image.new("RGB", (600, 450)), (600, 600), "crop", blur=30,
+                                             source_scale=0.5)
+    assert smaller.size == largest.size
+    assert smaller_scale == pytest.approx(largest_scale)
+
+
+def test_background_kept(image_config: dict, jobs: JobRegistry):
+    """Tests that a background not sent again is taken from the session that prepared it, and that it is asked for
+    when the session doesn't have it
+
+    Args:
+        image_config (dict): image settings
+        jobs (JobRegistry): registry of the images in progress
+    """
+    image_config['in_memory'] = True
+    buffer = BytesIO()
+    Image.radial_gradient("L").resize((1200, 900)).convert("RGB").save(buffer, "JPEG")
+    data = {'title': "Title", 'caption': "Caption", 'template': "DMI", 'resize_mode': "crop",
+            'background_offset': {'x': 0, 'y': 0}}
+    try:
+        with pytest.raises(BackgroundMissingError):
+            render_image(sender_id=1, data=data, image_config=image_config, bg_kept=True)
+        sent = render_image(sender_id=1, data=data, image_config=image_config, bg_bytes=buffer.getvalue())
+        assert render_image(sender_id=1, data=data, image_config=image_config, bg_kept=True) == sent
+    finally:
+        clear_session(1)
+
+
+def test_restore_images(tmp_path, image_config: dict, jobs: JobRegistry):
+    """Tests that the images in progress are registered again, downloading the missing backgrounds,
+    and that the files left behind are deleted
+
+    Args:
+        tmp_path (Path): temporary directory, in place of data/img
+        image_config (dict): image settings
+        jobs (JobRegistry): registry of the images in progress
+    """
+    image_config['in_memory'] = False
+    for name in ("template_DMI.png", "bg_1.png", "1.png", "bg_2.png", "2.png"):
+        (tmp_path / name).write_bytes(b"image")
+
+    def get_file(file_id: str):
+        if file_id == "expired":
+            raise TelegramError("File not found")
+        url = f"https://example.org/{file_id}"
+
+        def download(custom_path: str):
+            with open(custom_path, "wb") as bg_file:
+                bg_file.write(url.encode())
+
+        return SimpleNamespace(file_path=url, download=download)
+
+    bot = SimpleNamespace(getFile=get_file, request=SimpleNamespace(retrieve=lambda url: url.encode()))
+    in_progress = {
+        1: {'background_file_id': "first"},  # saved on the disk
+        3: {'background_file_id': "third"},  # only kept in memory
+        4: {'background_file_id': "expired"},
+        5: {'background_file_id': None},  # default background
+    }
+
+    assert restore_images(bot, in_progress) == 3
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["bg_1.png", "bg_3.png", "template_DMI.png"]
+    assert (tmp_path / "bg_1.png").read_bytes() == b"image"
+    assert (tmp_path / "bg_3.png").read_bytes() == b"https://example.org/third"
+    assert [jobs.has_job(sender_id) for sender_id in range(1, 6)] == [True, False, True, False, True]
+
+
+def test_cached_then_deferred(tmp_path, monkeypatch, jobs: JobRegistry):
+    """Tests that the final image requested while a cached preview is being sent again is sent afterwards,
+    and that the image is then finished
+
+    Args:
+        tmp_path (Path): temporary directory, for the render cache
+        monkeypatch (MonkeyPatch): used to restore the module
+        jobs (JobRegistry): registry of the images in progress
+    """
+    data = {'title': "Title", 'caption': "Caption", 'template': "DMI", 'resize_mode': "crop",
+            'background_offset': {'x': 0, 'y': 0}, 'background_unique_id': None}
+    cache = RenderCache(max_size=10, path=str(tmp_path / "render_cache.json"))
+    cache.put(render_key(data=data, final=False), "preview")
+    cache.put(render_key(data=data, final=True), "final")
+    monkeypatch.setattr(photo_utils, "get_render_cache", lambda: cache)
+    sent = []
+
+    def edit_message_media(media, **kwargs):
+        sent.append(media.media)
+        if len(sent) == 1:  # the user presses "Genera" while the preview is being sent
+            assert generate_photo(info=info, user_data=data, final=True)
+
+    bot = SimpleNamespace(edit_message_media=edit_message_media)
+    info = {'bot': bot, 'chat_id': 1, 'sender_id': 1, 'message_id': 10}
+
+    assert generate_photo(info=info, user_data=data, replace_message=True)
+    assert sent == ["preview", "final"]
+    assert not jobs.has_job(1)
@@ -0,0 +1,240 @@
+"""Tests the limiter of the calls to the Bot API"""
+import time
+from threading import Thread
+import pytest
+from telegram.error import RetryAfter
+from modules.various.rate_limiter import ApiLimiter, RateLimitedBot, TokenBucket, call_arguments, \
+    PRIORITY_FINAL, PRIORITY_MESSAGE, PRIORITY_PREVIEW
+
+TIMEOUT = 5
+
+
+def unlimited() -> ApiLimiter:
+    """Creates a limiter with no limits, so that only the keys and the priorities matter
+
+    Returns:
+        ApiLimiter: the limiter
+    """
+    return ApiLimiter(global_rate=0, global_burst=1, chat_rate=0, group_rate=0, chat_burst=1)
+
+
+def start_acquire(limiter: ApiLimiter, results: list, *args, **kwargs) -> Thread:
+    """Calls acquire in another thread, appending (args, result) to the results, and waits until the call is waiting
+
+    Args:
+        limiter (ApiLimiter): limiter to use
+        results (list): where the result is appended
+        args (Any): arguments of acquire
+        kwargs (Any): keyword arguments of acquire
+
+    Returns:
+        Thread: the thread calling acquire
+    """
+    waiting = limiter.waiting
+    thread = Thread(target=lambda: results.append((args, limiter.acquire(*args, **kwargs))), daemon=True)
+    thread.start()
+    deadline = time.monotonic() + TIMEOUT
+    while limiter.waiting <= waiting and thread.is_alive() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return thread
+
+
+def test_token_bucket():
+    """Tests that the bucket allows the burst at once, then the rate
+    """
+    bucket = TokenBucket(rate=2, burst=2)
+    now = bucket.updated
+    for _ in range(2):
+        assert bucket.wait_time(now) == 0
+        bucket.take()
+    assert bucket.wait_time(now) == 0.5
+    assert bucket.wait_time(now + 0.5) == 0
+
+
+def test_token_bucket_unlimited():
+    """Tests that a bucket with no rate never waits, unless it is paused
+    """
+    bucket = TokenBucket(rate=0, burst=1)
+    for _ in range(10):
+        assert bucket.wait_time(time.monotonic()) == 0
+        bucket.take()
+    bucket.pause(10)
+    assert bucket.wait_time(time.monotonic()) > 9
+
+
+def test_chat_buckets():
+    """Tests that each chat has its own limit, and that the groups use the group_rate
+    """
+    limiter = ApiLimiter(global_rate=0, global_burst=1, chat_rate=1, group_rate=0.5, chat_burst=1)
+    assert limiter.acquire(1)
+    assert limiter.acquire(2)  # another chat is not affected
+    assert limiter.acquire(-1)
+    now = time.monotonic()
+    assert 0.9 < limiter._chat(1).wait_time(now) <= 1
+    assert 1.9 < limiter._chat(-1).wait_time(now) <= 2
+
+
+def test_global_bucket():
+    """Tests that the global limit holds up the calls to different chats
+    """
+    limiter = ApiLimiter(global_rate=5, global_burst=1, chat_rate=0, group_rate=0, chat_burst=1)
+    start = time.monotonic()
+    assert limiter.acquire(1)
+    assert limiter.acquire(2)
+    assert time.monotonic() - start >= 0.15
+
+
+def test_no_chat():
+    """Tests that a call with no chat, like the edit of an inline message, has no limit of its own
+    """
+    limiter = ApiLimiter(global_rate=0, global_burst=1, chat_rate=1, group_rate=1, chat_burst=1)
+    start = time.monotonic()
+    for _ in range(5):
+        assert limiter.acquire(None, key=("media", "inline"))
+        limiter.release(("media", "inline"))
+    assert time.monotonic() - start < 0.5
+    assert limiter.acquire(1)  # the chats keep their limit
+    assert limiter._chat(1).wait_time(time.monotonic()) > 0.5
+
+
+def test_pause():
+    """Tests that a paused chat waits, while the others don't
+    """
+    limiter = unlimited()
+    limiter.pause(1, 0.3)
+    start = time.monotonic()
+    assert limiter.acquire(2)
+    assert time.monotonic() - start < 0.1
+    assert limiter.acquire(1)
+    assert time.monotonic() - start >= 0.25
+
+
+def test_priority_order():
+    """Tests that the waiting calls go by priority, then by age
+    """
+    limiter = ApiLimiter(global_rate=10, global_burst=1, chat_rate=0, group_rate=0, chat_burst=1)
+    assert limiter.acquire(0)  # the next calls have to wait for the global bucket
+    results = []
+    threads = [
+        start_acquire(limiter, results, 1, PRIORITY_PREVIEW),
+        start_acquire(limiter, results, 2, PRIORITY_MESSAGE),
+        start_acquire(limiter, results, 3, PRIORITY_FINAL),
+        start_acquire(limiter, results, 4, PRIORITY_MESSAGE),
+    ]
+    for thread in threads:
+        thread.join(TIMEOUT)
+    assert [args[0] for args, _ in results] == [3, 2, 4, 1]
+    assert all(result for _, result in results)
+
+
+def test_drop_obsolete():
+    """Tests that a call waiting for one with the same key is dropped by a newer one
+    """
+    limiter = unlimited()
+    key = ("media", 1, 10)
+    assert limiter.acquire(1, key=key)  # in flight
+    results = []
+    older = start_acquire(limiter, results, 1, PRIORITY_PREVIEW, key)
+    newer = start_acquire(limiter, results, 1, PRIORITY_PREVIEW, key)
+    older.join(TIMEOUT)
+    assert results == [((1, PRIORITY_PREVIEW, key), False)]
+    assert limiter.dropped == 1
+    assert newer.is_alive()  # still waiting for the call in flight
+
+    limiter.release(key)
+    newer.join(TIMEOUT)
+    assert results[1] == ((1, PRIORITY_PREVIEW, key), True)
+    limiter.release(key)
+
+
+def test_different_keys():
+    """Tests that the calls with different keys don't affect each other
+    """
+    limiter = unlimited()
+    assert limiter.acquire(1, key=("media", 1, 10))
+    assert limiter.acquire(1, key=("media", 1, 11))
+    assert limiter.acquire(1, key=("text", 1, 10))
+    assert limiter.dropped == 0
+
+
+def test_retry_dropped_by_newer():
+    """Tests that a call made again after a RetryAfter is dropped if a newer one with the same key is waiting,
+    instead of dropping the newer one
+    """
+    limiter = unlimited()
+    key = ("media", 1, 10)
+    assert limiter.acquire(1, key=key)
+    results = []
+    newer = start_acquire(limiter, results, 1, PRIORITY_PREVIEW, key)
+    limiter.pause(1, 0.2)  # the newer call can't go before the retry
+    limiter.release(key)
+    assert not limiter.acquire(1, PRIORITY_PREVIEW, key, retry=True)
+    newer.join(TIMEOUT)
+    assert results == [((1, PRIORITY_PREVIEW, key), True)]
+
+
+def test_retry_alone():
+    """Tests that a call made again after a RetryAfter goes, if no newer call with the same key is waiting
+    """
+    limiter = unlimited()
+    key = ("media", 1, 10)
+    assert limiter.acquire(1, key=key)
+    limiter.release(key)
+    assert limiter.acquire(1, key=key, retry=True)
+    assert limiter.dropped == 0
+
+
+def test_bot_retry_after():
+    """Tests that the bot makes the call again after a RetryAfter, up to max_retries times
+    """
+    limiter = unlimited()
+    bot = RateLimitedBot("123456:test", limiter=limiter, max_retries=1)
+    calls = []
+
+    def edit_message_media(*args, **kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise RetryAfter(0)
+        return "edited"
+
+    assert bot._limited(edit_message_media, PRIORITY_FINAL, "media", chat_id=1, message_id=10) == "edited"
+    assert len(calls) == 2
+    assert not limiter._in_flight  # the key has been released
+
+    calls.clear()
+
+    def always_retry(*args, **kwargs):
+        calls.append(kwargs)
+        raise RetryAfter(0)
+
+    with pytest.raises(RetryAfter):
+        bot._limited(always_retry, PRIORITY_FINAL, "media", chat_id=1, message_id=10)
+    assert len(calls) == 2
+
+
+def test_call_arguments():
+    """Tests that the arguments of a call are found by name, whether they were passed by position or by keyword
+    """
+    bot = RateLimitedBot("123456:test", limiter=unlimited(), max_retries=0)
+    edit_message_text = super(RateLimitedBot, bot).edit_message_text  # the method called by _limited
+    assert call_arguments(edit_message_text, ("text", 1, 10), {}) == {'text': "text", 'chat_id': 1, 'message_id': 10}
+    assert call_arguments(super(RateLimitedBot, bot).delete_message, (1,), {'message_id': 10}) == \
+        {'chat_id': 1, 'message_id': 10}
+    assert call_arguments(lambda *args, **kwargs: None, (1,), {'chat_id': 2}) == {'chat_id': 2}
+
+
+def test_bot_inline_message():
+    """Tests that the bot edits an inline message, which has no chat, keyed by its inline_message_id
+    """
+    limiter = unlimited()
+    bot = RateLimitedBot("123456:test", limiter=limiter, max_retries=0)
+    calls = []
+
+    def edit_message_media(*args, **kwargs):
+        calls.append((limiter._in_flight.copy(), kwargs))
+        return "edited"
+
+    assert bot._limited(edit_message_media, PRIORITY_MESSAGE, "media", inline_message_id="inline", media=None) == "edited"
+    assert calls[0][0] == {("media", "inline")}
+    assert not limiter._in_flight
+    assert bot._limited(edit_message_media, PRIORITY_MESSAGE, "media", chat_id=None, inline_message_id="inline") == "edited"
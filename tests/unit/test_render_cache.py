@@ -0,0 +1,133 @@
+"""Tests the cache of the images already sent"""
+import pytest
+from modules.data.data_reader import config_map
+from modules.various import render_cache
+from modules.various.render_cache import RenderCache, render_key
+
+DATA = {
+    'title': "Title",
+    'caption': "Caption",
+    'template': "DMI",
+    'resize_mode': "crop",
+    'background_offset': {'x': 0, 'y': 0},
+    'background_unique_id': None,
+}
+
+
+def key(final: bool = False, **changes) -> str:
+    """Builds the key of the image described by DATA, with the changes provided
+
+    Args:
+        final (bool, optional): whether the image is final. Defaults to False.
+        changes (Any): values of DATA to change
+
+    Returns:
+        str: key of the image
+    """
+    return render_key(data=dict(DATA, **changes), final=final)
+
+
+def test_key_inputs():
+    """Tests that the key changes with what changes how the image looks, and only with that
+    """
+    assert key() == key()
+    assert key() == key(other="ignored")
+    assert key() != key(title="Other")
+    assert key() != key(caption="Other")
+    assert key() != key(background_offset={'x': 10, 'y': 0})
+    assert key() != key(resize_mode="scale")
+    assert key() != key(background_unique_id="AQADxyz")
+
+
+def test_key_final():
+    """Tests that the preview and the final image have different keys, unless they are the same image ("scale")
+    """
+    assert key(final=False) != key(final=True)
+    assert key(final=False, resize_mode="scale") == key(final=True, resize_mode="scale")
+    assert key(resize_mode="scale") == key(resize_mode="scale", background_offset={'x': 10, 'y': 0})
+
+
+def test_key_settings(monkeypatch):
+    """Tests that the key changes with the settings used to render the image
+
+    Args:
+        monkeypatch (MonkeyPatch): used to restore the settings
+    """
+    before = key()
+    monkeypatch.setitem(config_map, 'image', dict(config_map['image'], blur=config_map['image']['blur'] + 1))
+    assert key() != before
+
+
+def test_key_background():
+    """Tests that the background is identified by its file_unique_id, and that an image whose background was never
+    identified is not cached
+    """
+    assert key(background_unique_id="AQADxyz") == key(background_unique_id="AQADxyz")
+    assert key(background_unique_id="AQADxyz") != key(background_unique_id="AQADabc")
+    data = dict(DATA)
+    del data['background_unique_id']
+    assert render_key(data=data, final=False) is None
+
+
+def test_key_assets(monkeypatch):
+    """Tests that the key changes when the template or its default background are modified on the disk
+
+    Args:
+        monkeypatch (MonkeyPatch): used to restore the module
+    """
+    monkeypatch.setattr(render_cache, "get_asset_version", lambda template: [[1000, 50], [1000, 60]])
+    before = key()
+    monkeypatch.setattr(render_cache, "get_asset_version", lambda template: [[2000, 50], [1000, 60]])
+    assert key() != before
+
+
+def test_cache(tmp_path):
+    """Tests that the file_ids are stored, discarded and forgotten starting from the least recently used
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    cache = RenderCache(max_size=2, path=str(tmp_path / "render_cache.json"))
+    assert cache.get("a") is None
+    cache.put("a", "file_a")
+    cache.put("b", "file_b")
+    assert cache.get("a") == "file_a"  # now "b" is the least recently used
+    cache.put("c", "file_c")
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    cache.discard("a")
+    assert cache.get("a") is None
+    assert cache.get("c") == "file_c"
+
+
+def test_save_load(tmp_path):
+    """Tests that the file_ids are kept between restarts, and that the file is written only if something changed
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    path = tmp_path / "render_cache.json"
+    cache = RenderCache(max_size=10, path=str(path))
+    cache.save()
+    assert not path.exists()
+    cache.put("a", "file_a")
+    cache.put("b", "file_b")
+    cache.save()
+
+    restored = RenderCache(max_size=10, path=str(path))
+    assert len(restored) == 2
+    assert restored.get("a") == "file_a"
+    assert restored.get("b") == "file_b"
+
+
+@pytest.mark.parametrize("contents", ["", "not json", "{\"a\": 1"])
+def test_load_corrupted(tmp_path, contents: str):
+    """Tests that a corrupted file is ignored
+
+    Args:
+        tmp_path (Path): temporary directory
+        contents (str): contents of the file
+    """
+    path = tmp_path / "render_cache.json"
+    path.write_text(contents)
+    assert len(RenderCache(max_size=10, path=str(path))) == 0
@@ -0,0 +1,35 @@
+"""Tests the pool of workers that creates the images"""
+from threading import Event
+import pytest
+from modules.various.render_engine import RenderBusyError, RenderEngine
+
+TIMEOUT = 5
+
+
+def test_busy():
+    """Tests that a job is refused once workers + queue_size jobs are running or waiting
+    """
+    engine = RenderEngine(workers=1, queue_size=0, processes=False)
+    release = Event()
+    engine.submit(1, release.wait, TIMEOUT)
+    with pytest.raises(RenderBusyError):
+        engine.submit(2, lambda: None)
+    release.set()
+    engine.shutdown()
+
+
+def test_wait():
+    """Tests that a job submitted with wait is kept until a slot is free, instead of being refused
+    """
+    engine = RenderEngine(workers=1, queue_size=0, processes=False)
+    release, done = Event(), Event()
+    results = []
+    engine.submit(1, release.wait, TIMEOUT)
+    assert engine.submit(2, lambda: "waited", callback=lambda future: (results.append(future.result()), done.set()),
+                         wait=True) is None
+    assert engine.pending == 1
+    release.set()
+    assert done.wait(TIMEOUT)
+    assert results == ["waited"]
+    engine.shutdown()
+    assert engine.pending == 0
@@ -0,0 +1,47 @@
+"""Tests the layout of the texts"""
+from modules.various.font_registry import get_font
+from modules.various.text_layout import wrap_text
+
+FONT = get_font(40)
+
+
+def test_short_text():
+    """Tests that a text shorter than the max width is kept on a single line
+    """
+    assert wrap_text("Short title", 1000, FONT) == ["Short title"]
+
+
+def test_long_text():
+    """Tests that a long text is split in lines shorter than the max width, without losing any word
+    """
+    text = "The quick brown fox jumps over the lazy dog " * 5
+    lines = wrap_text(text, 300, FONT)
+    assert len(lines) > 1
+    assert all(FONT.getsize(line)[0] < 300 for line in lines)
+    assert " ".join(lines).split() == text.split()
+
+
+def test_same_lines_as_measuring_each_line():
+    """Tests that summing the widths of the words gives the same lines as measuring each line,
+    so that each line is filled as much as possible
+    """
+    text = "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore"
+    lines = wrap_text(text, 400, FONT)
+    for line, next_line in zip(lines, lines[1:]):
+        assert FONT.getsize(f"{line} {next_line.split()[0]}")[0] >= 400 - 2  # the next word didn't fit
+
+
+def test_new_lines():
+    """Tests that the new lines in the text are kept
+    """
+    text = "First line of a text long enough to be wrapped\nSecond"
+    lines = wrap_text(text, 400, FONT)
+    assert lines[-1] == "Second"
+    assert " ".join(lines[:-1]).split() == text.split("\n")[0].split()
+
+
+def test_long_word():
+    """Tests that a word longer than the max width gets a line of its own
+    """
+    lines = wrap_text("a Supercalifragilisticexpialidocious b", 100, FONT)
+    assert lines == ["a", "Supercalifragilisticexpialidocious", "b"]
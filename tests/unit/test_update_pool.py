@@ -0,0 +1,128 @@
+"""Tests the pool of workers that handles the updates"""
+import time
+from threading import Event, Thread
+from modules.data.data_reader import config_map
+from modules.various.update_pool import UpdatePool, create_updater
+
+TIMEOUT = 5
+
+
+def test_order():
+    """Tests that the updates of a chat are handled one at a time, in the order they arrived
+    """
+    pool = UpdatePool(workers=4, queue_size=100)
+    handled = []
+    running = []
+
+    def handle(chat_id: int, update_id: int):
+        running.append(chat_id)
+        assert running.count(chat_id) == 1
+        time.sleep(0.001 * (update_id % 3))
+        handled.append((chat_id, update_id))
+        running.remove(chat_id)
+
+    for update_id in range(30):
+        for chat_id in range(3):
+            pool.submit(chat_id, handle, chat_id, update_id)
+    pool.shutdown(wait=True)
+    for chat_id in range(3):
+        assert [update_id for chat, update_id in handled if chat == chat_id] == list(range(30))
+    assert pool.pending == 0
+
+
+def test_chats_in_parallel():
+    """Tests that the updates of different chats are handled at the same time
+    """
+    pool = UpdatePool(workers=2, queue_size=0)
+    first, second = Event(), Event()
+    pool.submit(1, lambda: (first.set(), second.wait(TIMEOUT)))
+    pool.submit(2, lambda: (second.set(), first.wait(TIMEOUT)))
+    assert first.wait(TIMEOUT) and second.wait(TIMEOUT)
+    pool.shutdown(wait=True)
+
+
+def test_slow_chat():
+    """Tests that a slow update only holds up its own chat, whatever the other chats are
+    """
+    pool = UpdatePool(workers=2, queue_size=10)
+    release = Event()
+    handled = []
+    pool.submit(1, release.wait, TIMEOUT)
+    pool.submit(1, handled.append, 1)
+    for chat_id in range(3, 12, 2):  # chats that would have shared a worker with chat 1
+        pool.submit(chat_id, handled.append, chat_id)
+    deadline = time.monotonic() + TIMEOUT
+    while len(handled) < 5 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert handled == list(range(3, 12, 2))
+    release.set()
+    pool.shutdown(wait=True)
+    assert handled[-1] == 1
+
+
+def test_shutdown_waits():
+    """Tests that shutdown handles the updates still waiting in the queue of their chat
+    """
+    pool = UpdatePool(workers=1, queue_size=10)
+    handled = []
+    for update_id in range(5):
+        pool.submit(1, lambda update_id=update_id: (time.sleep(0.01), handled.append(update_id)))
+    pool.shutdown(wait=True)
+    assert handled == list(range(5))
+    assert pool.pending == 0
+
+
+def test_waiting():
+    """Tests that the updates waiting behind the one being handled can be seen by its handler, and only those of its chat
+    """
+    pool = UpdatePool(workers=2, queue_size=10)
+    seen = []
+    pool.submit(1, lambda: seen.append(pool.waiting(1)))
+    pool.submit(1, lambda update_id: seen.append(pool.waiting(1)), "second")
+    pool.submit(2, lambda update_id: None, "other chat")
+    pool.shutdown(wait=True)
+    assert seen[0] in ([], [("second",)])  # the second update may arrive after the first one is handled
+    assert seen[1] == []
+    assert pool.waiting(1) == []
+
+
+def test_capacity():
+    """Tests that submit waits for a free slot once workers + queue_size updates are running or waiting
+    """
+    pool = UpdatePool(workers=1, queue_size=1)
+    release = Event()
+    pool.submit(1, release.wait, TIMEOUT)
+    pool.submit(1, lambda: None)
+    assert pool.pending == 2
+
+    submitted = Event()
+    submitter = Thread(target=lambda: (pool.submit(1, lambda: None), submitted.set()), daemon=True)
+    submitter.start()
+    assert not submitted.wait(0.2)  # the pool is full
+    release.set()
+    assert submitted.wait(TIMEOUT)
+    pool.shutdown(wait=True)
+    assert pool.pending == 0
+
+
+def test_default_workers():
+    """Tests that the number of cpus is used when the workers are not set
+    """
+    pool = UpdatePool(workers=0, queue_size=4)
+    assert pool.workers >= 1
+    assert pool.capacity == pool.workers + 4
+    pool.shutdown()
+
+
+def test_connections(monkeypatch):
+    """Tests that by default there is a connection for each worker of the pool and for each job of the render engine
+
+    Args:
+        monkeypatch (MonkeyPatch): used to restore the settings
+    """
+    monkeypatch.setitem(config_map, 'api', dict(config_map['api'], con_pool_size=0))
+    monkeypatch.setitem(config_map, 'dispatcher', dict(config_map['dispatcher'], workers=3, queue_size=50))
+    monkeypatch.setitem(config_map, 'render', dict(config_map['render'], workers=2, queue_size=8))
+    updater = create_updater("123456:TEST")
+    assert updater.bot.request.con_pool_size == 3 + 2 + 8 + 4
+    updater.dispatcher.pool.shutdown()